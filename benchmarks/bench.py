@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of repacked package builds
+
+Generates a synthetic packagespec and BUILD tree (file count, size
+distribution, directory depth, symlinks and sparse files are configurable),
+builds it with every package format plugin and reads timings of build
+stages (spec parsing, staging, indexing, rendering, archive writing, ...)
+from the --trace output of repacked. Results are written as JSON and can
+be compared against a stored baseline, the run fails when a stage got
+slower than the threshold allows.
+
+Runs offline, dpkg-deb, rpmbuild and fakeroot are replaced by stubs when
+they are not installed.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import platform
+import tempfile
+import statistics
+import subprocess
+import optparse
+import logging
+
+logger = logging.getLogger()
+logger.addHandler(logging.StreamHandler())
+
+REPACKED = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "repacked", "repacked.py")
+
+FORMATS = ["debian", "rpm"]
+
+# Stages shorter than this are noise, they never count as regressions
+MIN_TIME = 0.01
+
+SPEC_TEMPLATE = """name: {name}
+version: 1.0.{files}
+release: 1
+maintainer: Benchmark <bench@example.com>
+summary: Synthetic benchmark package
+description: |
+    Package with {files} generated files
+packagetree: BUILD/
+packages:
+  - package: debian
+    architecture: all
+    requires: libc6
+  - package: rpm
+    architecture: noarch
+    requires: glibc
+    directory_exclude_list:
+      - /usr
+      - /usr/share
+"""
+
+STUBS = {
+    "fakeroot": '#!/bin/sh\nexec "$@"\n',
+    # dpkg-deb --build [options] directory package.deb
+    "dpkg-deb": '#!/bin/sh\nfor last; do :; done\nfor arg; do [ -d "$arg" ] && dir=$arg; done\n'
+        'tar -cf "$last" -C "$dir" .\n',
+    "rpmbuild": '#!/bin/sh\nexit 0\n',
+}
+
+def file_sizes(count, median, sigma, max_size, rng):
+    """
+    Returns log-normally distributed file sizes, a few large files and
+    many small ones like in real package trees
+    """
+
+    mu = 0 if median <= 0 else math.log(median)
+    return [min(int(rng.lognormvariate(mu, sigma)), max_size) for i in range(count)]
+
+def generate_tree(directory, files=1000, depth=4, fanout=8, median_size=4096, size_sigma=1.5,
+                  max_size=64 << 20, symlinks=0.05, sparse=0, seed=0):
+    """
+    Creates packagespec and BUILD tree in directory, returns path of
+    the packagespec
+    """
+
+    rng = random.Random(seed)
+    build = os.path.join(directory, "BUILD")
+    os.makedirs(build)
+
+    # Random directory layout below usr/share, at most depth levels deep
+    directories = [os.path.join("usr", "share", "bench")]
+    for level in range(depth):
+        for parent in list(directories):
+            if parent.count(os.sep) - 2 != level:
+                continue
+            for i in range(rng.randint(1, fanout)):
+                directories.append(os.path.join(parent, "d{0}".format(i)))
+    for path in directories:
+        os.makedirs(os.path.join(build, path))
+
+    block = os.urandom(1 << 20)
+    sizes = file_sizes(files, median_size, size_sigma, max_size, rng)
+    created = []
+    for i, size in enumerate(sizes):
+        path = os.path.join(rng.choice(directories), "f{0}".format(i))
+        with open(os.path.join(build, path), "wb") as f:
+            if i < sparse:
+                # Sparse file, only the last byte is written
+                f.truncate(max(size, 1 << 20) - 1)
+                f.write(b"\0")
+            else:
+                remaining = size
+                while remaining > 0:
+                    offset = rng.randrange(len(block))
+                    chunk = block[offset:offset + remaining]
+                    f.write(chunk)
+                    remaining -= len(chunk)
+        created.append(path)
+
+    for i in range(int(files * symlinks)):
+        target = rng.choice(created)
+        link = os.path.join(os.path.dirname(target), "l{0}".format(i))
+        if not os.path.lexists(os.path.join(build, link)):
+            os.symlink(os.path.basename(target), os.path.join(build, link))
+
+    specfile = os.path.join(directory, "packagespec")
+    with open(specfile, "w") as f:
+        f.write(SPEC_TEMPLATE.format(name="bench", files=files))
+    return specfile
+
+def stub_tools(directory):
+    """
+    Writes stubs of build tools which are not installed, returns PATH
+    for the build
+    """
+
+    bindir = os.path.join(directory, "stubs")
+    os.makedirs(bindir)
+    for tool, script in STUBS.items():
+        if shutil.which(tool):
+            continue
+        logger.warning("{0} not found, using a stub".format(tool))
+        path = os.path.join(bindir, tool)
+        with open(path, "w") as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+    return bindir + os.pathsep + os.environ.get("PATH", "")
+
+def run_build(specfile, pkg_format, options, workdir, env):
+    """
+    Builds one package format with tracing, returns {stage: seconds}
+    """
+
+    output = tempfile.mkdtemp(dir=workdir, prefix="out-")
+    tracefile = os.path.join(workdir, "trace.json")
+    command = [sys.executable, REPACKED, specfile, "-f", pkg_format, "-o", output, "--trace", tracefile,
+        "--version-db", os.path.join(workdir, "versions.db")]
+    if pkg_format == "debian":
+        command += ["--deb-builder", options.deb_builder]
+    else:
+        command += ["--rpm-builder", options.rpm_builder]
+    command += options.extra
+
+    started = time.time()
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env,
+        cwd=os.path.dirname(specfile))
+    wall = time.time() - started
+    if process.returncode:
+        sys.stderr.write(process.stdout.decode("utf-8", "replace"))
+        raise RuntimeError("Build of {0} package failed".format(pkg_format))
+
+    with open(tracefile) as f:
+        events = json.load(f)["traceEvents"]
+    stages = {"total": wall}
+    for event in events:
+        stages[event["name"]] = stages.get(event["name"], 0) + event["dur"] / 1e6
+    stages["size"] = sum(os.path.getsize(os.path.join(output, name)) for name in os.listdir(output)
+        if os.path.isfile(os.path.join(output, name)))
+    shutil.rmtree(output)
+    return stages
+
+def benchmark(options):
+    workdir = tempfile.mkdtemp(prefix="repacked-bench-")
+    try:
+        logger.info("Generating {0} files in {1}".format(options.files, workdir))
+        specfile = generate_tree(os.path.join(workdir, "project"), files=options.files, depth=options.depth,
+            fanout=options.fanout, median_size=options.median_size, size_sigma=options.size_sigma,
+            max_size=options.max_size, symlinks=options.symlinks, sparse=options.sparse, seed=options.seed)
+
+        env = dict(os.environ)
+        env["PATH"] = stub_tools(workdir)
+        env.pop("REPACKED_DEBUG", None)
+
+        results = {}
+        for pkg_format in options.formats:
+            runs = []
+            for i in range(options.warmup + options.repeat):
+                # Digest cache and compiled templates live in ~/.repacked,
+                # cold runs get a new home directory every time
+                home = os.path.join(workdir, "home-{0}".format(i if options.cold else 0))
+                if not os.path.isdir(home):
+                    os.makedirs(home)
+                env["HOME"] = home
+                stages = run_build(specfile, pkg_format, options, workdir, env)
+                if i >= options.warmup:
+                    runs.append(stages)
+            names = sorted(set(name for run in runs for name in run))
+            results[pkg_format] = dict((name, statistics.median(run.get(name, 0) for run in runs)) for name in names)
+            results[pkg_format]["size"] = statistics.median_low(run["size"] for run in runs)
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def compare(results, baseline, threshold, min_time=MIN_TIME):
+    """
+    Returns list of (format, stage, baseline, current) of stages slower
+    than baseline by more than threshold (0.2 is 20 %)
+    """
+
+    regressions = []
+    for pkg_format, stages in results.items():
+        for stage, current in stages.items():
+            if stage == "size":
+                continue
+            previous = baseline.get(pkg_format, {}).get(stage)
+            if previous is None or current < min_time:
+                continue
+            if current > previous * (1 + threshold):
+                regressions.append((pkg_format, stage, previous, current))
+    return regressions
+
+def format_results(results, baseline=None):
+    """
+    Returns text table of stage timings, with change against baseline
+    """
+
+    lines = [["format", "stage", "time", "baseline", "change"]]
+    for pkg_format, stages in sorted(results.items()):
+        for stage, current in sorted(stages.items(), key=lambda item: -item[1] if item[0] != "size" else 0):
+            previous = (baseline or {}).get(pkg_format, {}).get(stage)
+            if stage == "size":
+                value, old = str(current), "" if previous is None else str(previous)
+            else:
+                value, old = "{0:.3f}s".format(current), "" if previous is None else "{0:.3f}s".format(previous)
+            change = "" if not previous else "{0:+.0f}%".format((current - previous) * 100.0 / previous)
+            lines.append([pkg_format, stage, value, old, change])
+    widths = [max(len(line[i]) for line in lines) for i in range(len(lines[0]))]
+    return "\n".join("  ".join(value.ljust(width) if i < 2 else value.rjust(width)
+        for i, (value, width) in enumerate(zip(line, widths))) for line in lines)
+
+def main():
+    logger.setLevel(logging.DEBUG if os.environ.get("REPACKED_DEBUG") else logging.INFO)
+
+    parser = optparse.OptionParser(description="Benchmarks repacked builds of a synthetic package tree.",
+        prog="bench.py", usage="%prog [options] [-- repacked options]")
+    parser.add_option('--files', '-n', type="int", default=2000, help="Number of generated files, default 2000")
+    parser.add_option('--depth', type="int", default=4, help="Maximum directory depth, default 4")
+    parser.add_option('--fanout', type="int", default=6, help="Maximum subdirectories of a directory, default 6")
+    parser.add_option('--median-size', type="int", default=4096, help="Median file size in bytes, default 4096")
+    parser.add_option('--size-sigma', type="float", default=1.5, help="Sigma of log-normal file size distribution, default 1.5")
+    parser.add_option('--max-size', type="int", default=64 << 20, help="Maximum file size in bytes, default 64 MiB")
+    parser.add_option('--symlinks', type="float", default=0.05, help="Symlinks per generated file, default 0.05")
+    parser.add_option('--sparse', type="int", default=0, help="Number of sparse files, default 0")
+    parser.add_option('--seed', type="int", default=0, help="Seed of the tree generator")
+    parser.add_option('--format', '-f', dest="formats", action="append", default=None, help="Benchmarked package format (debian/rpm), default all")
+    parser.add_option('--deb-builder', default="native", help="Tool creating deb packages (native/dpkg-deb), default native")
+    parser.add_option('--rpm-builder', default="native", help="Tool creating rpm packages (native/rpmbuild), default native")
+    parser.add_option('--repeat', '-r', type="int", default=3, help="Measured runs of every format, median is reported, default 3")
+    parser.add_option('--warmup', type="int", default=1, help="Runs before the measured ones, default 1")
+    parser.add_option('--cold', default=False, action="store_true", help="Start every run with empty digest and template caches")
+    parser.add_option('--output', '-o', default=None, help="Write results to file as JSON")
+    parser.add_option('--baseline', '-b', default=None, help="Compare results with baseline JSON file, exit with 1 on regressions")
+    parser.add_option('--threshold', '-t', type="float", default=0.2, help="Allowed slowdown against baseline, default 0.2 (20 %)")
+    parser.add_option('--save-baseline', default=None, help="Write results to file as the new baseline")
+
+    options, arguments = parser.parse_args()
+    options.extra = arguments
+    options.formats = options.formats or FORMATS
+    for pkg_format in options.formats:
+        if pkg_format not in FORMATS:
+            parser.error("Unknown package format {0}".format(pkg_format))
+
+    results = benchmark(options)
+
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    document = {
+        "created": time.time(),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "parameters": dict((name, getattr(options, name)) for name in ("files", "depth", "fanout", "median_size",
+            "size_sigma", "max_size", "symlinks", "sparse", "seed", "deb_builder", "rpm_builder", "repeat", "cold", "extra")),
+        "results": results,
+    }
+    for filename in (options.output, options.save_baseline):
+        if filename:
+            with open(filename, "w") as f:
+                json.dump(document, f, indent=2, sort_keys=True)
+
+    print(format_results(results, baseline))
+
+    if baseline is not None:
+        regressions = compare(results, baseline, options.threshold)
+        for pkg_format, stage, previous, current in regressions:
+            logger.error("{0} {1}: {2:.3f}s -> {3:.3f}s".format(pkg_format, stage, previous, current))
+        if regressions:
+            logger.error("{0} stage(s) slower than baseline by more than {1:.0f}%".format(len(regressions), options.threshold * 100))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Content addressed store of built packages
+
+Packages in the output directory are stored once by their sha256 in
+OUTPUTDIR/.artifacts and exposed under their usual file names through
+hardlinks. A package with the same content as one built before, for
+another profile or in an earlier run, takes no extra space. Objects no
+longer needed are removed by collect(), which keeps the packages of the
+builds recorded last in the version DB.
+"""
+
+import os
+import stat
+import logging
+
+from versionstore import digest_artifact
+
+logger = logging.getLogger()
+
+STORE_DIR = ".artifacts"
+
+class ArtifactStore:
+    """
+    Stores packages of output_dir in output_dir/.artifacts/<sha[:2]>/<sha>
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.store_dir = os.path.join(output_dir, STORE_DIR)
+
+    def path(self, digest):
+        return os.path.join(self.store_dir, digest[:2], digest)
+
+    def release(self, filename):
+        """
+        Unlinks package name shared with a stored object before the
+        package is built again, external tools may write it in place
+        """
+
+        path = os.path.join(self.output_dir, filename)
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return
+        if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+            os.unlink(path)
+
+    def add(self, filename, digest=None):
+        """
+        Moves built package into the store and links it back under its
+        name, returns its digest, None when it isn't a regular file.
+        Package is hashed only when its digest isn't given.
+        """
+
+        path = os.path.join(self.output_dir, filename)
+        if digest is None:
+            digest = digest_artifact(path)
+        if digest is None:
+            return None
+
+        obj = self.path(digest)
+        if not os.path.isdir(os.path.dirname(obj)):
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+        try:
+            os.link(path, obj)
+            logger.debug("Stored {0} as {1}".format(filename, digest))
+            return digest
+        except FileExistsError:
+            pass
+        except OSError as e:
+            logger.warning("Can't store {0} in {1}: {2}".format(filename, self.store_dir, e))
+            return digest
+
+        if os.path.samefile(path, obj):
+            return digest
+
+        # Same content is stored already, the new copy is replaced by a link to it
+        tmpfile = "{0}.{1}.tmp".format(path, os.getpid())
+        os.link(obj, tmpfile)
+        os.rename(tmpfile, path)
+        logger.info("{0} is identical to a stored package, linked to {1}".format(filename, digest))
+        return digest
+
+    def objects(self):
+        """
+        Yields (digest, path) of all stored objects
+        """
+
+        if not os.path.isdir(self.store_dir):
+            return
+        for prefix in sorted(os.listdir(self.store_dir)):
+            directory = os.path.join(self.store_dir, prefix)
+            if not os.path.isdir(directory):
+                continue
+            for digest in sorted(os.listdir(directory)):
+                yield digest, os.path.join(directory, digest)
+
+    def collect(self, keep):
+        """
+        Removes objects whose digest is not in keep together with the
+        names linked to them. Objects in keep stay even when no name is
+        linked to them anymore, e.g. after the package was moved away.
+        Returns number of objects and bytes removed.
+        """
+
+        # Names of packages by inode, only names of stored objects are removed
+        names = {}
+        for entry in os.scandir(self.output_dir):
+            if entry.is_file(follow_symlinks=False):
+                st = entry.stat(follow_symlinks=False)
+                if st.st_nlink > 1:
+                    names.setdefault((st.st_dev, st.st_ino), []).append(entry.path)
+
+        removed = 0
+        size = 0
+        for digest, path in self.objects():
+            if digest in keep:
+                continue
+            st = os.lstat(path)
+            for name in names.get((st.st_dev, st.st_ino), []):
+                logger.info("Removing {0}".format(name))
+                os.unlink(name)
+            os.unlink(path)
+            removed += 1
+            size += st.st_size
+
+        for prefix in os.listdir(self.store_dir) if os.path.isdir(self.store_dir) else []:
+            directory = os.path.join(self.store_dir, prefix)
+            if os.path.isdir(directory) and not os.listdir(directory):
+                os.rmdir(directory)
+        return removed, size
@@ -0,0 +1,143 @@
+"""
+Content addressed cache of built packages
+
+Packages are stored under a key computed from everything the package is
+made of: the packagetree manifest, spec metadata, package entry, resolved
+configuration, installation scripts and templates used to render control
+files. When the key of a package matches a stored one, the stored package
+is reused and no build tree is created.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import logging
+
+from staging import FileLinker
+from treeindex import index_tree
+
+logger = logging.getLogger()
+
+def digest_file(filename):
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def tree_manifest(sha, packagetree, follow_symlinks=True):
+    """
+    Feeds path, type, mode, size, mtime and link target of every entry
+    of packagetree into sha, returns number of entries
+    """
+
+    index = index_tree(packagetree, follow_symlinks)
+    for entry in index.entries:
+        record = "{0}\0{1:o}\0{2}\0{3}\0{4}\n".format(
+            entry.path, entry.mode, entry.size, entry.mtime_ns, entry.linkto)
+        sha.update(record.encode("utf-8", "surrogateescape"))
+    return len(index.entries)
+
+class BuildCache:
+    """
+    Stores built packages in cache_dir/<key>/<package filename>
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        # Packages are never hardlinked, external tools may overwrite them in place
+        self.linker = FileLinker(["reflink", "copy_range"])
+
+    def copy(self, src, dst):
+        if os.path.exists(dst):
+            os.unlink(dst)
+        self.linker.link(src, dst, os.stat(src))
+
+    def key(self, spec, package, config, plugin_name, architecture, template_dir):
+        sha = hashlib.sha256()
+
+        metadata = dict((k, v) for k, v in spec.items() if k != 'packages')
+        settings = {
+            'plugin': plugin_name,
+            'package': package,
+            'spec': metadata,
+            'version': config.version,
+            'release': config.release,
+            'profile': config.profile,
+            'architecture': architecture,
+            'preserve_symlinks': config.preserve_symlinks,
+            'preserve_permissions': config.preserve_permissions,
+            'deb_builder': config.deb_builder,
+            'rpm_builder': config.rpm_builder,
+            'compression': config.compression,
+            'compression_level': config.compression_level,
+            'compression_threads': config.compression_threads,
+        }
+        if config.source_date_epoch is not None:
+            settings['source_date_epoch'] = config.source_date_epoch
+        sha.update(json.dumps(settings, sort_keys=True, default=str).encode("utf-8"))
+
+        # Content of installation scripts and templates
+        scripts = package.get('scripts', spec.get('scripts')) or {}
+        for script, filename in sorted(scripts.items()):
+            if os.path.isfile(filename):
+                sha.update("{0}\0{1}\n".format(script, digest_file(filename)).encode("utf-8"))
+
+        if template_dir and os.path.isdir(template_dir):
+            for name in sorted(os.listdir(template_dir)):
+                sha.update("{0}\0{1}\n".format(name, digest_file(os.path.join(template_dir, name))).encode("utf-8"))
+
+        if spec.get('packagetree') and os.path.isdir(spec['packagetree']):
+            tree_manifest(sha, spec['packagetree'], not config.preserve_symlinks)
+
+        return sha.hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def fetch(self, key, output_dir):
+        """
+        Places cached package into output_dir, returns its filename
+        or None when key is not cached
+        """
+
+        entry = self.entry_dir(key)
+        if not os.path.isdir(entry):
+            return None
+
+        for filename in os.listdir(entry):
+            os.makedirs(output_dir, exist_ok=True)
+            self.copy(os.path.join(entry, filename), os.path.join(output_dir, filename))
+            return filename
+
+        return None
+
+    def store(self, key, artifact, since=0):
+        """
+        Stores artifact under key, artifacts older than since are
+        left over from previous builds and are not stored
+        """
+
+        if not os.path.isfile(artifact) or os.stat(artifact).st_mtime < since:
+            logger.debug("Package {0} was not built, not caching it".format(artifact))
+            return
+
+        entry = self.entry_dir(key)
+        if os.path.isdir(entry):
+            return
+
+        parent = os.path.dirname(entry)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+
+        # Entry appears atomically, concurrent builds never see a partial one
+        tmpdir = tempfile.mkdtemp(dir=parent)
+        try:
+            self.copy(artifact, os.path.join(tmpdir, os.path.basename(artifact)))
+            os.rename(tmpdir, entry)
+        except OSError:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        logger.debug("Package {0} cached as {1}".format(artifact, key))
@@ -0,0 +1,278 @@
+"""
+Block parallel compression of package payloads
+
+Input is split into blocks which are compressed independently on all
+cores and written out in order. Gzip blocks are written as concatenated
+gzip members, xz blocks are assembled into a single multi-block xz stream
+(the same thing xz -T does). Zstd is left to the zstandard module or to
+the zstd tool, both compress frames on several threads themselves.
+"""
+
+import os
+import gzip
+import lzma
+import zlib
+import shutil
+import struct
+import threading
+import subprocess
+import collections
+import concurrent.futures
+import logging
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger()
+
+CODECS = ["gzip", "xz", "zstd"]
+
+DEFAULT_LEVELS = {"gzip": 9, "xz": 6, "zstd": 3}
+LEVEL_RANGES = {"gzip": (1, 9), "xz": (0, 9), "zstd": (1, 22)}
+
+# File name suffixes of compressed tar members in .deb packages
+DEB_SUFFIXES = {"gzip": "gz", "xz": "xz", "zstd": "zst"}
+
+# Size of xz blocks is three times the dictionary size of the preset, as xz -T does
+XZ_DICT_SIZES = [256 << 10, 1 << 20, 2 << 20, 4 << 20, 4 << 20, 8 << 20, 8 << 20, 16 << 20, 32 << 20, 64 << 20]
+
+XZ_MAGIC = b"\xfd7zXZ\x00"
+XZ_FLAGS_CRC64 = b"\x00\x04"
+
+def resolve_threads(threads):
+    """
+    Returns number of compression threads, 0 or None means all cores
+    """
+    if not threads:
+        return os.cpu_count() or 1
+    return int(threads)
+
+def codec_available(codec):
+    if codec == "zstd":
+        return zstandard is not None or shutil.which("zstd") is not None
+    return codec in CODECS
+
+def check_settings(codec, level):
+    """
+    Returns error message for unsupported codec or level, None when
+    settings are fine
+    """
+
+    if codec is not None and codec not in CODECS:
+        return "compression not supported. Supported values: {0}".format("/".join(CODECS))
+    if codec is not None and not codec_available(codec):
+        return "{0} compression needs zstandard python module or zstd tool".format(codec)
+    if level is not None:
+        try:
+            level = int(level)
+        except ValueError:
+            return "compression level {0} is not a number".format(level)
+        # Without codec the level is used with default codecs of the builders
+        for name in [codec] if codec else ["gzip", "xz"]:
+            low, high = LEVEL_RANGES[name]
+            if not low <= level <= high:
+                return "compression level {0} out of range {1}-{2} of {3}".format(level, low, high, name)
+    return None
+
+def open_compressor(fp, codec, level=None, threads=None, stable=False):
+    """
+    Returns file object compressing data written to it into fp,
+    closing it finishes the compressed stream but leaves fp open.
+    With stable set, the output doesn't depend on number of threads.
+    """
+
+    level = DEFAULT_LEVELS[codec] if level is None else int(level)
+    threads = resolve_threads(threads)
+
+    if codec == "zstd":
+        if zstandard is not None:
+            return ZstdCompressor(fp, level, threads)
+        return ExternalCompressor(fp, ["zstd", "-q", "-c", "-{0}".format(level), "-T{0}".format(threads)] + (["--ultra"] if level > 19 else []))
+
+    if threads == 1 and not stable:
+        # Single stream, same output as the compressors of dpkg-deb and rpmbuild
+        if codec == "gzip":
+            return gzip.GzipFile(fileobj=fp, mode="wb", compresslevel=level, mtime=0)
+        return lzma.LZMAFile(fp, "wb", check=lzma.CHECK_CRC64, preset=level)
+
+    if codec == "gzip":
+        return GzipBlockCompressor(fp, level, threads)
+    return XzBlockCompressor(fp, level, threads)
+
+class BlockCompressor:
+    """
+    Splits written data into blocks compressed by a pool of threads,
+    compressed blocks are written to fp in order
+    """
+
+    block_size = 1 << 20
+
+    def __init__(self, fp, level, threads):
+        self.fp = fp
+        self.level = level
+        self.threads = threads
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.blocks = 0
+        # zlib and lzma release the GIL while compressing
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def submit(self, block):
+        self.pending.append((self.executor.submit(self.compress_block, block), len(block)))
+        self.blocks += 1
+        # Bound memory used by blocks waiting to be written
+        while len(self.pending) > self.threads * 2:
+            self.write_block()
+
+    def write_block(self):
+        future, size = self.pending.popleft()
+        self.fp.write(self.emit(future.result(), size))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        try:
+            if self.buffer or not self.blocks:
+                self.submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self.write_block()
+            self.fp.write(self.finish())
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def emit(self, compressed, size):
+        return compressed
+
+    def finish(self):
+        return b""
+
+class GzipBlockCompressor(BlockCompressor):
+    """
+    Every block is a complete gzip member, gzip readers decompress
+    concatenated members as one stream
+    """
+
+    def compress_block(self, block):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress(block) + compressor.flush()
+
+def xz_varint(value):
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+def xz_read_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        value |= (byte & 0x7f) << shift
+        offset += 1
+        shift += 7
+        if not byte & 0x80:
+            return value, offset
+
+class XzBlockCompressor(BlockCompressor):
+    """
+    Blocks are compressed as single block xz streams, their blocks are
+    then put into one stream with an index covering all of them
+    """
+
+    def __init__(self, fp, level, threads):
+        BlockCompressor.__init__(self, fp, level, threads)
+        self.block_size = XZ_DICT_SIZES[level] * 3
+        self.records = []
+        self.fp.write(XZ_MAGIC + XZ_FLAGS_CRC64 + struct.pack("<I", zlib.crc32(XZ_FLAGS_CRC64)))
+
+    def compress_block(self, block):
+        data = lzma.compress(block, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64, preset=self.level)
+        index_size = (struct.unpack("<I", data[-8:-4])[0] + 1) * 4
+        index = data[-12 - index_size:-12]
+        # Index of the stream has exactly one record when block is not empty
+        count, offset = xz_read_varint(index, 1)
+        if not count:
+            return b"", None
+        unpadded, offset = xz_read_varint(index, offset)
+        uncompressed, offset = xz_read_varint(index, offset)
+        return data[12:-12 - index_size], (unpadded, uncompressed)
+
+    def emit(self, compressed, size):
+        block, record = compressed
+        if record is not None:
+            self.records.append(record)
+        return block
+
+    def finish(self):
+        index = b"\x00" + xz_varint(len(self.records))
+        index += b"".join(xz_varint(unpadded) + xz_varint(uncompressed) for unpadded, uncompressed in self.records)
+        index += b"\x00" * (-len(index) % 4)
+        index += struct.pack("<I", zlib.crc32(index))
+
+        backward = struct.pack("<I", len(index) // 4 - 1) + XZ_FLAGS_CRC64
+        return index + struct.pack("<I", zlib.crc32(backward)) + backward + b"YZ"
+
+class ZstdCompressor:
+    """
+    Multi-threaded zstd compression by the zstandard module
+    """
+
+    def __init__(self, fp, level, threads):
+        compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+        self.writer = compressor.stream_writer(fp, closefd=False)
+
+    def write(self, data):
+        return self.writer.write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.writer.close()
+
+class ExternalCompressor:
+    """
+    Pipes data through compression tool, its output is copied to fp
+    """
+
+    def __init__(self, fp, command):
+        self.fp = fp
+        logger.debug("Compressing with {0}".format(" ".join(command)))
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.error = None
+        self.reader = threading.Thread(target=self.copy_output)
+        self.reader.start()
+
+    def copy_output(self):
+        try:
+            for chunk in iter(lambda: self.process.stdout.read(1024 * 1024), b""):
+                self.fp.write(chunk)
+        except Exception as e:
+            self.error = e
+
+    def write(self, data):
+        self.process.stdin.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.process.stdin.close()
+        self.reader.join()
+        if self.process.wait():
+            raise IOError("{0} failed with exit code {1}".format(self.process.args[0], self.process.returncode))
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,250 @@
+"""
+Native writer of Debian binary packages
+
+Package is an ar archive holding debian-binary, control.tar and data.tar
+members. Archives are streamed directly into the package file, owner and
+group of all entries are set to root in tar headers, so there is no need
+for fakeroot and dpkg-deb.
+"""
+
+import io
+import os
+import gzip
+import time
+import shutil
+import tarfile
+import tempfile
+import logging
+
+from compression import DEB_SUFFIXES, open_compressor
+
+logger = logging.getLogger()
+
+AR_MAGIC = b"!<arch>\n"
+DEB_FORMAT_VERSION = b"2.0\n"
+
+class ArMember:
+    """
+    File object writing one member of an ar archive. Size of the member
+    is not known in advance, header is fixed when member is closed.
+    """
+
+    def __init__(self, fp, name, mtime=0):
+        self.fp = fp
+        self.name = name
+        self.mtime = mtime
+        self.offset = fp.tell()
+        self.size = 0
+        self.fp.write(self.header())
+
+    def header(self):
+        header = "{0:<16}{1:<12}{2:<6}{3:<6}{4:<8}{5:<10}`\n".format(
+            self.name, int(self.mtime), 0, 0, "100644", self.size)
+        return header.encode("ascii")
+
+    def write(self, data):
+        self.fp.write(data)
+        self.size += len(data)
+
+    def close(self):
+        end = self.fp.tell()
+        self.fp.seek(self.offset)
+        self.fp.write(self.header())
+        self.fp.seek(end)
+        if self.size % 2:
+            self.fp.write(b"\n")
+
+def walk_sorted(root, top="", follow_symlinks=False):
+    """
+    Yields (path, arcname) of all entries below root, sorted by name,
+    directories always precede their content
+    """
+
+    entries = sorted(os.scandir(root), key=lambda e: e.name)
+    for entry in entries:
+        arcname = os.path.join(top, entry.name)
+        yield entry.path, arcname
+        if entry.is_dir(follow_symlinks=follow_symlinks):
+            for item in walk_sorted(entry.path, arcname, follow_symlinks):
+                yield item
+
+def current_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+class DebWriter:
+    """
+    Writes a .deb package from control and data directories, or directly
+    from a source tree and in-memory control files
+    """
+
+    def __init__(self, filename, compression="xz", control_compression="gz", follow_symlinks=False, preserve_permissions=True, level=None, threads=None,
+            source_date_epoch=None):
+        self.filename = filename
+        # Reproducible output: newer mtimes are clamped, archive timestamps are set to it
+        self.source_date_epoch = source_date_epoch
+        self.compression = compression
+        self.level = level
+        self.threads = threads
+        self.control_compression = control_compression
+        self.follow_symlinks = follow_symlinks
+        self.preserve_permissions = preserve_permissions
+
+    def tarinfo(self, tar, path, arcname):
+        info = tar.gettarinfo(path, "./" + arcname if arcname else "./")
+        if info is None:
+            # Sockets can't be archived
+            return None
+        info.uid = info.gid = 0
+        info.uname = info.gname = "root"
+        if self.source_date_epoch is not None:
+            info.mtime = min(info.mtime, self.source_date_epoch)
+        return info
+
+    def memberinfo(self, arcname, size=0, mode=0o644, directory=False):
+        info = tarfile.TarInfo("./" + arcname)
+        info.type = tarfile.DIRTYPE if directory else tarfile.REGTYPE
+        info.size = size
+        info.mode = mode
+        info.mtime = int(time.time()) if self.source_date_epoch is None else self.source_date_epoch
+        info.uname = info.gname = "root"
+        return info
+
+    def add_files(self, tar, files, seen_dirs):
+        """
+        Adds in-memory (arcname, data, mode) files, missing parent
+        directories are created. Data can be a function returning
+        the content, it is called when the file is added.
+        """
+
+        # Sorted by name like files of directories, output doesn't depend on the order given
+        for arcname, data, mode in sorted(files, key=lambda f: f[0]):
+            if callable(data):
+                data = data()
+            parents = []
+            parent = os.path.dirname(arcname)
+            while parent and parent not in seen_dirs:
+                parents.insert(0, parent)
+                parent = os.path.dirname(parent)
+            for parent in parents:
+                tar.addfile(self.memberinfo(parent, mode=0o755, directory=True))
+                seen_dirs.add(parent)
+            tar.addfile(self.memberinfo(arcname, len(data), mode), io.BytesIO(data))
+
+    def entries(self, root, fanout, follow_symlinks):
+        if fanout is not None:
+            # Order of files read by fan-out, parents still precede their content
+            return ((os.path.join(root, path), path) for path in fanout.paths)
+        return walk_sorted(root, follow_symlinks=follow_symlinks)
+
+    def write_tar(self, member, root, exclude=(), control=False, files=(), fanout=None):
+        if control and self.control_compression == "gz":
+            # Control archive is small, gzip header gets no timestamp
+            fileobj, mode = gzip.GzipFile(filename="", mode="wb", fileobj=member, mtime=0), "w|"
+        elif control:
+            fileobj, mode = member, "w|" + self.control_compression
+        else:
+            fileobj, mode = open_compressor(member, self.compression, self.level, self.threads, stable=self.source_date_epoch is not None), "w|"
+        # Copying the tree without preserving permissions would apply umask
+        mask = 0o7777 if self.preserve_permissions or control else ~current_umask() & 0o777
+        with tarfile.open(fileobj=fileobj, mode=mode, format=tarfile.GNU_FORMAT) as tar:
+            tar.dereference = self.follow_symlinks and not control
+            seen_dirs = set()
+
+            # Root is usually a private temporary directory
+            info = self.memberinfo("", mode=0o755, directory=True)
+            tar.addfile(info)
+
+            for path, arcname in self.entries(root, fanout, tar.dereference) if root else ():
+                if arcname.split(os.sep)[0] in exclude:
+                    continue
+                info = self.tarinfo(tar, path, arcname)
+                if info is None:
+                    logger.warning("Skipping special file {0}".format(path))
+                    continue
+                if control and info.isfile():
+                    # Maintainer scripts have to be executable, the rest is plain data
+                    info.mode = 0o755 if os.access(path, os.X_OK) else 0o644
+                elif not self.preserve_permissions:
+                    info.mode = (0o777 if info.isdir() else 0o666) & mask
+                if info.isdir():
+                    seen_dirs.add(arcname)
+                if info.isreg():
+                    with fanout.open(path) if fanout else open(path, "rb") as f:
+                        if fanout:
+                            info.size = f.size
+                        tar.addfile(info, f)
+                else:
+                    tar.addfile(info)
+
+            self.add_files(tar, files, seen_dirs)
+
+        if fileobj is not member:
+            fileobj.close()
+
+    def write(self, control_dir, data_dir):
+        """
+        Creates the package, control_dir usually is DEBIAN/ directory
+        inside data_dir which is excluded from data archive
+        """
+
+        exclude = []
+        if os.path.dirname(os.path.abspath(control_dir)) == os.path.abspath(data_dir):
+            exclude.append(os.path.basename(os.path.abspath(control_dir)))
+
+        self.write_package(lambda member: self.write_tar(member, control_dir, control=True),
+            lambda member: self.write_tar(member, data_dir, exclude=exclude))
+
+    def write_stream(self, control_files, data_dir, data_files=(), fanout=None):
+        """
+        Creates the package from in-memory control files and files
+        read directly from data_dir (None for meta packages), data_files
+        are in-memory files added to data archive.
+        Files are (arcname, data, mode) tuples.
+        With fanout, files of data_dir are taken from the fan-out reader
+        and data archive is written before control files are generated.
+        """
+
+        self.write_package(lambda member: self.write_tar(member, None, control=True, files=control_files),
+            lambda member: self.write_tar(member, data_dir, files=data_files, fanout=fanout), data_first=fanout is not None)
+
+    def write_package(self, write_control, write_data, data_first=False):
+        # rpmbuild and dpkg-deb create the output directory too
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        tmpfile = self.filename + ".tmp"
+        try:
+            with open(tmpfile, "wb") as fp:
+                fp.write(AR_MAGIC)
+
+                mtime = self.source_date_epoch or 0
+                member = ArMember(fp, "debian-binary", mtime)
+                member.write(DEB_FORMAT_VERSION)
+                member.close()
+
+                data = None
+                if data_first:
+                    # Members have fixed order, data archive waits in a temporary file
+                    data = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.filename)))
+                    write_data(data)
+
+                member = ArMember(fp, "control.tar." + self.control_compression, mtime)
+                write_control(member)
+                member.close()
+
+                member = ArMember(fp, "data.tar." + DEB_SUFFIXES[self.compression], mtime)
+                if data is not None:
+                    with data:
+                        data.seek(0)
+                        shutil.copyfileobj(data, member, 1024 * 1024)
+                else:
+                    write_data(member)
+                member.close()
+
+            os.rename(tmpfile, self.filename)
+        except:
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+            raise
+
+        logger.debug("Debian package {0} written".format(self.filename))
@@ -0,0 +1,151 @@
+"""
+Checksums of package files
+
+Files of an indexed tree are hashed on a pool of threads, md5 and sha256
+are computed in one pass over every file. Digests are kept in
+~/.repacked/digests.sqlite keyed by (device, inode, size, mtime_ns), so
+files unchanged since the previous build are not read again.
+"""
+
+import os
+import mmap
+import time
+import sqlite3
+import hashlib
+import logging
+import concurrent.futures
+
+from treeindex import FILE
+from tracing import span
+
+logger = logging.getLogger()
+
+cache_path = os.path.expanduser("~/.repacked/digests.sqlite")
+
+# Files larger than this are mapped into memory instead of being read
+MMAP_THRESHOLD = 4 << 20
+CHUNK_SIZE = 1 << 20
+
+# Files modified this recently could change again within the same mtime
+RACY_SECONDS = 2
+
+def hash_file(path, size):
+    """
+    Returns (md5, sha256) hex digests of file
+    """
+
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                with memoryview(m) as view:
+                    for offset in range(0, len(m), CHUNK_SIZE * 8):
+                        # Slices have to be released before the map is closed
+                        with view[offset:offset + CHUNK_SIZE * 8] as chunk:
+                            md5.update(chunk)
+                            sha256.update(chunk)
+        else:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                md5.update(chunk)
+                sha256.update(chunk)
+    return md5.hexdigest(), sha256.hexdigest()
+
+class DigestCache:
+    """
+    Persistent digests of files, shared by concurrent builds
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS digests (
+            dev INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, md5 TEXT, sha256 TEXT,
+            PRIMARY KEY (dev, inode, size, mtime_ns))""")
+        self.db.commit()
+
+    def get(self, entry):
+        row = self.db.execute("SELECT md5, sha256 FROM digests WHERE dev=? AND inode=? AND size=? AND mtime_ns=?",
+            (entry.dev, entry.inode, entry.size, entry.mtime_ns)).fetchone()
+        return tuple(row) if row else None
+
+    def store(self, items):
+        """
+        Stores (entry, (md5, sha256)) items
+        """
+
+        racy = (time.time() - RACY_SECONDS) * 1e9
+        rows = [(e.dev, e.inode, e.size, e.mtime_ns, d[0], d[1]) for e, d in items if e.mtime_ns < racy]
+        if rows:
+            self.db.executemany("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.db.commit()
+
+caches = {}
+
+def get_cache():
+    """
+    Returns digest cache of this process, None when it can't be opened
+    """
+
+    # sqlite connections can't be shared with forked build workers
+    pid = os.getpid()
+    if pid not in caches:
+        try:
+            caches[pid] = DigestCache(cache_path)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Digest cache {0} not available: {1}".format(cache_path, e))
+            caches[pid] = None
+    return caches[pid]
+
+def cached_digests(index):
+    """
+    Returns {path: (md5, sha256)} of regular files of indexed tree
+    found in digest cache and list of entries missing there
+    """
+
+    if index.digests is not None:
+        return dict(index.digests), []
+
+    cache = get_cache()
+    digests = {}
+    missing = []
+    for entry in index.entries:
+        if entry.type != FILE:
+            continue
+        cached = cache.get(entry) if cache else None
+        if cached:
+            digests[entry.path] = cached
+        else:
+            missing.append(entry)
+    return digests, missing
+
+def tree_digests(index, threads=None):
+    """
+    Returns {path: (md5, sha256)} of regular files of indexed tree,
+    digests are computed only once per index
+    """
+
+    if index.digests is not None:
+        return index.digests
+
+    cache = get_cache()
+    digests, missing = cached_digests(index)
+
+    if missing:
+        # hashlib releases the GIL while hashing, threads run in parallel
+        with span("digests", files=len(missing), bytes=sum(e.size for e in missing)):
+            with concurrent.futures.ThreadPoolExecutor(threads or os.cpu_count() or 1) as executor:
+                results = executor.map(lambda e: hash_file(os.path.join(index.root, e.path), e.size), missing)
+                computed = list(zip(missing, results))
+        for entry, digest in computed:
+            digests[entry.path] = digest
+        if cache:
+            cache.store(computed)
+
+    logger.debug("Digests of {0} files, {1} hashed, {2} cached".format(len(digests), len(missing), len(digests) - len(missing)))
+    index.digests = digests
+    return digests
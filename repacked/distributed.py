@@ -0,0 +1,492 @@
+"""
+Distributed package builds
+
+The coordinator (repacked.py --workers) parses the spec, runs hooks and
+splits the build into one job per package. Every job is sent to a worker
+(repacked.py --worker) together with the manifest of packagetree: path,
+type, mode, mtime and sha256 of every entry. Workers keep file contents
+in a content addressed store and ask only for blobs they don't have yet.
+The tree is recreated from the store, the package built there is sent
+back and written into the output directory of the coordinator.
+
+Workers listen on TCP (host:port) or Unix socket (path) addresses and
+build one job at a time, several workers can run on one host. Messages
+are JSON lines, blobs and packages follow the line announcing their size:
+
+    {"action": "build", "job": {...}, "manifest": [...], "scripts": {...}}
+    {"missing": ["<sha256>", ...]}
+    {"blob": "<sha256>", "size": 1234} + data
+    {"state": "done", "filename": "foo_1.0-1_all.deb", "size": 5678, "log": "..."} + data
+
+Workers don't authenticate coordinators, they have to listen only on
+trusted networks.
+"""
+
+import io
+import os
+import json
+import collections
+import shutil
+import signal
+import socket
+import hashlib
+import tempfile
+import threading
+import socketserver
+import logging
+
+from staging import FileLinker
+from treeindex import DIRECTORY, FILE, SYMLINK
+from digests import tree_digests, hash_file
+from tracing import span
+from server import is_listening
+
+logger = logging.getLogger()
+
+CHUNK_SIZE = 1 << 20
+
+class DistributedError(Exception):
+    pass
+
+class TransportError(DistributedError):
+    """
+    Worker can't be reached or closed the connection
+    """
+    pass
+
+def parse_address(address):
+    """
+    Returns (family, address) of host:port or Unix socket path
+    """
+
+    if os.sep in address or ":" not in address:
+        return socket.AF_UNIX, address
+    host, port = address.rsplit(":", 1)
+    return socket.AF_INET, (host, int(port))
+
+class Connection:
+    """
+    JSON lines followed by raw data over a stream socket
+    """
+
+    def __init__(self, rfile, wfile):
+        self.rfile = rfile
+        self.wfile = wfile
+
+    def send(self, message):
+        self.wfile.write((json.dumps(message, default=str) + "\n").encode("utf-8"))
+
+    def send_file(self, path, size):
+        try:
+            f = open(path, "rb")
+        except OSError as e:
+            raise DistributedError("Can't read {0}: {1}".format(path, e))
+        with f:
+            remaining = size
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise DistributedError("{0} changed while it was sent".format(path))
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def flush(self):
+        self.wfile.flush()
+
+    def receive(self):
+        line = self.rfile.readline()
+        if not line:
+            raise TransportError("Connection closed")
+        return json.loads(line.decode("utf-8"))
+
+    def receive_data(self, size, f):
+        """
+        Copies size bytes into file f, returns their sha256
+        """
+
+        sha = hashlib.sha256()
+        remaining = size
+        while remaining > 0:
+            chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise TransportError("Connection closed")
+            sha.update(chunk)
+            try:
+                f.write(chunk)
+            except OSError as e:
+                raise DistributedError("Can't write {0}: {1}".format(f.name, e))
+            remaining -= len(chunk)
+        return sha.hexdigest()
+
+def connect(address, timeout=None):
+    family, addr = parse_address(address)
+    try:
+        if family == socket.AF_UNIX:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            sock.connect(addr)
+        else:
+            sock = socket.create_connection(addr, timeout)
+    except OSError as e:
+        raise TransportError("Can't connect to worker {0}: {1}".format(address, e))
+    return sock
+
+def tree_manifest(index):
+    """
+    Returns manifest of indexed tree, [path, type, mode, mtime_ns, size,
+    linkto, sha256] of every entry, and {sha256: (path, size)} of blobs
+    """
+
+    digests = tree_digests(index)
+    manifest = []
+    blobs = {}
+    for entry in index.entries:
+        if entry.type not in (DIRECTORY, FILE, SYMLINK):
+            logger.warning("Skipping special file {0}".format(entry.path))
+            continue
+        sha256 = digests[entry.path][1] if entry.type == FILE else None
+        manifest.append([entry.path, entry.type, entry.mode, entry.mtime_ns, entry.size, entry.linkto, sha256])
+        if sha256:
+            blobs[sha256] = (os.path.join(index.root, entry.path), entry.size)
+    return manifest, blobs
+
+def file_blob(path):
+    """
+    Returns (sha256, (path, size)) of a file sent besides the tree
+    """
+
+    size = os.path.getsize(path)
+    return hash_file(path, size)[1], (os.path.abspath(path), size)
+
+class Job:
+    """
+    One package built on a worker, message is sent as it is, blobs are
+    {sha256: (path, size)} the worker may ask for
+    """
+
+    def __init__(self, name, message, blobs):
+        self.name = name
+        self.message = message
+        self.blobs = blobs
+        self.worker = None
+        self.filename = None
+        # sha256 of the package, computed while it is received
+        self.digest = None
+        self.error = None
+        self.log = ""
+        self.sent = 0
+        self.attempts = 0
+
+def run_job(address, job, output_dir, timeout=None):
+    """
+    Builds job on worker, raises TransportError when the worker can't
+    be used, build failures are recorded in the job. Errors of local
+    files raise DistributedError, they aren't the worker's fault.
+    """
+
+    job.worker = address
+    job.error = None
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+    except OSError as e:
+        raise DistributedError("Can't create {0}: {1}".format(output_dir, e))
+    sock = connect(address, timeout)
+    try:
+        conn = Connection(sock.makefile("rb"), sock.makefile("wb"))
+        with span("remote build", worker=address, package=job.name, files=0, bytes=0) as args:
+            conn.send(job.message)
+            conn.flush()
+            reply = conn.receive()
+            if "missing" not in reply:
+                job.error = reply.get("error") or "Unexpected reply {0}".format(reply)
+                return
+
+            for sha256 in reply["missing"]:
+                path, size = job.blobs[sha256]
+                conn.send({"blob": sha256, "size": size})
+                conn.send_file(path, size)
+                args["files"] += 1
+                args["bytes"] += size
+            conn.flush()
+            job.sent = args["files"]
+
+            reply = conn.receive()
+            job.log = reply.get("log") or ""
+            if reply.get("state") != "done":
+                job.error = reply.get("error") or "Build failed"
+                return
+
+            # Only plain file names are accepted from workers
+            filename = os.path.basename(reply["filename"])
+            tmpfile = os.path.join(output_dir, filename + ".tmp")
+            try:
+                f = open(tmpfile, "wb")
+            except OSError as e:
+                # Package is read anyway, the worker's connection ends normally
+                with open(os.devnull, "wb") as f:
+                    conn.receive_data(reply["size"], f)
+                raise DistributedError("Can't write {0}: {1}".format(tmpfile, e))
+            try:
+                with f:
+                    job.digest = conn.receive_data(reply["size"], f)
+                try:
+                    os.rename(tmpfile, os.path.join(output_dir, filename))
+                except OSError as e:
+                    raise DistributedError("Can't write {0}: {1}".format(filename, e))
+            except:
+                if os.path.exists(tmpfile):
+                    os.unlink(tmpfile)
+                raise
+            job.filename = filename
+    except (OSError, ValueError, KeyError) as e:
+        raise TransportError("Worker {0} failed: {1}".format(address, e))
+    finally:
+        sock.close()
+
+def run_jobs(workers, jobs, output_dir, timeout=None):
+    """
+    Runs jobs on workers, every worker builds one job at a time. Jobs of
+    a worker which can't be reached are passed to the others.
+    """
+
+    pending = collections.deque(jobs)
+    condition = threading.Condition()
+    # Jobs neither finished nor out of attempts, workers wait for them as
+    # long as a job given back by an unreachable worker may come
+    unsettled = [len(jobs)]
+
+    def next_job():
+        with condition:
+            while not pending:
+                if not unsettled[0]:
+                    return None
+                condition.wait()
+            return pending.popleft()
+
+    def settle(job=None):
+        with condition:
+            if job is not None:
+                pending.append(job)
+            else:
+                unsettled[0] -= 1
+            condition.notify_all()
+
+    def work(address):
+        while True:
+            job = next_job()
+            if job is None:
+                return
+            try:
+                run_job(address, job, output_dir, timeout)
+            except TransportError as e:
+                logger.warning(str(e))
+                job.attempts += 1
+                job.error = str(e)
+                settle(job if job.attempts < len(workers) else None)
+                return
+            except DistributedError as e:
+                job.error = str(e)
+            except BaseException as e:
+                job.error = str(e)
+                settle()
+                raise
+            settle()
+
+    threads = [threading.Thread(target=work, args=(address,), name="worker-" + address) for address in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Jobs given back by the last reachable workers
+    for job in pending:
+        job.error = job.error or "No worker available"
+
+class ManifestStat:
+    """
+    Stat of a manifest entry, as FileLinker expects it
+    """
+
+    def __init__(self, mode, size, mtime_ns):
+        self.st_mode = mode
+        self.st_size = size
+        self.st_mtime_ns = mtime_ns
+        self.st_atime_ns = mtime_ns
+
+class BlobStore:
+    """
+    Content addressed store of files, objects/<sha256[:2]>/<sha256>
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.tmp_dir = os.path.join(self.directory, "tmp")
+        for path in [os.path.join(self.directory, "objects"), self.tmp_dir]:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        self.linker = FileLinker(["reflink", "copy_range"])
+
+    def path(self, sha256):
+        return os.path.join(self.directory, "objects", sha256[:2], sha256)
+
+    def has(self, sha256):
+        return os.path.exists(self.path(sha256))
+
+    def receive(self, conn, sha256, size):
+        fd, tmpfile = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                digest = conn.receive_data(size, f)
+            if digest != sha256:
+                raise DistributedError("Blob {0} arrived corrupted".format(sha256))
+            os.chmod(tmpfile, 0o444)
+            if not os.path.isdir(os.path.dirname(self.path(sha256))):
+                os.makedirs(os.path.dirname(self.path(sha256)), exist_ok=True)
+            os.rename(tmpfile, self.path(sha256))
+        except:
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+            raise
+
+    def copy(self, sha256, dst, mode=0o644, mtime_ns=None):
+        st = os.stat(self.path(sha256))
+        self.linker.link(self.path(sha256), dst, ManifestStat(mode, st.st_size, st.st_mtime_ns if mtime_ns is None else mtime_ns))
+
+    def materialize(self, manifest, root):
+        """
+        Recreates tree described by manifest in root
+        """
+
+        os.makedirs(root)
+        root = os.path.realpath(root)
+        directories = []
+        for path, type, mode, mtime_ns, size, linkto, sha256 in manifest:
+            if os.path.isabs(path) or ".." in path.split("/"):
+                raise DistributedError("Invalid path {0} in manifest".format(path))
+            dst = os.path.join(root, path)
+            # Symlinks of the manifest must not lead its entries out of root
+            parent = os.path.realpath(os.path.dirname(dst))
+            if parent != root and not parent.startswith(root + os.sep):
+                raise DistributedError("Path {0} in manifest leads out of the tree".format(path))
+            if type == DIRECTORY:
+                os.mkdir(dst)
+                directories.append((dst, mode, mtime_ns))
+            elif type == FILE:
+                self.copy(sha256, dst, mode, mtime_ns)
+            elif type == SYMLINK:
+                os.symlink(linkto, dst)
+                os.utime(dst, ns=(mtime_ns, mtime_ns), follow_symlinks=False)
+
+        # Content is in place, directories get their modes and mtimes
+        for dst, mode, mtime_ns in reversed(directories):
+            os.chmod(dst, mode & 0o7777)
+            os.utime(dst, ns=(mtime_ns, mtime_ns))
+
+class Worker:
+    """
+    Builds jobs of coordinators, build(job, tree, scripts, output_dir)
+    returns filename of the package written into output_dir
+    """
+
+    def __init__(self, store_dir, build):
+        self.store = BlobStore(store_dir)
+        self.build = build
+
+    def handle(self, conn):
+        message = conn.receive()
+        if message.get("action") != "build":
+            conn.send({"error": "Unknown action {0}".format(message.get("action"))})
+            conn.flush()
+            return
+
+        manifest = message.get("manifest") or []
+        scripts = message.get("scripts") or {}
+        blobs = set(entry[6] for entry in manifest if entry[1] == FILE) | set(scripts.values())
+        missing = sorted(sha256 for sha256 in blobs if not self.store.has(sha256))
+        conn.send({"missing": missing})
+        conn.flush()
+        for i in range(len(missing)):
+            header = conn.receive()
+            self.store.receive(conn, header["blob"], header["size"])
+        logger.info("Job {0}: {1} files, {2} received".format(message["job"].get("name"), len(blobs), len(missing)))
+
+        # Output of the build goes back to the coordinator
+        log = io.StringIO()
+        handler = logging.StreamHandler(log)
+        handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        logger.addHandler(handler)
+        workdir = tempfile.mkdtemp(prefix="job-", dir=self.store.tmp_dir)
+        try:
+            tree = None
+            if message.get("packagetree"):
+                tree = os.path.join(workdir, "tree")
+                self.store.materialize(manifest, tree)
+            script_paths = {}
+            if scripts:
+                os.mkdir(os.path.join(workdir, "scripts"))
+            for i, (path, sha256) in enumerate(sorted(scripts.items())):
+                script_paths[path] = os.path.join(workdir, "scripts", str(i))
+                self.store.copy(sha256, script_paths[path], 0o755)
+            output_dir = os.path.join(workdir, "out")
+            os.mkdir(output_dir)
+
+            filename = self.build(message["job"], tree, script_paths, output_dir)
+            artifact = os.path.join(output_dir, filename)
+            reply = {"state": "done", "filename": filename, "size": os.path.getsize(artifact)}
+        except (Exception, SystemExit) as e:
+            logger.exception("Job {0} failed".format(message["job"].get("name")))
+            reply = {"state": "failed", "error": str(e) or type(e).__name__}
+            artifact = None
+        finally:
+            logger.removeHandler(handler)
+
+        try:
+            reply["log"] = log.getvalue()
+            conn.send(reply)
+            if artifact:
+                conn.send_file(artifact, reply["size"])
+            conn.flush()
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+class WorkerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            self.server.worker.handle(Connection(self.rfile, self.wfile))
+        except (OSError, ValueError, KeyError, DistributedError) as e:
+            logger.error("Job failed: {0}".format(e))
+
+class TCPWorkerServer(socketserver.TCPServer):
+    allow_reuse_address = True
+
+class UnixWorkerServer(socketserver.UnixStreamServer):
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+def serve_worker(address, build, store_dir):
+    """
+    Runs worker until it is interrupted, jobs are built one at a time
+    """
+
+    family, addr = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(addr):
+            if is_listening(addr):
+                raise OSError("Build worker already listens on {0}".format(addr))
+            os.unlink(addr)
+        server = UnixWorkerServer(addr, WorkerHandler)
+    else:
+        server = TCPWorkerServer(addr, WorkerHandler)
+    server.worker = Worker(store_dir, build)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    logger.info("Build worker listening on {0}, store in {1}".format(address, server.worker.store.directory))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,125 @@
+"""
+Compiled path exclude rules
+
+Rules are absolute paths, plain ones are kept in a set, rules with glob
+patterns are compiled into a trie of path components. "*", "?" and
+"[...]" match within one component, "**" matches any number of
+components including none, e.g. /usr/share/doc/** matches
+/usr/share/doc and everything below it.
+"""
+
+import re
+import fnmatch
+
+GLOB_CHARS = re.compile(r"[*?\[]")
+
+class Node:
+    __slots__ = ("literal", "globs", "deep", "loop", "end")
+
+    def __init__(self, loop=False):
+        self.literal = {}
+        self.globs = []
+        self.deep = None
+        self.loop = loop
+        self.end = False
+
+    def child(self, component):
+        if component == "**":
+            if self.deep is None:
+                self.deep = Node(loop=True)
+            return self.deep
+        if GLOB_CHARS.search(component):
+            for pattern, regex, node in self.globs:
+                if pattern == component:
+                    return node
+            node = Node()
+            self.globs.append((component, re.compile(fnmatch.translate(component)), node))
+            return node
+        return self.literal.setdefault(component, Node())
+
+def closure(nodes):
+    # "**" may match no component at all
+    result = set(nodes)
+    pending = list(nodes)
+    while pending:
+        node = pending.pop()
+        if node.deep is not None and node.deep not in result:
+            result.add(node.deep)
+            pending.append(node.deep)
+    return frozenset(result)
+
+class ExcludeRules:
+    """
+    Matches paths against compiled rules. Paths of a depth-first walk
+    reuse match state of their parent, only the current branch is kept.
+    """
+
+    def __init__(self, patterns):
+        self.exact = set()
+        self.root = Node()
+        self.has_globs = False
+        self.stack = []
+
+        for pattern in patterns or ():
+            pattern = "/" + str(pattern).strip().strip("/")
+            if not GLOB_CHARS.search(pattern):
+                self.exact.add(pattern)
+                continue
+            self.has_globs = True
+            node = self.root
+            for component in pattern.strip("/").split("/"):
+                node = node.child(component)
+            node.end = True
+
+    def __bool__(self):
+        return bool(self.exact) or self.has_globs
+
+    def step(self, states, component):
+        result = set()
+        for node in states:
+            if node.loop:
+                result.add(node)
+            child = node.literal.get(component)
+            if child is not None:
+                result.add(child)
+            for pattern, regex, child in node.globs:
+                if regex.match(component):
+                    result.add(child)
+        return closure(result)
+
+    def states(self, path):
+        """
+        Returns trie states reached by path, states of parents on the
+        current branch are cached
+        """
+
+        if path == "/":
+            return closure([self.root])
+
+        while self.stack and not path.startswith(self.stack[-1][0] + "/"):
+            self.stack.pop()
+
+        if self.stack:
+            parent_path, parent_states = self.stack[-1]
+            rest = path[len(parent_path) + 1:].split("/")
+        else:
+            parent_states = closure([self.root])
+            rest = path.strip("/").split("/")
+
+        states = parent_states
+        for component in rest:
+            states = self.step(states, component) if states else states
+        self.stack.append((path, states))
+        return states
+
+    def match(self, path):
+        """
+        Returns True when absolute path is excluded
+        """
+
+        path = "/" + path.strip("/")
+        if path in self.exact:
+            return True
+        if not self.has_globs:
+            return False
+        return any(node.end for node in self.states(path))
@@ -0,0 +1,229 @@
+"""
+Single-read fan-out of package files
+
+When several packages are written from the same packagetree, every
+regular file is read only once. The reader passes chunks of the file to
+all archive writers, each writer runs in its own thread and compresses
+its archive in parallel with the others. Queues between the reader and
+the writers are bounded, memory use doesn't depend on file sizes.
+
+Writers take files in sorted path order through open(), which returns
+a file object of the next file. Digests of files missing in the digest
+cache are computed by the reader on the way.
+"""
+
+import os
+import queue
+import hashlib
+import threading
+import logging
+
+from treeindex import FILE
+from digests import cached_digests, get_cache
+from tracing import span
+
+logger = logging.getLogger()
+
+CHUNK_SIZE = 1 << 20
+
+# Chunks waiting for one writer
+QUEUE_DEPTH = 16
+
+class FanoutError(Exception):
+    pass
+
+class Stream:
+    """
+    File object of one file read by the fan-out reader
+    """
+
+    def __init__(self, consumer, path, size):
+        self.consumer = consumer
+        self.path = path
+        self.size = size
+        self.chunk = b""
+        self.offset = 0
+        self.finished = False
+        self.md5 = None
+        self.sha256 = None
+
+    def next_item(self):
+        item = self.consumer.queue.get()
+        if isinstance(item, tuple):
+            if item[0] == "end":
+                self.finished = True
+                self.md5, self.sha256 = item[1], item[2]
+                return None
+            raise FanoutError("Reading {0} failed: {1}".format(self.path, item[1]))
+        return item
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.offset >= len(self.chunk):
+                chunk = None if self.finished else self.next_item()
+                if chunk is None:
+                    break
+                self.chunk, self.offset = chunk, 0
+                continue
+            end = len(self.chunk) if size < 0 else min(len(self.chunk), self.offset + size)
+            parts.append(self.chunk[self.offset:end])
+            if size > 0:
+                size -= end - self.offset
+            self.offset = end
+        return b"".join(parts)
+
+    def close(self):
+        # Rest of the file is skipped, the next file follows in the queue
+        while not self.finished:
+            self.next_item()
+        self.chunk = b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class Consumer:
+    """
+    One archive writer of the fan-out
+    """
+
+    def __init__(self, fanout, name):
+        self.fanout = fanout
+        self.name = name
+        self.queue = queue.Queue(QUEUE_DEPTH)
+        self.stream = None
+        self.closed = False
+        self.error = None
+
+    @property
+    def paths(self):
+        """
+        Sorted paths of all entries of the tree relative to its root
+        """
+        return self.fanout.paths
+
+    @property
+    def digests(self):
+        """
+        {path: (md5, sha256)} of files known so far
+        """
+        return self.fanout.digests
+
+    def open(self, path):
+        """
+        Returns file object of the next file, which has to be path
+        """
+
+        if self.stream is not None:
+            self.stream.close()
+        item = self.queue.get()
+        if item[0] == "error":
+            raise FanoutError("Reading {0} failed: {1}".format(path, item[1]))
+        if item[1] != os.path.abspath(path):
+            raise FanoutError("{0} writer wants {1}, but {2} was read".format(self.name, path, item[1]))
+        self.stream = Stream(self, item[1], item[2])
+        return self.stream
+
+    def put(self, item):
+        # Writers which failed don't take anything, the others wait for space
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+class Fanout:
+    """
+    Reads regular files of indexed tree once for all consumers
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.root = os.path.abspath(index.root)
+        self.consumers = []
+        self.paths = sorted(e.path for e in index.entries)
+        self.files = sorted((e for e in index.entries if e.type == FILE), key=lambda e: e.path)
+        self.digests, missing = cached_digests(index)
+        self.missing = set(e.path for e in missing)
+        self.computed = []
+
+    def consumer(self, name):
+        consumer = Consumer(self, name)
+        self.consumers.append(consumer)
+        return consumer
+
+    def send(self, item):
+        for consumer in self.consumers:
+            consumer.put(item)
+
+    def read(self):
+        with span("fanout read", files=0, bytes=0) as args:
+            for entry in self.files:
+                path = os.path.join(self.root, entry.path)
+                with open(path, "rb") as f:
+                    size = os.fstat(f.fileno()).st_size
+                    self.send(("open", path, size))
+                    hashed = entry.path in self.missing
+                    md5 = hashlib.md5() if hashed else None
+                    sha256 = hashlib.sha256() if hashed else None
+                    remaining = size
+                    while remaining > 0:
+                        chunk = f.read(min(CHUNK_SIZE, remaining))
+                        if not chunk:
+                            raise FanoutError("{0} changed while it was read".format(path))
+                        if hashed:
+                            md5.update(chunk)
+                            sha256.update(chunk)
+                        self.send(chunk)
+                        remaining -= len(chunk)
+                if hashed:
+                    digest = (md5.hexdigest(), sha256.hexdigest())
+                    self.digests[entry.path] = digest
+                    self.computed.append((entry, digest))
+                else:
+                    digest = self.digests[entry.path]
+                self.send(("end",) + digest)
+                args["files"] += 1
+                args["bytes"] += size
+
+    def run(self, writers):
+        """
+        Runs writers, list of (consumer, function) pairs, each in its
+        own thread while files are read. Raises the first error.
+        """
+
+        def write(consumer, function):
+            try:
+                function()
+            except BaseException as e:
+                consumer.error = e
+            finally:
+                consumer.closed = True
+
+        threads = [threading.Thread(target=write, args=writer, name="fanout-" + writer[0].name) for writer in writers]
+        for thread in threads:
+            thread.start()
+
+        try:
+            self.read()
+        except BaseException as e:
+            error = e
+            self.send(("error", e))
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+
+        for consumer, function in writers:
+            if consumer.error is not None:
+                raise consumer.error
+
+        # Digests computed on the way are kept for the next builds
+        self.index.digests = self.digests
+        cache = get_cache()
+        if cache and self.computed:
+            cache.store(self.computed)
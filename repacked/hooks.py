@@ -1,20 +1,166 @@
+"""
+Execution of pkgbuild hooks
+
+Hooks form a dependency graph, every hook is started as soon as all hooks
+it depends on have finished, independent hooks run concurrently. Output
+of every hook is streamed to stdout line by line prefixed with the hook
+name. Hooks running longer than their timeout are killed, wall-clock time
+of every hook is recorded.
+"""
 
 import os
-import shutil
-import re
 import sys
-import platform
+import time
+import signal
+import threading
 import subprocess
+import logging
+import concurrent.futures
+
+from tracing import span
+
+logger = logging.getLogger()
+
+# Lines of concurrent hooks are never mixed
+output_lock = threading.Lock()
+
+class Hook:
+    """
+    One hook command, depends is list of names of hooks which have
+    to finish successfully before it is started
+    """
+
+    def __init__(self, name, command, depends=(), timeout=None):
+        self.name = name
+        self.command = list(command)
+        self.depends = list(depends)
+        self.timeout = timeout
+        self.returncode = None
+        self.duration = None
+        self.started = None
+        self.timed_out = False
+
+    def run(self):
+        """
+        Runs the hook, returns its exit code
+        """
+
+        with span("hook " + self.name, "hook") as args:
+            args["returncode"] = self.execute()
+            return args["returncode"]
+
+    def execute(self):
+        logger.debug("Running {0} hook: {1}".format(self.name, " ".join(self.command)))
+        self.started = time.time()
+        try:
+            # Own process group, so a timeout kills also processes started by the hook
+            process = subprocess.Popen(self.command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                start_new_session=True)
+        except OSError as e:
+            logger.error("[{0}] can't run {1}: {2}".format(self.name, self.command[0], e))
+            self.returncode = 127
+            self.duration = time.time() - self.started
+            return self.returncode
+
+        timer = None
+        if self.timeout:
+            timer = threading.Timer(self.timeout, self.kill, [process])
+            timer.start()
+
+        try:
+            for line in iter(process.stdout.readline, b""):
+                self.output(line.decode("utf-8", "replace").rstrip("\n"))
+            self.returncode = process.wait()
+        finally:
+            if timer:
+                timer.cancel()
+            process.stdout.close()
+
+        self.duration = time.time() - self.started
+        if self.timed_out:
+            logger.error("{0} hook timed out after {1}s".format(self.name, self.timeout))
+        elif self.returncode:
+            logger.error("ERROR running {0} hook {1}, exit code {2}".format(self.name, self.command[0], self.returncode))
+        logger.info("{0} hook finished in {1:.1f}s".format(self.name, self.duration))
+        return self.returncode
+
+    def output(self, line):
+        line = "[{0}] {1}".format(self.name, line)
+        with output_lock:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+        logger.debug(line)
+
+    def kill(self, process):
+        self.timed_out = True
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+def check_hooks(hooks):
+    """
+    Returns error message when hooks have unknown or cyclic
+    dependencies, None otherwise
+    """
+
+    names = dict((hook.name, hook) for hook in hooks)
+    if len(names) != len(hooks):
+        return "Hook names have to be unique"
+    for hook in hooks:
+        for name in hook.depends:
+            if name not in names:
+                return "Hook {0} depends on unknown hook {1}".format(hook.name, name)
+
+    done = set()
+    remaining = list(hooks)
+    while remaining:
+        ready = [hook for hook in remaining if set(hook.depends) <= done]
+        if not ready:
+            return "Hooks {0} have cyclic dependencies".format(", ".join(hook.name for hook in remaining))
+        done.update(hook.name for hook in ready)
+        remaining = [hook for hook in remaining if hook.name not in done]
+    return None
+
+def run_hooks(hooks, jobs=None):
+    """
+    Runs hooks respecting their dependencies, at most jobs of them at
+    once. Returns list of hooks which failed or were skipped because
+    a hook they depend on failed.
+    """
+
+    error = check_hooks(hooks)
+    if error:
+        logger.error(error)
+        return list(hooks)
+
+    pending = list(hooks)
+    done = set()
+    failed = []
 
-class RepackedHooks():
-    def init(self):
-        self.RepackedHooksList={}
+    # Hooks mostly wait for their processes, all ready hooks run at once by default
+    with concurrent.futures.ThreadPoolExecutor(jobs or max(len(hooks), 1)) as executor:
+        running = {}
+        while pending or running:
+            failed_names = set(hook.name for hook in failed)
+            for hook in list(pending):
+                if failed_names.intersection(hook.depends):
+                    logger.error("Skipping {0} hook, hooks it depends on failed".format(hook.name))
+                    pending.remove(hook)
+                    failed.append(hook)
+                elif set(hook.depends) <= done:
+                    pending.remove(hook)
+                    running[executor.submit(hook.run)] = hook
 
-    def PkgUpdateDistHook():
-        print("PkgUpdateDistHook")
+            if not running:
+                continue
 
-    def PkgeReleaseHook():
-        print("PkgReleaseHook")
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                hook = running.pop(future)
+                if future.result():
+                    failed.append(hook)
+                else:
+                    done.add(hook.name)
 
-    def PkgBuildPackageHook():
-        print("PkgBuildPackage")
+    return failed
@@ -1,30 +1,32 @@
 
-from repacked import Configuration
-from pkg_resources import resource_string
+from debwriter import DebWriter
+from compression import resolve_threads
+from treeindex import index_tree, FILE
+from digests import tree_digests
 from yapsy.IPlugin import IPlugin
-from mako.template import Template
+from templating import get_template, render_inline
+from tracing import span
+from tools import run_tool
 
 import os
 import distutils.dir_util
-import shutil
 import tempfile
-import re
-import sys
 import platform
 import logging
+import hashlib
 
-tmpl_dir = os.path.expanduser("~/.repacked/templates")
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-if not os.path.exists(tmpl_dir):
-    tmpl_dir = os.path.join(os.path.dirname(__file__),'../../repacked/templates')
-
 class DebianPackager(IPlugin):
     def __init__(self):
         self.spec = {}
         self.package = {}
         self.output_dir = ""
+        self.control_files = []
+        self.data_files = []
+        self.source_root = None
+        self.index = None
         self.preserve_symlinks=False
         self.preserve_permissions=True
 
@@ -60,64 +62,60 @@ class DebianPackager(IPlugin):
 
         return filename
 
+    def format_description(self, description):
+        """
+        Returns extended description for control file, continuation
+        lines are indented by one space and blank lines written as " ."
+        """
+
+        lines = [line.rstrip() for line in description.strip().splitlines()]
+        return "\n".join(line if i == 0 else " " + (line or ".") for i, line in enumerate(lines))
+
     def get_deps(self, package, config):
         if package.get('requires') is not None:
-            return Template(package.get('requires')).render(package_version=config.version)
+            return render_inline(package.get('requires'), package_version=config.version)
         else:
             return None
 
     def tree(self, spec, package, config):
         """
-        Builds a debian package tree
+        Builds a debian package tree. When staging is disabled and the
+        native writer is used, no tree is created, control files are
+        kept in memory and package files are read from packagetree.
         """
 
         self.spec = spec
         self.package = package
+        self.control_files = []
+        self.data_files = []
+        self.source_root = None
 
-        ## Create directories
-
-        # Create the temporary folder
-        tmpdir = tempfile.mkdtemp()
-
-        # Create the directory holding control files
-        os.mkdir(os.path.join(tmpdir, "DEBIAN"))
-
-        try:
-            packagetree=spec['packagetree']
-            # Copy across the contents of the file tree
-            distutils.dir_util.copy_tree(spec['packagetree'], tmpdir, preserve_mode=config.preserve_permissions, preserve_symlinks=config.preserve_symlinks)
-        except KeyError:
+        stream = config.staging_mode == "none" and config.deb_builder == "native"
+        packagetree = spec.get('packagetree')
+        if packagetree is None:
             logger.warning("No BUILDIR provided. This is ok if this should be used as meta package.")
 
-        logger.debug(("Debian package tree created in {0}".format(tmpdir)))
-
-        ## Create control file
-        cf = open(os.path.join(tmpdir, "DEBIAN", "control"), "w")
-
-        cf_template = Template(filename=os.path.join(tmpl_dir, "debcontrol.tmpl"))
+        ## Create directories
+        if stream:
+            tmpdir = None
+            self.source_root = packagetree
+            logger.debug("Debian package files are read from {0}".format(packagetree))
+        else:
+            # Create the temporary folder
+            tmpdir = tempfile.mkdtemp()
 
-        cf_version = config.version
-        cf_release = str(config.release).replace('-','.');
-        cf_provides = package.get('provides')
-        cf_provides = "" if cf_provides == None else ", " + cf_provides
+            # Create the directory holding control files
+            os.mkdir(os.path.join(tmpdir, "DEBIAN"))
 
-        cf_final = cf_template.render(
-            package_name=spec['name'],
-            version="{0}-{1}".format(cf_version, cf_release),
-            architecture=self.checkarch(package['architecture']),
-            maintainer=spec['maintainer'],
-            size=os.path.getsize(tmpdir),
-            summary=spec['summary'],
-            description="\n .\n ".join(re.split(r"\n\s\s*", spec['description'].strip())),
-            dependencies=self.get_deps(package, config),
-            predepends=package.get('predepends'),
-            replaces=package.get('replaces'),
-            provides="{0}-{1}{2}".format(spec['name'], cf_version, cf_provides),
-            conflicts=package.get('conflicts'),
-        )
+            if packagetree is not None:
+                # Copy across the contents of the file tree
+                if config.staging:
+                    config.staging.view(packagetree, tmpdir)
+                else:
+                    with span("copy") as args:
+                        args["files"] = len(distutils.dir_util.copy_tree(spec['packagetree'], tmpdir, preserve_mode=config.preserve_permissions, preserve_symlinks=config.preserve_symlinks))
 
-        cf.write(cf_final)
-        cf.close()
+            logger.debug(("Debian package tree created in {0}".format(tmpdir)))
 
         ## Check for lintian overrides and add them to the build tree
         overrides = package.get('lintian-overrides')
@@ -132,17 +130,42 @@ class DebianPackager(IPlugin):
                 override = o.strip()
                 lintfile += lint_tmpl.format(package=spec['name'], override=override)
 
-            try:
-                os.makedirs(os.path.join(tmpdir, "usr/share/lintian/overrides"))
-                do_overrides = True
-            except:
-                # Directory exists, skip it
-                do_overrides = False
+            # Overrides are not added when the directory exists
+            if not (packagetree and os.path.exists(os.path.join(packagetree, "usr/share/lintian/overrides"))):
+                self.data_files.append((os.path.join("usr/share/lintian/overrides", spec['name']), lintfile.encode("utf-8"), 0o644))
+
+        ## Create control file
+        cf_template = get_template("debcontrol.tmpl")
+
+        cf_version = config.version
+        cf_release = str(config.release).replace('-','.');
+        cf_provides = package.get('provides')
+        cf_provides = "" if cf_provides == None else ", " + cf_provides
 
-            if do_overrides:
-                lf = open(os.path.join(tmpdir, "usr/share/lintian/overrides", spec['name']), "w")
-                lf.write(lintfile)
-                lf.close()
+        index = index_tree(packagetree, not config.preserve_symlinks) if packagetree else None
+        size = index.installed_size() if index else 0
+        size += self.data_files_size(packagetree)
+
+        with span("render", template="debcontrol.tmpl"):
+            cf_final = cf_template.render(
+                package_name=spec['name'],
+                version="{0}-{1}".format(cf_version, cf_release),
+                architecture=self.checkarch(package['architecture']),
+                maintainer=spec['maintainer'],
+                size=size,
+                summary=spec['summary'],
+                description=self.format_description(spec['description']),
+                dependencies=self.get_deps(package, config),
+                predepends=package.get('predepends'),
+                replaces=package.get('replaces'),
+                provides="{0}-{1}{2}".format(spec['name'], cf_version, cf_provides),
+                conflicts=package.get('conflicts'),
+            )
+
+        self.control_files.append(("control", cf_final.encode("utf-8"), 0o644))
+        self.index = index
+        if not (stream and config.single_read):
+            self.control_files.append(("md5sums", self.md5sums(index), 0o644))
 
         ## Copy over installation scripts
         try:
@@ -161,18 +184,98 @@ class DebianPackager(IPlugin):
                 filename = app[1]
 
                 if os.path.isfile(filename):
-                    shutil.copy(filename, os.path.join(tmpdir, "DEBIAN", script))
-                    os.chmod(os.path.join(tmpdir, "DEBIAN", script), 0o755)
+                    with open(filename, "rb") as f:
+                        self.control_files.append((script, f.read(), 0o755))
                 else:
                     logger.error(("Installation script {0} not found.".format(script)))
 
+        if tmpdir:
+            for name, data, mode in self.control_files:
+                self.write_file(os.path.join(tmpdir, "DEBIAN", name), data, mode)
+            for name, data, mode in self.data_files:
+                self.write_file(os.path.join(tmpdir, name), data, mode)
+
         return tmpdir
 
-    def build(self, directory, filename, config):
+    def md5sums(self, index, digests=None):
+        """
+        Returns content of DEBIAN/md5sums listing all regular files
+        """
+
+        lines = []
+        if index:
+            digests = digests if digests is not None else tree_digests(index)
+            lines.extend("{0}  {1}\n".format(digests[e.path][0], e.path) for e in index.entries if e.type == FILE)
+        for name, data, mode in self.data_files:
+            lines.append("{0}  {1}\n".format(hashlib.md5(data).hexdigest(), name))
+        return "".join(lines).encode("utf-8", "surrogateescape")
+
+    def data_files_size(self, packagetree):
         """
-        Builds a deb package from the directory tree
+        Returns installed size in KiB of files added to the tree
+        and of directories created for them
+        """
+
+        size = 0
+        dirs = set()
+        for name, data, mode in self.data_files:
+            size += (len(data) + 1023) // 1024
+            parent = os.path.dirname(name)
+            while parent and parent not in dirs:
+                dirs.add(parent)
+                if not (packagetree and os.path.isdir(os.path.join(packagetree, parent))):
+                    size += 1
+                parent = os.path.dirname(parent)
+        return size
+
+    def write_file(self, path, data, mode):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write(data)
+        os.chmod(path, mode)
+
+    def build(self, directory, filename, config, fanout=None):
+        """
+        Builds a deb package from the directory tree, files of a
+        streamed package can come from single-read fan-out
         """
 
         filename = os.path.join(config.output_dir, filename)
-        logger.debug(("fakeroot dpkg-deb --build {0} {1}".format(directory, filename)))
-        os.system("fakeroot dpkg-deb --build {0} {1} 2>&1 1>/dev/null".format(directory, filename))
+
+        compression = config.compression or "xz"
+
+        if directory is None:
+            logger.debug(("Writing {0} from {1}".format(filename, self.source_root)))
+            writer = DebWriter(filename, compression, follow_symlinks=not config.preserve_symlinks, preserve_permissions=config.preserve_permissions,
+                level=config.compression_level, threads=config.compression_threads, source_date_epoch=config.source_date_epoch)
+            control_files = self.control_files
+            if config.single_read:
+                # Digests are known once the fan-out reader went through all files
+                digests = fanout.digests if fanout else None
+                control_files = control_files + [("md5sums", lambda: self.md5sums(self.index, digests), 0o644)]
+            writer.write_stream(control_files, self.source_root, self.data_files, fanout=fanout)
+            return
+
+        if config.deb_builder == "native":
+            logger.debug(("Writing {0} from {1}".format(filename, directory)))
+            writer = DebWriter(filename, compression, level=config.compression_level, threads=config.compression_threads,
+                source_date_epoch=config.source_date_epoch)
+            writer.write(os.path.join(directory, "DEBIAN"), directory)
+            return
+
+        # dpkg-deb keeps its own defaults for settings not given
+        deb_ops = []
+        if config.compression:
+            deb_ops.append("-Z{0}".format(config.compression))
+        if config.compression_level is not None:
+            deb_ops.append("-z{0}".format(config.compression_level))
+        if config.compression_threads is not None:
+            deb_ops.append("--threads-max={0}".format(resolve_threads(config.compression_threads)))
+
+        env = None
+        if config.source_date_epoch is not None:
+            # dpkg-deb clamps tar entry times and sets ar header times itself
+            env = dict(os.environ, SOURCE_DATE_EPOCH=str(config.source_date_epoch))
+
+        run_tool("dpkg-deb", ["fakeroot", "dpkg-deb"] + deb_ops + ["--build", directory, filename], env)
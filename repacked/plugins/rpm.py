@@ -1,32 +1,34 @@
 from __future__ import print_function
-from pkg_resources import resource_string
 from yapsy.IPlugin import IPlugin
-from mako.template import Template
-from mako import exceptions
+from templating import get_template
+from rpmwriter import RPMWriter
+from compression import DEFAULT_LEVELS, resolve_threads
+from treeindex import index_tree, DIRECTORY
+from digests import tree_digests
+from excludes import ExcludeRules
+from tracing import span
+from tools import run_tool
 
 import os
 import distutils.dir_util
-import shutil
 import tempfile
-import re
-import sys
 import platform
 import logging
 
-tmpl_dir = os.path.expanduser("~/.repacked/templates")
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-
-if not os.path.exists(tmpl_dir):
-    tmpl_dir = os.path.join(os.path.dirname(__file__),'../../repacked/templates')
-
 class RPMPackager(IPlugin):
     def __init__(self):
         self.spec = {}
         self.package = {}
         self.output_dir = ""
         self.tmpdir = ""
+        self.paths = []
+        self.scriptdata = {}
+        self.source_root = None
+        self.index = None
+        self.excludes = None
         self.preserve_symlinks=False
         self.preserve_permissions=True
 
@@ -70,52 +72,50 @@ class RPMPackager(IPlugin):
         self.spec = spec
         self.package = package
 
+        # Native writer can read package files directly from packagetree
+        stream = config.staging_mode == "none" and config.rpm_builder == "native"
+
         ## Create directories
 
-        # Create the temporary folder
-        self.tmpdir = tmpdir = tempfile.mkdtemp()
+        if stream:
+            self.tmpdir = tmpdir = None
+            program_files = os.path.abspath(spec['packagetree']) if spec.get('packagetree') else None
+            if program_files is None:
+                logger.warning("No BUILDIR provided this is ok if this should be used as meta package.")
+            logger.debug("RPM package files are read from {0}".format(program_files))
+        else:
+            # Create the temporary folder
+            self.tmpdir = tmpdir = tempfile.mkdtemp()
 
-        # Create the directory holding the program files
-        program_files = os.path.join(tmpdir, "BUILD")
-        os.mkdir(program_files)
+            # Create the directory holding the program files
+            program_files = os.path.join(tmpdir, "BUILD")
+            os.mkdir(program_files)
 
-        try:
-            packagetree=spec['packagetree']
-            # Copy across the contents of the file tree
-            distutils.dir_util.copy_tree(spec['packagetree'], os.path.join(tmpdir, "BUILD"), preserve_mode=config.preserve_permissions, preserve_symlinks=config.preserve_symlinks)
-        except KeyError:
-            logger.warning("No BUILDIR provided this is ok if this should be used as meta package.")
+            try:
+                packagetree=spec['packagetree']
+                # Copy across the contents of the file tree
+                if config.staging:
+                    config.staging.view(packagetree, program_files)
+                else:
+                    with span("copy") as args:
+                        args["files"] = len(distutils.dir_util.copy_tree(spec['packagetree'], os.path.join(tmpdir, "BUILD"), preserve_mode=config.preserve_permissions, preserve_symlinks=config.preserve_symlinks))
+            except KeyError:
+                logger.warning("No BUILDIR provided this is ok if this should be used as meta package.")
 
-        logger.debug("RPM package tree created in {0}".format(tmpdir))
+            logger.debug("RPM package tree created in {0}".format(tmpdir))
 
-        ## Create RPM spec file
+        self.source_root = program_files
 
-        cf = open(os.path.join(tmpdir, "rpm.spec"), "w")
+        # Directories not owned by the package
+        self.excludes = ExcludeRules(package.get('directory_exclude_list'))
 
-        cf_template = Template(filename=os.path.join(tmpl_dir, "rpmspec.tmpl"))
+        # Files are taken from the packagetree index, the staged tree has the same content
+        self.index = index_tree(spec['packagetree'], not config.preserve_symlinks) if spec.get('packagetree') else None
 
-        # Collect file exclude list
-        try:
-            dirlist_exclude = package['directory_exclude_list']
-        except:
-            # Empy file exclude list
-            dirlist_exclude = []
-
-        # Create file list
-        filelist = []
-        for root, subfolders, files in os.walk(program_files):
-            for folder in subfolders:
-                dirname = os.path.join(root, folder).replace(program_files, "").replace("%","[%]")
-                if dirname in dirlist_exclude:
-                    logger.debug("Excluding directory {0} from RPM spec dir list".format(dirname))
-                    continue
-                else:
-                    logger.debug("Adding directory {0} to RPM spec dir list".format(dirname))
-                    filelist.append('%dir "{0}"'.format(dirname))
-            for file in files:
-                filename = os.path.join(root, file).replace(program_files, "").replace("%","[%]")
-                logger.debug("Adding file {0} to RPM spec file list".format(filename))
-                filelist.append('"{0}"'.format(filename))
+        # Native writer needs all paths sorted, rpmbuild gets them streamed into the spec file
+        self.paths = []
+        if tmpdir is None or config.rpm_builder == "native":
+            self.paths = [path for path, entry in self.package_entries()]
 
         # Collect the install scripts
         try:
@@ -127,7 +127,7 @@ class RPMPackager(IPlugin):
                 # No installation scripts
                 scripts = None
 
-        scriptdata = {}
+        self.scriptdata = scriptdata = {}
 
         if scripts:
             for app in scripts.items():
@@ -145,56 +145,142 @@ class RPMPackager(IPlugin):
                 else:
                     logger.error("Installation script {0} not found.".format(script))
 
-        # Render the spec file from template
-        cf_final = cf_template.render(
-            package_name=spec['name'],
-            version=config.version,
-            release=str(config.release).replace('-','.'),
-            maintainer=spec['maintainer'],
-            summary=spec['summary'],
-            description=spec['description'],
-            dependencies=package.get('requires'),
-            obsoletes=package.get('replaces'),
-            conflicts=package.get('conflicts'),
-            provides=package.get('provides'),
-            architecture=self.checkarch(package['architecture']),
-            file_list=filelist,
-            license="N/A",
-            output_dir=os.path.abspath(config.output_dir),
-            build_dir=tmpdir,
-
-            # Install scripts
-            prein=scriptdata.get('preinst'),
-            postin=scriptdata.get('postinst'),
-            preun=scriptdata.get('prerm'),
-            postun=scriptdata.get('postrm'),
-        )
+        # Spec file is needed only by rpmbuild
+        if tmpdir is None:
+            return None
 
-        cf.write(cf_final)
-        cf.close()
+        ## Create RPM spec file
+
+        with span("render", template="rpmspec.tmpl") as args:
+            cf = open(os.path.join(tmpdir, "rpm.spec"), "w")
+
+            cf_template = get_template("rpmspec.tmpl")
+
+            # Render the spec file from template
+            cf_final = cf_template.render(
+                package_name=spec['name'],
+                version=config.version,
+                release=str(config.release).replace('-','.'),
+                maintainer=spec['maintainer'],
+                summary=spec['summary'],
+                description=spec['description'],
+                dependencies=package.get('requires'),
+                obsoletes=package.get('replaces'),
+                conflicts=package.get('conflicts'),
+                provides=package.get('provides'),
+                architecture=self.checkarch(package['architecture']),
+                license="N/A",
+                output_dir=os.path.abspath(config.output_dir),
+                build_dir=tmpdir,
+
+                # Install scripts
+                prein=scriptdata.get('preinst'),
+                postin=scriptdata.get('postinst'),
+                preun=scriptdata.get('prerm'),
+                postun=scriptdata.get('postrm'),
+            )
+
+            cf.write(cf_final)
+            # %files section is written entry by entry, the list is never held in memory
+            for path, entry in self.package_entries():
+                filename = path.replace("%","[%]")
+                if entry.type == DIRECTORY:
+                    cf.write('%dir "{0}"\n'.format(filename))
+                else:
+                    cf.write('"{0}"\n'.format(filename))
+                args["files"] = args.get("files", 0) + 1
+            cf.close()
 
         return tmpdir
 
-    def build(self, directory, filename, config):
+    def package_entries(self):
         """
-        Builds a RPM package from the directory tree
+        Yields (install path, index entry) of packaged entries,
+        directories matching directory_exclude_list are skipped
         """
 
+        for entry in self.index.entries if self.index else ():
+            path = "/" + entry.path
+            if entry.type == DIRECTORY and self.excludes and self.excludes.match(path):
+                logger.debug("Excluding directory {0} from RPM spec dir list".format(path))
+                continue
+            yield path, entry
+
+    def build(self, directory, filename, config, fanout=None):
+        """
+        Builds a RPM package from the directory tree, files of a
+        streamed package can come from single-read fan-out
+        """
+
+        if directory is None:
+            self.build_native(self.source_root, os.path.join(config.output_dir, filename), config, stream=True, fanout=fanout)
+            return
+
         directory = os.path.join(directory, "BUILD")
 
+        if config.rpm_builder == "native":
+            self.build_native(directory, os.path.join(config.output_dir, filename), config)
+            return
+
         if  os.environ.get("REPACKED_DEBUG"):
-            rpm_ops="--define 'noclean 1'"
+            rpm_ops = ["--define", "noclean 1"]
+        else:
+            rpm_ops = []
+
+        if config.compression or config.compression_level is not None or config.compression_threads is not None:
+            rpm_ops += ["--define", "_binary_payload {0}".format(self.binary_payload(config))]
+
+        env = None
+        if config.source_date_epoch is not None:
+            env = dict(os.environ, SOURCE_DATE_EPOCH=str(config.source_date_epoch))
+            rpm_ops += ["--define", "use_source_date_epoch_as_buildtime 1", "--define", "clamp_mtime_to_source_date_epoch 1",
+                "--define", "_buildhost localhost"]
+
+        run_tool("rpmbuild", ["fakeroot", "rpmbuild", "-bb", "--buildroot={0}".format(directory),
+            "--target={0}".format(self.checkarch(self.package['architecture']))] + rpm_ops +
+            [os.path.abspath(os.path.join(self.tmpdir, "rpm.spec"))], env)
+
+    def binary_payload(self, config):
+        """
+        Returns rpmbuild payload setting, e.g. w6T8.xzdio
+        """
+
+        compression = config.compression or "gzip"
+        level = DEFAULT_LEVELS[compression] if config.compression_level is None else config.compression_level
+        threads = ""
+        if compression != "gzip":
+            threads = "T{0}".format(resolve_threads(config.compression_threads))
+        return "w{0}{1}.{2}".format(level, threads, {"gzip": "gzdio", "xz": "xzdio", "zstd": "zstdio"}[compression])
+
+    def build_native(self, directory, filename, config, stream=False, fanout=None):
+        """
+        Writes RPM package directly from the file list collected by tree(),
+        files are read from packagetree itself when streaming
+        """
+
+        spec = self.spec
+        package = self.package
+
+        logger.debug("Writing {0} from {1}".format(filename, directory))
+        writer = RPMWriter(filename, spec['name'], str(config.version), str(config.release).replace('-','.'),
+            self.checkarch(package['architecture']), config.compression or "gzip", config.compression_level, config.compression_threads,
+            source_date_epoch=config.source_date_epoch)
+        writer.set_metadata(spec['summary'], spec['description'], packager=spec['maintainer'])
+        writer.add_dependencies("requires", package.get('requires'))
+        writer.add_dependencies("obsoletes", package.get('replaces'))
+        writer.add_dependencies("conflicts", package.get('conflicts'))
+        writer.add_dependencies("provides", package.get('provides'))
+
+        for script, body in self.scriptdata.items():
+            writer.add_script(script, body)
+
+        # File digests are taken from the digest cache, files are read only for the payload
+        digests = {}
+        if self.index and fanout is None:
+            digests = dict(("/" + path, d[1]) for path, d in tree_digests(self.index).items())
+
+        if stream:
+            writer.write(directory, self.paths, follow_symlinks=not config.preserve_symlinks, preserve_permissions=config.preserve_permissions,
+                digests=digests, fanout=fanout)
         else:
-            rpm_ops=""
-
-        logger.debug("fakeroot rpmbuild -bb --buildroot={buildroot} --target={architecture} {rpm_ops} {specfile}".format(
-            architecture=self.checkarch(self.package['architecture']),
-            buildroot=directory,
-            specfile=os.path.abspath(os.path.join(self.tmpdir, "rpm.spec")),
-            rpm_ops=rpm_ops))
-
-        os.system("fakeroot rpmbuild -bb --buildroot={buildroot} --target={architecture} {rpm_ops} {specfile}".format(
-            architecture=self.checkarch(self.package['architecture']),
-            buildroot=directory,
-            specfile=os.path.abspath(os.path.join(self.tmpdir, "rpm.spec")),
-            rpm_ops=rpm_ops))
+            writer.write(directory, self.paths, digests=digests)
@@ -4,11 +4,6 @@
 repacked - dead simple package creation
 """
 
-from pkg_resources import resource_string
-from yapsy.PluginManager import PluginManager
-from mako.template import Template
-from mako import exceptions
-
 __author__ = "Jonathan Prior, enhanced by Adam Hamsik, Stanislav Bocinec, Michal Linhard"
 __copyright__ = "Copyright 2011, 736 Computing Services Limited"
 __license__ = "LGPL"
@@ -17,17 +12,34 @@ __maintainer__ = "Stanislav Bocinec"
 __email__ = "stanislav.bocinec@innovatrics.com"
 
 import optparse
-import yaml
 import os
 import sys
-import tempfile
-import distutils.dir_util
 import shutil
-import dbm
-import shelve
 import logging
-import subprocess
 import re
+import time
+import multiprocessing
+import concurrent.futures
+import json
+import shlex
+import functools
+import signal
+
+from staging import StagingArea
+from buildcache import BuildCache
+from artifacts import ArtifactStore
+from compression import check_settings as check_compression
+from treeindex import index_tree, clear_indexes
+from versionstore import open_store, format_builds, digest_artifact
+from hooks import Hook, run_hooks as run_hook_graph
+from tracing import span
+from watcher import open_watcher
+from fanout import Fanout
+from specs import load_spec, SpecError
+from tools import ToolError
+import tracing
+import server
+import distributed
 
 logger = logging.getLogger()
 
@@ -41,109 +53,320 @@ class Configuration:
         self.release_hook=None
         self.build_pkg_hook=None
         self.build_pkg_hook_args=""
+        self.hooks=[]
+        self.hook_timeout=None
+        self.hook_mode=None
+        self.hook_times={}
         self.version=None
         self.release=None
         self.define_env_version=None
         self.define_env_release=None
-        self.config_version_db_path="/var/tmp/dbversion.db"
+        self.config_version_db_path="/var/tmp/repacked-versions.db"
         self.config_version_db=None
         self.pkg_format="all"
         self.profile=None
+        self.jobs=1
+        self.log_dir=None
+        self.failed_builds=[]
+        self.built_versions={}
+        self.staging=None
+        self.staging_mode=None
+        self.staging_dir=None
+        self.single_read=False
+        # Addresses of build workers, packages are built locally when empty
+        self.workers=[]
+        self.compression=None
+        self.compression_level=None
+        self.compression_threads=None
+        # Package output depends only on inputs, file times are clamped to source_date_epoch
+        self.reproducible=False
+        self.source_date_epoch=None
+        # None means not given on command line, value from spec or default is used
+        self.deb_builder=None
+        self.rpm_builder=None
+        self.build_cache=None
+        # Packages are deduplicated in content addressed store of output directory when set
+        self.artifact_store=None
+        # Indexes of packages in spec to build, all when None
+        self.package_filter=None
+
+    def __getstate__(self):
+        # Version DB handle can't be shared with build worker processes,
+        # versions are recorded by the parent process
+        state = self.__dict__.copy()
+        state['config_version_db'] = None
+        return state
 
 plugin_dir = os.path.expanduser("~/.repacked/plugins")
 
+if not os.path.exists(plugin_dir):
+    plugin_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plugins')
 if not os.path.exists(plugin_dir):
     plugin_dir = os.path.join(os.path.dirname(__file__),'../../repacked/plugins')
 
+plugin_index_path = os.path.expanduser("~/.repacked/plugin-index.json")
+
 pkg_plugins = {}
 
-pluginMgr = PluginManager(plugin_info_ext="plugin")
-pluginMgr.setPluginPlaces([plugin_dir])
-pluginMgr.locatePlugins()
-pluginMgr.loadPlugins()
+def read_plugin_index():
+    """
+    Returns cached list of plugins found in plugin directory, None if
+    the plugin directory has changed since the index was written
+    """
+
+    try:
+        with open(plugin_index_path) as f:
+            index = json.load(f)
+        if index['plugin_dir'] != os.path.abspath(plugin_dir) or index['mtime_ns'] != os.stat(plugin_dir).st_mtime_ns:
+            return None
+        for entry in index['plugins'].values():
+            if os.stat(entry['infofile']).st_mtime_ns != entry['mtime_ns']:
+                return None
+        return index['plugins']
+    except (OSError, ValueError, KeyError):
+        return None
+
+def write_plugin_index(candidates):
+    plugins = {}
+    for infofile, filepath, info in candidates:
+        plugins[info.name] = {'infofile': infofile, 'filepath': filepath, 'mtime_ns': os.stat(infofile).st_mtime_ns}
+
+    index = {'plugin_dir': os.path.abspath(plugin_dir), 'mtime_ns': os.stat(plugin_dir).st_mtime_ns, 'plugins': plugins}
+    try:
+        tmpfile = "{0}.{1}".format(plugin_index_path, os.getpid())
+        with open(tmpfile, "w") as f:
+            json.dump(index, f)
+        os.rename(tmpfile, plugin_index_path)
+    except OSError:
+        logger.debug("Can't write plugin index {0}".format(plugin_index_path))
+
+def load_plugins(names=None):
+    """
+    Imports and activates package format plugins. Only plugins listed
+    in names are imported when given, plugin directory is scanned only
+    when the cached plugin index is out of date.
+    """
+
+    from yapsy.PluginManager import PluginManager
+
+    pluginMgr = PluginManager(plugin_info_ext="plugin")
+
+    index = read_plugin_index()
+    if index is None:
+        pluginMgr.setPluginPlaces([plugin_dir])
+        logger.debug("Scanning plugin directory {0}".format(plugin_dir))
+        pluginMgr.locatePlugins()
+        write_plugin_index(pluginMgr.getPluginCandidates())
+        for candidate in pluginMgr.getPluginCandidates():
+            if names and candidate[2].name not in names:
+                pluginMgr.removePluginCandidate(candidate)
+    else:
+        # Nothing to scan, candidates come from the index
+        pluginMgr.setPluginPlaces([])
+        pluginMgr.locatePlugins()
+        locator = pluginMgr.getPluginLocator()
+        for name, entry in index.items():
+            if names and name not in names:
+                continue
+            info, details = locator.gatherCorePluginInfo(os.path.dirname(entry['infofile']), os.path.basename(entry['infofile']))
+            pluginMgr.appendPluginCandidate((entry['infofile'], entry['filepath'], info))
+
+    pluginMgr.loadPlugins()
 
-for pluginInfo in pluginMgr.getAllPlugins():
-   pluginMgr.activatePluginByName(pluginInfo.name)
+    for pluginInfo in pluginMgr.getAllPlugins():
+        pluginMgr.activatePluginByName(pluginInfo.name)
+        logger.debug("Found plugin {name}".format(name=pluginInfo.name))
+        pkg_plugins[pluginInfo.name] = pluginInfo
 
 def parse_spec(filename):
     """
     Loads the YAML file into a Python object for parsing
-    and returns it
+    and returns it, the spec is validated before it is used
     """
 
-    fp = open(filename, 'r')
-    spec = yaml.safe_load("\n".join(fp.readlines()))
+    return load_spec(filename)
 
-    return spec
+def spec_hooks(config, spec):
+    """
+    Returns hooks of packagespec. Stage hooks run one after another in
+    their usual order, extra hooks declare their own dependencies.
+    """
 
-def update_dist_hook(config, spec):
+    stages = []
     if config.update_dist_hook:
-        logger.debug ("Update Dist hook script: "+config.update_dist_hook)
-        try:
-            subprocess.check_call([config.update_dist_hook])
-        except subprocess.CalledProcessError:
-            logger.error("ERROR running " + config.update_dist_hook + " script")
-            return(1)
-
-def release_dist_hook(config, spec):
+        stages.append(("pkg-update-dist", [config.update_dist_hook]))
     if config.release_hook:
-        logger.debug ("Release Hook script: "+config.release_hook)
-        try:
-            subprocess.check_call([config.release_hook, config.version + '.' + str(config.release), config.release_hook_tag])
-        except subprocess.CalledProcessError:
-            logger.error("ERROR running " + config.release_hook + " script")
-            return(1)
-
-def build_pkg_hook(config, spec):
+        args = [str(config.version) + '.' + str(config.release)]
+        if config.release_hook_tag is not None:
+            args.append(str(config.release_hook_tag))
+        stages.append(("pkg-release-hooks", [config.release_hook] + args))
     if config.build_pkg_hook:
-        logger.debug ("Build Hook script: "+config.build_pkg_hook)
         args = config.build_pkg_hook_args if config.build_pkg_hook_args else ""
-        try:
-            subprocess.check_call([config.build_pkg_hook, args])
-        except subprocess.CalledProcessError:
-            logger.error("ERROR running " + config.build_pkg_hook + " script")
-            return(1)
+        stages.append(("pkg-build-package", [config.build_pkg_hook, args]))
 
-def run_package_build(spec, config, package, builder, tempdirs):
-    logger.debug("Running custom distribution hook")
-    if update_dist_hook(config, spec):
-        logger.error("ERROR running distribution hook. Exitting")
-        sys.exit(1)
+    hooks = []
+    for name, command in stages:
+        hooks.append(Hook(name, command, [hooks[-1].name] if hooks else [], config.hook_timeout))
 
-    logger.debug("Running custom release hook")
-    if release_dist_hook(config, spec):
-        logger.error("ERROR running release hook. Exitting")
-        sys.exit(1)
+    for item in config.hooks or []:
+        if not isinstance(item, dict) or not item.get('name') or not item.get('command'):
+            logger.error("Hooks in pkgbuild section need name and command: {0}".format(item))
+            return None
+        command = item['command']
+        if not isinstance(command, list):
+            command = shlex.split(str(command))
+        depends = item.get('depends') or []
+        if not isinstance(depends, list):
+            depends = [depends]
+        hooks.append(Hook(str(item['name']), [str(c) for c in command], [str(d) for d in depends],
+            assign_value(item.get('timeout'), config.hook_timeout)))
+
+    return hooks
+
+def run_hooks(config, spec):
+    """
+    Runs pkgbuild hooks, returns non zero value on failure
+    """
+
+    hooks = spec_hooks(config, spec)
+    if hooks is None:
+        return 1
+    if not hooks:
+        return 0
 
-    logger.debug("Running custom build hook")
-    if build_pkg_hook(config, spec):
-        logger.error("ERROR running build hook. Exitting")
+    logger.debug("Running hooks {0}".format(", ".join(hook.name for hook in hooks)))
+    failed = run_hook_graph(hooks)
+    for hook in hooks:
+        if hook.duration is not None:
+            config.hook_times[hook.name] = hook.duration
+    if failed:
+        logger.error("ERROR running hooks {0}. Exitting".format(", ".join(hook.name for hook in failed)))
+        return 1
+
+    # Hooks may have changed the packagetree
+    clear_indexes()
+    return 0
+
+def record_version(spec, config, pkg_format=None, filename=None, duration=None, digest=None):
+    """
+    Records build of filename, digest is its sha256 when it is known
+    already, otherwise the package is hashed once for the artifact
+    store and the version DB
+    """
+    env_name=spec['name'].replace("-", "_")+"_version"
+    config.built_versions[env_name]=config.version
+    artifact = os.path.abspath(os.path.join(config.output_dir, filename)) if filename else None
+    if digest is None and (config.artifact_store is not None or config.config_version_db is not None):
+        with span("digest", format=pkg_format):
+            digest = digest_artifact(artifact)
+    if config.artifact_store is not None and digest is not None:
+        with span("artifact store", format=pkg_format):
+            digest = config.artifact_store.add(filename, digest)
+    if config.config_version_db is not None:
+        config.config_version_db.record(spec['name'], config.version, config.release, config.profile,
+            pkg_format, artifact, duration, digest)
+
+def lookup_package(spec, config, package, builder):
+    """
+    Returns build cache key of package and filename of its cached
+    build fetched into output directory, None when there is none
+    """
+
+    if not config.build_cache:
+        return None, None
+
+    from templating import find_template_dir
+    with span("cache lookup", format=builder.name):
+        key = config.build_cache.key(spec, package, config, builder.name,
+            builder.plugin_object.checkarch(package['architecture']), find_template_dir())
+        filename = config.build_cache.fetch(key, config.output_dir)
+    if filename:
+        logger.info("Package {0} is up to date, reusing cached build".format(filename))
+    return key, filename
+
+def build_package(spec, config, package, builder):
+    """
+    Creates package build tree and the package, or reuses the package
+    from build cache. Returns build directory (None if nothing was built)
+    and filename of the package.
+    """
+
+    plugin = builder.plugin_object
+    key, filename = lookup_package(spec, config, package, builder)
+    if filename:
+        return None, filename
+
+    started = time.time()
+    with span("tree", format=builder.name):
+        directory = plugin.tree(spec, package, config)
+    filename = plugin.filenamegen(package, config)
+    if config.artifact_store is not None:
+        config.artifact_store.release(filename)
+    with span("build", format=builder.name, package=filename) as args:
+        plugin.build(directory, filename, config)
+        artifact = os.path.join(config.output_dir, filename)
+        args["bytes"] = os.path.getsize(artifact) if os.path.isfile(artifact) else 0
+
+    if key:
+        with span("cache store", format=builder.name):
+            config.build_cache.store(key, os.path.join(config.output_dir, filename), int(started))
+
+    return directory, filename
+
+def run_package_build(spec, config, package, builder, tempdirs):
+    if config.hook_mode == "per-package" and run_hooks(config, spec):
         sys.exit(1)
 
     logger.info("Creating package files")
-    directory = builder.plugin_object.tree(spec, package, config)
-    builder.plugin_object.build(directory, builder.plugin_object.filenamegen(package, config), config)
+    started = time.time()
+    try:
+        directory, filename = build_package(spec, config, package, builder)
+    except ToolError as e:
+        logger.error("Building {0} package failed: {1}".format(builder.name, e))
+        config.failed_builds.append(builder.name)
+        return
 
-    env_name=spec['name'].replace("-", "_")+"_version"
-    if config.config_version_db:
-        config.config_version_db[env_name]=config.version
+    record_version(spec, config, builder.name, filename, time.time() - started)
 
-    tempdirs.append(directory)
+    if directory:
+        tempdirs.append(directory)
 
-def build_packages(spec, config):
+def package_build_job(spec, config, package, builder_name, logfile):
     """
-    Loops through package specs and call the package
-    builders one by one
+    Creates one package in a build worker process, output of the
+    build is written to its own log file
+    """
+    handler = logging.FileHandler(logfile)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logger.addHandler(handler)
+
+    try:
+        builder = pkg_plugins[builder_name]
+        logger.info("Creating {0} package files".format(builder_name))
+        started = time.time()
+        directory, filename = build_package(spec, config, package, builder)
+        duration = time.time() - started
+        # Packages are hashed by the workers in parallel, not one by one afterwards
+        return directory, filename, duration, digest_artifact(os.path.join(config.output_dir, filename))
+    except:
+        logger.exception("Building {0} package failed".format(builder_name))
+        raise
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+def select_packages(spec, config):
+    """
+    Returns list of (package, builder) pairs which match requested
+    package format, profile and version
     """
 
-    packages = spec['packages']
     name = spec['name']
-    tempdirs = []
+    selected = []
 
-    # Eventually replace this with a plugin system
-    # with scripts to create build trees for different
-    # packages
-    for package in packages:
+    for index, package in enumerate(spec['packages']):
+        if config.package_filter is not None and index not in config.package_filter:
+            continue
         try:
             if config.pkg_format in [ "all", package['package'] ]:
                 builder = pkg_plugins[package['package']]
@@ -152,13 +375,267 @@ def build_packages(spec, config):
                 continue
         except KeyError:
             logger.error("Module {0} isn't installed. Ignoring this package and continuing.".format(package['package']))
-            exit
+            continue
         # We want to build a package if there is no version defined or if version matches
         pkg_profile = package.get('profile', None)
         if config.profile is None or pkg_profile is None or pkg_profile == config.profile:
             if package.get('pkg-version', None) is None or re.match(str(package.get('pkg-version','')), config.version) is not None:
                 logger.info("package version:"+format(package.get('pkg-version'))+", config version: "+str(config.version)+", release version: "+str(config.release))
-                run_package_build(spec, config, package, builder, tempdirs)
+                selected.append((package, builder))
+
+    return selected
+
+def build_packages_parallel(spec, config, selected):
+    """
+    Runs package builds in a pool of worker processes. Hooks are run
+    only once before the builds start, all workers share their result.
+    """
+
+    tempdirs = []
+
+    if config.hook_mode != "none" and run_hooks(config, spec):
+        sys.exit(1)
+
+    # Stage and index the tree before forking so all workers share them
+    if config.staging and spec.get('packagetree'):
+        config.staging.stage(spec['packagetree'])
+    if spec.get('packagetree'):
+        index = index_tree(spec['packagetree'], not config.preserve_symlinks)
+        if any(builder.name == "debian" or config.rpm_builder == "native" for package, builder in selected):
+            from digests import tree_digests
+            tree_digests(index)
+
+    log_dir = assign_value(config.log_dir, os.path.join(config.output_dir, "logs"))
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    # Plugins are inherited by forked workers, no need to load them again
+    context = multiprocessing.get_context("fork")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=config.jobs, mp_context=context) as executor:
+        jobs = {}
+        for index, (package, builder) in enumerate(selected):
+            logfile = os.path.join(log_dir, "{0}-{1}-{2}.log".format(spec['name'], builder.name, index))
+            job = executor.submit(package_build_job, spec, config, package, builder.name, logfile)
+            jobs[job] = (builder.name, logfile)
+
+        for job in concurrent.futures.as_completed(jobs):
+            builder_name, logfile = jobs[job]
+            try:
+                directory, filename, duration, digest = job.result()
+            except Exception as e:
+                logger.error("Building {0} package failed: {1}, see {2}".format(builder_name, e, logfile))
+                config.failed_builds.append(logfile)
+                continue
+
+            logger.info("Created {0}".format(filename))
+            record_version(spec, config, builder_name, filename, duration, digest)
+            if directory:
+                tempdirs.append(directory)
+
+    return tempdirs
+
+def fanout_groups(selected):
+    """
+    Splits selected packages into groups built from one read of the
+    packagetree, plugins keep state of one package, so every format
+    is at most once in a group
+    """
+
+    groups = []
+    for package, builder in selected:
+        for group in groups:
+            if builder.name not in [b.name for p, b in group]:
+                group.append((package, builder))
+                break
+        else:
+            groups.append([(package, builder)])
+    return groups
+
+def single_read_possible(spec, config, selected):
+    if not spec.get('packagetree') or len(selected) < 2:
+        return False
+    if config.staging_mode != "none" or config.deb_builder != "native" or config.rpm_builder != "native":
+        logger.info("Single-read needs staging none and native builders, building packages separately")
+        return False
+    return True
+
+def build_packages_fanout(spec, config, selected):
+    """
+    Builds packages with a single read of packagetree, every file is
+    read once and passed to archive writers of all packages of a group,
+    each writer runs in its own thread
+    """
+
+    tempdirs = []
+
+    if config.hook_mode != "none" and run_hooks(config, spec):
+        sys.exit(1)
+
+    index = index_tree(spec['packagetree'], not config.preserve_symlinks)
+
+    def write(builder, directory, filename, consumer):
+        with span("build", format=builder.name, package=filename) as args:
+            builder.plugin_object.build(directory, filename, config, fanout=consumer)
+            artifact = os.path.join(config.output_dir, filename)
+            args["bytes"] = os.path.getsize(artifact) if os.path.isfile(artifact) else 0
+
+    for group in fanout_groups(selected):
+        started = time.time()
+        fanout = Fanout(index)
+        builds = []
+        for package, builder in group:
+            key, filename = lookup_package(spec, config, package, builder)
+            if filename:
+                record_version(spec, config, builder.name, filename, time.time() - started)
+                continue
+            with span("tree", format=builder.name):
+                directory = builder.plugin_object.tree(spec, package, config)
+            filename = builder.plugin_object.filenamegen(package, config)
+            builds.append((builder, directory, filename, key, fanout.consumer(builder.name)))
+            if directory:
+                tempdirs.append(directory)
+
+        if not builds:
+            continue
+        logger.info("Creating {0} packages from one read of {1}".format(", ".join(b[0].name for b in builds), spec['packagetree']))
+        fanout.run([(consumer, functools.partial(write, builder, directory, filename, consumer))
+            for builder, directory, filename, key, consumer in builds])
+
+        for builder, directory, filename, key, consumer in builds:
+            if key:
+                with span("cache store", format=builder.name):
+                    config.build_cache.store(key, os.path.join(config.output_dir, filename), int(started))
+            record_version(spec, config, builder.name, filename, time.time() - started)
+
+    return tempdirs
+
+# Resolved settings a worker needs to build a package the same way
+WORKER_CONFIG = ["preserve_symlinks", "preserve_permissions", "version", "release", "profile", "pkg_format",
+    "staging_mode", "single_read", "compression", "compression_level", "compression_threads", "deb_builder", "rpm_builder",
+    "reproducible", "source_date_epoch"]
+
+def build_packages_distributed(spec, config, selected):
+    """
+    Sends package builds to workers, hooks are run only once by the
+    coordinator, packages come back into output directory
+    """
+
+    if config.hook_mode != "none" and run_hooks(config, spec):
+        sys.exit(1)
+
+    manifest, blobs = [], {}
+    if spec.get('packagetree'):
+        index = index_tree(spec['packagetree'], not config.preserve_symlinks)
+        manifest, blobs = distributed.tree_manifest(index)
+
+    started = time.time()
+    jobs = []
+    for package, builder in selected:
+        key, filename = lookup_package(spec, config, package, builder)
+        if filename:
+            record_version(spec, config, builder.name, filename, time.time() - started)
+            continue
+
+        scripts = {}
+        job_blobs = dict(blobs)
+        for name, path in package_scripts(spec, package).items():
+            if os.path.isfile(path):
+                sha256, blob = distributed.file_blob(path)
+                scripts[path] = sha256
+                job_blobs[sha256] = blob
+
+        name = "{0}-{1}-{2}".format(spec['name'], builder.name, spec['packages'].index(package))
+        message = {
+            "action": "build",
+            "job": {
+                "name": name,
+                "spec": spec,
+                "package": spec['packages'].index(package),
+                "config": dict((key, getattr(config, key)) for key in WORKER_CONFIG),
+            },
+            "packagetree": bool(spec.get('packagetree')),
+            "manifest": manifest,
+            "scripts": scripts,
+        }
+        job = distributed.Job(name, message, job_blobs)
+        job.builder = builder
+        job.key = key
+        jobs.append(job)
+
+    logger.info("Building {0} packages on {1} workers".format(len(jobs), len(config.workers)))
+    distributed.run_jobs(config.workers, jobs, config.output_dir)
+
+    for job in jobs:
+        if job.error:
+            logger.error("Building {0} on {1} failed: {2}".format(job.name, job.worker, job.error))
+            if job.log:
+                logger.error(job.log.rstrip())
+            config.failed_builds.append(job.name)
+            continue
+        logger.info("Created {0} on {1}, {2} files sent".format(job.filename, job.worker, job.sent))
+        if job.key:
+            with span("cache store", format=job.builder.name):
+                config.build_cache.store(job.key, os.path.join(config.output_dir, job.filename), int(started))
+        record_version(spec, config, job.builder.name, job.filename, time.time() - started, job.digest)
+
+    return []
+
+def worker_build(job, tree, scripts, output_dir):
+    """
+    Builds package of a job sent by coordinator, tree is recreated
+    packagetree and scripts map script paths of the spec to local files
+    """
+
+    spec = job['spec']
+    if tree:
+        spec['packagetree'] = tree
+    else:
+        spec.pop('packagetree', None)
+    for item in [spec] + spec['packages']:
+        if item.get('scripts'):
+            item['scripts'] = dict((name, scripts.get(path, path)) for name, path in item['scripts'].items())
+
+    config = Configuration()
+    for key, value in job['config'].items():
+        setattr(config, key, value)
+    config.output_dir = output_dir
+    config.hook_mode = "none"
+
+    package = spec['packages'][job['package']]
+    builder = pkg_plugins.get(package['package'])
+    if builder is None:
+        raise distributed.DistributedError("Module {0} isn't installed on worker".format(package['package']))
+
+    clear_indexes()
+    directory, filename = build_package(spec, config, package, builder)
+    if directory:
+        clean_up([directory])
+    return filename
+
+def build_packages(spec, config):
+    """
+    Loops through package specs and call the package
+    builders one by one, or in parallel when more jobs are allowed
+    """
+
+    tempdirs = []
+    selected = select_packages(spec, config)
+
+    if config.workers and selected:
+        return build_packages_distributed(spec, config, selected)
+
+    if config.single_read and single_read_possible(spec, config, selected):
+        return build_packages_fanout(spec, config, selected)
+
+    if config.jobs > 1 and len(selected) > 1:
+        return build_packages_parallel(spec, config, selected)
+
+    # Hooks prepare the packagetree shared by all package formats
+    if selected and config.hook_mode == "once" and run_hooks(config, spec):
+        sys.exit(1)
+
+    for package, builder in selected:
+        run_package_build(spec, config, package, builder, tempdirs)
 
     return tempdirs
 
@@ -166,8 +643,9 @@ def clean_up(dirs):
     """
     Delete the temporary build trees to save space
     """
-    for fldr in dirs:
-        shutil.rmtree(fldr, ignore_errors=True)
+    with span("cleanup", files=len(dirs)):
+        for fldr in dirs:
+            shutil.rmtree(fldr, ignore_errors=True)
 
 def assign_value(first, default=None):
     if first:
@@ -226,6 +704,61 @@ def extract_config(spec, config, outputdir, symlinks, permission, pkgformat, pro
     #if config.define_env_release is not None:
     #    logger.info("define_env_release is set, package version release = "+format(config.release))
     
+    pkgbuild = assign_value(spec.get('pkgbuild'), {})
+    config.deb_builder = assign_value(config.deb_builder, pkgbuild.get('deb-builder', 'native'))
+    if config.deb_builder not in ['native', 'dpkg-deb']:
+        logger.error("deb-builder not supported. Supported values: native/dpkg-deb")
+        sys.exit(1)
+    if pkgbuild.get('build-cache') and not config.build_cache:
+        config.build_cache = BuildCache(os.path.expanduser("~/.repacked/cache"))
+    if pkgbuild.get('artifact-store') and not config.artifact_store:
+        config.artifact_store = ArtifactStore(config.output_dir)
+    config.rpm_builder = assign_value(config.rpm_builder, pkgbuild.get('rpm-builder', 'rpmbuild'))
+    if config.rpm_builder not in ['native', 'rpmbuild']:
+        logger.error("rpm-builder not supported. Supported values: native/rpmbuild")
+        sys.exit(1)
+    config.staging_mode = assign_value(config.staging_mode, pkgbuild.get('staging', 'shared'))
+    if config.staging_mode not in ['shared', 'persistent', 'copy', 'none']:
+        logger.error("staging not supported. Supported values: shared/persistent/copy/none")
+        sys.exit(1)
+    config.staging_dir = assign_value(config.staging_dir, pkgbuild.get('staging-dir', '~/.repacked/staging'))
+    config.single_read = assign_value(config.single_read, pkgbuild.get('single-read', False))
+    config.hooks = assign_value(pkgbuild.get('hooks'), [])
+    config.hook_timeout = assign_value(config.hook_timeout, pkgbuild.get('hook-timeout'))
+    config.hook_mode = assign_value(config.hook_mode, pkgbuild.get('run-hooks', 'once'))
+    if config.hook_mode not in ['once', 'per-package', 'none']:
+        logger.error("run-hooks not supported. Supported values: once/per-package/none")
+        sys.exit(1)
+    config.compression = assign_value(config.compression, pkgbuild.get('compression'))
+    config.compression_level = assign_value(config.compression_level, pkgbuild.get('compression-level'))
+    config.compression_threads = assign_value(config.compression_threads, pkgbuild.get('compression-threads'))
+    error = check_compression(config.compression, config.compression_level)
+    if error is not None:
+        logger.error(error)
+        sys.exit(1)
+    if config.compression_level is not None:
+        config.compression_level = int(config.compression_level)
+    if config.compression_threads is not None:
+        try:
+            config.compression_threads = int(config.compression_threads)
+        except ValueError:
+            config.compression_threads = -1
+        if config.compression_threads < 0:
+            logger.error("compression-threads has to be a number, 0 uses all cores")
+            sys.exit(1)
+
+    config.reproducible = assign_value(config.reproducible, pkgbuild.get('reproducible', False))
+    if config.reproducible:
+        try:
+            config.source_date_epoch = int(assign_value(os.environ.get('SOURCE_DATE_EPOCH'), pkgbuild.get('source-date-epoch', 0)))
+        except ValueError:
+            config.source_date_epoch = -1
+        if config.source_date_epoch < 0:
+            logger.error("SOURCE_DATE_EPOCH has to be a number of seconds since 1970-01-01")
+            sys.exit(1)
+    else:
+        config.source_date_epoch = None
+
     if pkgformat not in ['debian', 'rpm', 'all']:
         logger.error("pkg-format not supported. Supported values: debian/rpm/all")
         sys.exit(1)
@@ -240,12 +773,10 @@ def initialize_project(project_name):
     if not os.path.exists(project_abs_path):
         os.mkdir(project_abs_path)
 
-    tmpl_dir = os.path.expanduser("~/.repacked/templates")
-    if not os.path.exists(tmpl_dir):
-        tmpl_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../repacked/templates')
+    from templating import get_template
 
     project_spec_file = open(os.path.join(project_abs_path, "packagespec"), "w")
-    project_spec_tmpl = Template(filename=os.path.join(tmpl_dir, "packagespec.tmpl"))
+    project_spec_tmpl = get_template("packagespec.tmpl")
     project_spec_content = project_spec_tmpl.render(
         project_name=project_name
     )
@@ -253,16 +784,418 @@ def initialize_project(project_name):
     project_spec_file.write(project_spec_content)
     project_spec_file.close()
 
-def main():
+def build_spec(specfile, options, version_db=None, watch=None):
     """
-    Set up the application
+    Builds packages of one packagespec file, returns list of failed
+    package builds and versions recorded by successful ones. In watch
+    mode only packages selected by watch state are built and the staged
+    tree is kept for the next build.
     """
-    if os.environ.get("REPACKED_DEBUG"):
-        logger.setLevel(logging.DEBUG)
+
+    # Parse the specification
+    with span("parse spec", spec=specfile) as args:
+        try:
+            spec = parse_spec(specfile)
+        except SpecError as e:
+            logger.error(e)
+            sys.exit(1)
+        args["bytes"] = os.path.getsize(specfile)
+
+    config=Configuration()
+    config.jobs = options.jobs
+    config.log_dir = options.log_dir
+    config.deb_builder = options.deb_builder
+    config.rpm_builder = options.rpm_builder
+    config.staging_mode = options.staging_mode
+    config.staging_dir = options.staging_dir
+    config.single_read = options.single_read
+    config.workers = [address.strip() for address in (options.workers or "").split(",") if address.strip()]
+    config.compression = options.compression
+    config.hook_timeout = options.hook_timeout
+    config.hook_mode = options.hook_mode
+    config.compression_level = options.compression_level
+    config.compression_threads = options.compression_threads
+    config.reproducible = options.reproducible
+    if options.cache:
+        config.build_cache = BuildCache(os.path.expanduser(options.cache_dir))
+    if options.artifact_store:
+        config.artifact_store = ArtifactStore(options.outputdir)
+    extract_config(spec, config, options.outputdir, options.preserve, options.permission, options.pkg_format, options.profile)
+    if config.staging_mode in ["shared", "persistent"]:
+        persistent_dir = config.staging_dir if config.staging_mode == "persistent" else None
+        if watch is None:
+            config.staging = StagingArea(config.preserve_symlinks, config.preserve_permissions, persistent_dir, spec['name'])
+        else:
+            if watch.staging is None:
+                watch.staging = StagingArea(config.preserve_symlinks, config.preserve_permissions, persistent_dir, spec['name'])
+            config.staging = watch.staging
+    if watch is not None:
+        config.package_filter = watch.packages
+
+    config.config_version_db = version_db
+
+    # Create build trees based on the spec
+    logger.info("Building packages...")
+    try:
+        tempdirs = build_packages(spec, config)
+    finally:
+        # Staged tree of watch mode is kept and updated by the next build
+        if config.staging and watch is None:
+            if options.no_clean:
+                logger.info("Not removing staging directories {dirs}".format(dirs=config.staging.directories()))
+            else:
+                clean_up(config.staging.directories())
+            config.staging.close()
+
+    # Clean up old build trees
+    if not options.no_clean:
+        logger.info("Cleaning up...")
+        if not os.environ.get("REPACKED_DEBUG"):
+            clean_up(tempdirs)
+        else:
+            logger.info("Not removing temp directories {dirs} debug enabled".format(dirs=tempdirs))
+
+    return config.failed_builds, config.built_versions
+
+def build_spec_job(specfile, options, version_db=None):
+    """
+    Builds packagespec in its own directory, paths in packagespec
+    are relative to it
+    """
+
+    os.chdir(os.path.dirname(os.path.abspath(specfile)))
+    return build_spec(os.path.basename(specfile), options, version_db)
+
+def find_specs(spec_dir):
+    """
+    Returns all packagespec files found in spec_dir and its subdirectories
+    """
+
+    specfiles = []
+    for root, dirs, files in os.walk(spec_dir):
+        dirs.sort()
+        if "packagespec" in files:
+            specfiles.append(os.path.join(root, "packagespec"))
+    return specfiles
+
+def build_batch(specfiles, options, version_db=None):
+    """
+    Builds many packagespec files in one process, sharing loaded plugins
+    and version DB. Returns list of packagespecs which failed.
+    """
+
+    failed = []
+
+    # Specs are built from their own directories
+    for option in ['outputdir', 'log_dir']:
+        if getattr(options, option):
+            setattr(options, option, os.path.abspath(getattr(options, option)))
+
+    if options.batch_jobs > 1:
+        context = multiprocessing.get_context("fork")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=options.batch_jobs, mp_context=context) as executor:
+            # Workers open their own connection to the version DB
+            jobs = dict((executor.submit(build_spec_job, specfile, options, version_db), specfile) for specfile in specfiles)
+            for job in concurrent.futures.as_completed(jobs):
+                specfile = jobs[job]
+                try:
+                    failed_builds, versions = job.result()
+                except BaseException as e:
+                    logger.error("Building {0} failed: {1}".format(specfile, e))
+                    failed.append(specfile)
+                    continue
+                if failed_builds:
+                    failed.append(specfile)
+        return failed
+
+    cwd = os.getcwd()
+    for specfile in specfiles:
+        logger.info("Building {0}".format(specfile))
+        try:
+            os.chdir(os.path.dirname(os.path.abspath(specfile)))
+            failed_builds, versions = build_spec(os.path.basename(specfile), options, version_db)
+            if failed_builds:
+                failed.append(specfile)
+        except (Exception, SystemExit) as e:
+            logger.error("Building {0} failed: {1}".format(specfile, e))
+            failed.append(specfile)
+        finally:
+            os.chdir(cwd)
+
+    return failed
+
+class WatchState:
+    def __init__(self):
+        # Staged packagetree kept between builds
+        self.staging=None
+        # Indexes of packages to build, all when None
+        self.packages=None
+
+def package_scripts(spec, package):
+    """
+    Returns install scripts of package, its own or those of the spec
+    """
+    if 'scripts' in package:
+        return package['scripts'] or {}
+    return spec.get('scripts') or {}
+
+def watch_inputs(spec, specfile, watcher):
+    """
+    Adds packagespec, its packagetree and install scripts to watcher
+    """
+
+    watcher.watch_file(specfile)
+    if spec.get('packagetree') and os.path.isdir(spec['packagetree']):
+        watcher.watch_tree(spec['packagetree'])
+    for package in spec['packages']:
+        for filename in package_scripts(spec, package).values():
+            watcher.watch_file(filename)
+    watcher.start()
+
+def affected_packages(spec, changed):
+    """
+    Returns indexes of packages which use changed install scripts,
+    None when changes affect all packages
+    """
+
+    packagetree = os.path.abspath(spec['packagetree']) if spec.get('packagetree') else None
+    if packagetree and any(path == packagetree or path.startswith(packagetree + os.sep) for path in changed):
+        return None
+
+    affected = set()
+    for index, package in enumerate(spec['packages']):
+        if any(os.path.abspath(filename) in changed for filename in package_scripts(spec, package).values()):
+            affected.add(index)
+    return affected
+
+def watch_spec(specfile, options, version_db=None):
+    """
+    Builds packagespec, then watches its packagetree, install scripts
+    and the packagespec itself and rebuilds packages affected by every
+    change until interrupted. Changed entries are updated in the staged
+    tree, pkgbuild hooks are run only by the first build.
+    """
+
+    specfile = os.path.abspath(specfile)
+    watch = WatchState()
+    # Staged tree is removed also when terminated
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    watcher = None
+    spec = None
+    changed = None
+
+    try:
+        while True:
+            if changed is None or specfile in changed:
+                # Everything is built again, inputs may have changed
+                if watcher is not None:
+                    watcher.close()
+                if watch.staging is not None:
+                    clean_up(watch.staging.directories())
+                    watch.staging.close()
+                    watch.staging = None
+                watch.packages = None
+                watcher = open_watcher()
+                try:
+                    spec = parse_spec(specfile)
+                    watch_inputs(spec, specfile, watcher)
+                except Exception as e:
+                    logger.error("Can't read {0}, waiting for changes: {1}".format(specfile, e))
+                    watcher.watch_file(specfile)
+                    watcher.start()
+                    spec = None
+            else:
+                watch.packages = affected_packages(spec, changed)
+                if watch.staging is not None and spec.get('packagetree'):
+                    watch.staging.update(spec['packagetree'], changed)
+
+            if spec is not None and watch.packages != set():
+                # Trees are indexed again, only unchanged files are taken from the digest cache
+                clear_indexes()
+                started = time.time()
+                try:
+                    failed_builds, versions = build_spec(specfile, options, version_db, watch)
+                except (Exception, SystemExit) as e:
+                    logger.error("Building {0} failed: {1}".format(specfile, e))
+                    failed_builds = [specfile]
+                print("{0} in {1:.1f}s, waiting for changes".format(
+                    "Build failed" if failed_builds else "Built", time.time() - started), flush=True)
+                options.hook_mode = "none"
+
+            changed = watcher.wait()
+            if changed is not None:
+                logger.info("Changed: {0}".format(", ".join(sorted(changed))))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if watcher is not None:
+            watcher.close()
+        if watch.staging is not None:
+            if not options.no_clean:
+                clean_up(watch.staging.directories())
+            watch.staging.close()
+
+# Version DB of build server, workers keep their connection between jobs
+server_version_db = None
+
+def serve_job(args, cwd, logfile):
+    """
+    Builds packagespecs of a build server job in a worker process,
+    returns list of failed packagespecs and recorded versions
+    """
+
+    failed = []
+    versions = {}
+
+    # Everything the job prints, also by build tools, goes to its log
+    log = open(logfile, "w")
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    try:
+        os.chdir(cwd)
+        # Trees may have changed since the previous job of this worker
+        clear_indexes()
+        options, specfiles = option_parser().parse_args(args)
+        if options.spec_dir:
+            specfiles.extend(find_specs(options.spec_dir))
+        for option in ['outputdir', 'log_dir']:
+            if getattr(options, option):
+                setattr(options, option, os.path.abspath(getattr(options, option)))
+
+        if options.trace:
+            tracing.start(os.path.abspath(options.trace))
+        try:
+            for specfile in specfiles:
+                logger.info("Building {0}".format(specfile))
+                try:
+                    failed_builds, built = build_spec_job(specfile, options, server_version_db)
+                    versions.update(built)
+                    if failed_builds:
+                        failed.append(specfile)
+                except (Exception, SystemExit) as e:
+                    logger.error("Building {0} failed: {1}".format(specfile, e))
+                    failed.append(specfile)
+        finally:
+            tracing.finish()
+    except SystemExit:
+        # Invalid options
+        failed.append(" ".join(args))
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(saved[0])
+        os.close(saved[1])
+        log.close()
+
+    return failed, versions
+
+def server_job(socket_path, specfiles, options):
+    """
+    Sends build to build server, prints its log and returns list of
+    failed packagespecs when waiting for it
+    """
+
+    # Options of the build are sent as they were given, without client options
+    args = []
+    skip = False
+    for arg in sys.argv[1:]:
+        if skip:
+            skip = False
+        elif arg == "--server":
+            skip = True
+        elif not (arg.startswith("--server=") or arg in ("--no-wait", "--status")):
+            args.append(arg)
+
+    job = server.request(socket_path, {"action": "build", "args": args, "cwd": os.getcwd()})
+    if "id" not in job:
+        logger.error(job["error"])
+        return specfiles
+    if options.no_wait:
+        print(job["id"])
+        return []
+
+    job = server.request(socket_path, {"action": "wait", "id": job["id"]})
+    try:
+        with open(job["log"]) as f:
+            sys.stdout.write(f.read())
+    except OSError:
+        pass
+    if job.get("error"):
+        logger.error("Job {0} failed: {1}".format(job["id"], job["error"]))
+    return job["failed"] if job["state"] != server.DONE else []
+
+def print_jobs(socket_path, ids):
+    """
+    Prints state of build server jobs
+    """
+
+    if ids:
+        jobs = [server.request(socket_path, {"action": "status", "id": int(id)}) for id in ids]
     else:
-        logger.setLevel(logging.INFO)
+        jobs = server.request(socket_path, {"action": "status"})["jobs"]
+
+    lines = [["id", "state", "submitted", "duration", "log", "build"]]
+    for job in jobs:
+        if "id" not in job:
+            logger.error(job["error"])
+            continue
+        lines.append([str(job["id"]), job["state"],
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(job["submitted"])),
+            "" if job["finished"] is None else "{0:.1f}s".format(job["finished"] - job["submitted"]),
+            job["log"], " ".join(job["args"])])
+    widths = [max(len(line[i]) for line in lines) for i in range(len(lines[0]))]
+    print("\n".join("  ".join(value.ljust(width) for value, width in zip(line, widths)).rstrip() for line in lines))
+
+def list_versions(path, names):
+    """
+    Prints builds recorded in version DB
+    """
+
+    version_db = open_store(path)
+    if version_db is None:
+        sys.exit(1)
+
+    if names:
+        rows = []
+        for name in names:
+            rows.extend(version_db.history(name))
+    else:
+        rows = version_db.latest()
+    print(format_builds(rows))
+    version_db.close()
+
+def collect_artifacts(output_dir, version_db_path, keep):
+    """
+    Removes packages of artifact store in output_dir which are not among
+    the last keep builds of any package recorded in version DB
+    """
 
-    parser = optparse.OptionParser(description="Creates DEB and RPM packages from files defined in a package specification.", prog="repacked.py", version=__version__, usage="%prog specfile [options]")
+    version_db = open_store(version_db_path)
+    if version_db is None:
+        sys.exit(1)
+    if keep < 1:
+        logger.error("--keep-builds has to be at least 1")
+        sys.exit(1)
+
+    try:
+        digests = version_db.recent_digests(keep)
+    finally:
+        version_db.close()
+    removed, size = ArtifactStore(output_dir).collect(digests)
+    print("Removed {0} packages, {1:.1f} MB freed".format(removed, size / 1e6))
+
+def option_parser():
+    """
+    Returns parser of command line options, also used for options of
+    build server jobs
+    """
+
+    parser = optparse.OptionParser(description="Creates DEB and RPM packages from files defined in a package specification.", prog="repacked.py", version=__version__, usage="%prog specfile [specfile ...] [options]")
     parser.add_option('--outputdir', '-o', default='.', help="packages will be placed in the specified directory")
     parser.add_option('--no-clean', '-C', action="store_true", help="Don't remove temporary files used to build packages")
     parser.add_option('--pkg-format', '-f', default="all", help="Specify package format (all/debian/rpm), default setting is to create all")
@@ -270,7 +1203,52 @@ def main():
     parser.add_option('--init', '-i', dest='project_name', default=False, help="Initialize empty project in new directory")
     parser.add_option('--preserve', '-p', default=False, action="store_true", help="Preserve Symlinks, default setting is to follow them.")
     parser.add_option('--permission', '-P', default=True, action="store_false", help="Disable preservation of  File Permissions, default setting is to preserve them.")
+    parser.add_option('--jobs', '-j', type="int", default=1, help="Number of packages built in parallel, default setting is to build one at a time")
+    parser.add_option('--staging', dest='staging_mode', default=None, help="How packagetree is staged (shared/persistent/copy/none), shared copy by default, persistent keeps it between runs and copies only changed files, none reads files directly from packagetree when native builders are used")
+    parser.add_option('--staging-dir', default=None, help="Directory of persistent stages, default is ~/.repacked/staging")
+    parser.add_option('--single-read', default=False, action="store_true", help="Read packagetree once for all packages, their archives are written in parallel, needs --staging none and native builders")
+    parser.add_option('--no-shared-staging', dest='staging_mode', action="store_const", const="copy", help="Copy packagetree separately for every package, same as --staging copy")
+    parser.add_option('--deb-builder', default=None, help="Tool used to create deb packages (native/dpkg-deb), default setting is the built-in native writer")
+    parser.add_option('--rpm-builder', default=None, help="Tool used to create rpm packages (native/rpmbuild), default setting is rpmbuild")
+    parser.add_option('--compression', '-Z', default=None, help="Payload compression of packages (gzip/xz/zstd), default is xz for deb and gzip for rpm packages")
+    parser.add_option('--compression-level', '-z', type="int", default=None, help="Compression level, low levels are fast, high levels give the smallest packages")
+    parser.add_option('--compression-threads', type="int", default=None, help="Number of threads compressing a package, default setting is to use all cores")
+    parser.add_option('--reproducible', default=False, action="store_true", help="Make packages byte for byte reproducible, file times are clamped to SOURCE_DATE_EPOCH (0 when not set) and build time and host are fixed")
+    parser.add_option('--hook-timeout', type="float", default=None, help="Seconds after which a running pkgbuild hook is killed, no timeout by default")
+    parser.add_option('--run-hooks', dest='hook_mode', default=None, help="Run pkgbuild hooks once per packagespec, before every package or never (once/per-package/none), once by default")
+    parser.add_option('--cache', default=False, action="store_true", help="Reuse previously built packages when nothing they are made of has changed")
+    parser.add_option('--artifact-store', default=False, action="store_true", help="Store packages once by content in OUTPUTDIR/.artifacts and link them under their names, identical packages take no extra space")
+    parser.add_option('--gc-artifacts', default=False, action="store_true", help="Remove packages of artifact store in OUTPUTDIR not among the last --keep-builds builds recorded in version DB, and exit")
+    parser.add_option('--keep-builds', type="int", default=3, help="Number of last builds of every package, format and profile kept by --gc-artifacts, default is 3")
+    parser.add_option('--cache-dir', default="~/.repacked/cache", help="Directory of the build cache, default is ~/.repacked/cache")
+    parser.add_option('--spec-dir', default=None, help="Build all packagespec files found in the directory and its subdirectories")
+    parser.add_option('--batch-jobs', type="int", default=1, help="Number of packagespec files built in parallel in batch mode, default setting is to build one at a time")
+    parser.add_option('--version-db', default=Configuration().config_version_db_path, help="Database recording built package versions, default is /var/tmp/repacked-versions.db")
+    parser.add_option('--versions', default=False, action="store_true", help="List last built version of every package, or history of packages given as arguments, and exit")
+    parser.add_option('--trace', default=None, help="Write timings of build stages to file in Chrome trace format and print their summary")
+    parser.add_option('--log-dir', default=None, help="Directory for per package build logs when building in parallel, default is OUTPUTDIR/logs, job logs of build server are in /var/tmp/repacked-jobs by default")
+    parser.add_option('--watch', default=False, action="store_true", help="Rebuild packages affected by changes of packagetree, install scripts or packagespec until interrupted")
+    parser.add_option('--serve', default=None, metavar="SOCKET", help="Run build server listening on Unix socket, --batch-jobs jobs are built at once")
+    parser.add_option('--server', default=None, metavar="SOCKET", help="Send the build to build server listening on Unix socket and wait for its result")
+    parser.add_option('--no-wait', default=False, action="store_true", help="Don't wait for the build sent to build server, print its job id")
+    parser.add_option('--status', default=False, action="store_true", help="Print state of build server jobs, all or ids given as arguments, and exit")
+    parser.add_option('--workers', default=None, metavar="ADDRESSES", help="Build packages on build workers, comma separated host:port or Unix socket addresses")
+    parser.add_option('--worker', default=None, metavar="ADDRESS", help="Run build worker listening on host:port or Unix socket, building jobs sent with --workers")
+    parser.add_option('--worker-store', default="~/.repacked/worker-store", help="Content addressed file store of build worker, default is ~/.repacked/worker-store")
+    return parser
+
+def main():
+    """
+    Set up the application
+    """
+    global server_version_db
+
+    if os.environ.get("REPACKED_DEBUG"):
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
 
+    parser = option_parser()
     options, arguments = parser.parse_args()
 
     # Initialize new empty project
@@ -279,43 +1257,86 @@ def main():
         initialize_project(options.project_name)
         sys.exit(0)
 
-    # Parse the specification
-    try:
-        spec = parse_spec(arguments[0])
-    except IndexError:
+    if options.versions:
+        list_versions(options.version_db, arguments)
+        sys.exit(0)
+
+    if options.gc_artifacts:
+        collect_artifacts(options.outputdir, options.version_db, options.keep_builds)
+        sys.exit(0)
+
+    if options.status:
+        print_jobs(options.server or options.serve, arguments)
+        sys.exit(0)
+
+    if options.worker:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        logger.addHandler(handler)
+        load_plugins()
+        # mako is imported only by processes building packages
+        from templating import compile_all as compile_templates
+        compile_templates()
+        distributed.serve_worker(options.worker, worker_build, os.path.expanduser(options.worker_store))
+        sys.exit(0)
+
+    if options.serve:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        logger.addHandler(handler)
+        # Everything shared by jobs is loaded before workers are forked
+        load_plugins()
+        from templating import compile_all as compile_templates
+        compile_templates()
+        server_version_db = open_store(options.version_db)
+        server.serve(options.serve, serve_job, options.batch_jobs, options.log_dir or "/var/tmp/repacked-jobs")
+        sys.exit(0)
+
+    specfiles = list(arguments)
+    if options.spec_dir:
+        specfiles.extend(find_specs(options.spec_dir))
+
+    if not specfiles:
         parser.print_usage()
         logger.error("Run with --help option for more information.")
         sys.exit(1)
-    
-    config=Configuration()
-    extract_config(spec, config, options.outputdir, options.preserve, options.permission, options.pkg_format, options.profile)
 
-    try:
-        config.config_version_db = shelve.open(config.config_version_db_path)
-    except dbm.error:
-        config.config_version_db = None
+    if options.server:
+        failed_builds = server_job(options.server, specfiles, options)
+        sys.exit(1 if failed_builds else 0)
 
-    # Import the plugins
-    logger.debug("Enumerating plugins...")
+    if options.trace:
+        tracing.start(os.path.abspath(options.trace))
 
-    for plugin in pluginMgr.getAllPlugins():
-        logger.debug("Found plugin {name}".format(name=plugin.name))
-        pkg_plugins[plugin.name] = plugin
+    version_db = open_store(options.version_db)
 
-    # Create build trees based on the spec
-    logger.info("Building packages...")
-    tempdirs = build_packages(spec, config)
+    try:
+        # Import the plugins
+        logger.debug("Enumerating plugins...")
+        with span("load plugins"):
+            load_plugins(None if options.pkg_format == "all" else [options.pkg_format])
 
-    # Clean up old build trees
-    if not options.no_clean:
-        logger.info("Cleaning up...")
-        if not os.environ.get("REPACKED_DEBUG"):
-            clean_up(tempdirs)
+        if options.watch:
+            if len(specfiles) != 1:
+                logger.error("Only one packagespec can be watched")
+                sys.exit(1)
+            watch_spec(specfiles[0], options, version_db)
+            failed_builds = []
+        elif len(specfiles) == 1 and not options.spec_dir:
+            failed_builds, versions = build_spec(specfiles[0], options, version_db)
+            if failed_builds:
+                logger.error("{0} package build(s) failed".format(len(failed_builds)))
         else:
-            logger.info("Not removing temp directories {dirs} debug enabled".format(dirs=tempdirs))
+            failed_builds = build_batch(specfiles, options, version_db)
+            if failed_builds:
+                logger.error("Building of {0} packagespec(s) failed: {1}".format(len(failed_builds), ", ".join(failed_builds)))
+    finally:
+        if version_db is not None:
+            version_db.close()
+        tracing.finish()
 
-    if config.config_version_db:
-        config.config_version_db.close()
+    if failed_builds:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,520 @@
+"""
+Native writer of RPM packages
+
+Package consists of lead, signature header, main header and compressed
+cpio payload. Payload is generated directly from the file list of the
+build tree, rpmbuild and its spec file processing is not needed.
+"""
+
+import os
+import re
+import stat
+import struct
+import hashlib
+import socket
+import time
+import tempfile
+import logging
+
+from compression import DEFAULT_LEVELS, open_compressor
+
+logger = logging.getLogger()
+
+LEAD_MAGIC = b"\xed\xab\xee\xdb"
+HEADER_MAGIC = b"\x8e\xad\xe8\x01\x00\x00\x00\x00"
+
+# Tag data types
+RPM_INT16_TYPE = 3
+RPM_INT32_TYPE = 4
+RPM_INT64_TYPE = 5
+RPM_STRING_TYPE = 6
+RPM_BIN_TYPE = 7
+RPM_STRING_ARRAY_TYPE = 8
+RPM_I18NSTRING_TYPE = 9
+
+TYPE_ALIGN = {RPM_INT16_TYPE: 2, RPM_INT32_TYPE: 4, RPM_INT64_TYPE: 8}
+TYPE_FORMAT = {RPM_INT16_TYPE: "H", RPM_INT32_TYPE: "I", RPM_INT64_TYPE: "Q"}
+
+# Region tags
+RPMTAG_HEADERSIGNATURES = 62
+RPMTAG_HEADERIMMUTABLE = 63
+RPMTAG_HEADERI18NTABLE = 100
+
+# Signature tags
+RPMSIGTAG_SHA1 = 269
+RPMSIGTAG_LONGSIZE = 270
+RPMSIGTAG_LONGARCHIVESIZE = 271
+RPMSIGTAG_SHA256 = 273
+RPMSIGTAG_SIZE = 1000
+RPMSIGTAG_MD5 = 1004
+RPMSIGTAG_PAYLOADSIZE = 1007
+
+# Header tags
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_SUMMARY = 1004
+RPMTAG_DESCRIPTION = 1005
+RPMTAG_BUILDTIME = 1006
+RPMTAG_BUILDHOST = 1007
+RPMTAG_SIZE = 1009
+RPMTAG_LICENSE = 1014
+RPMTAG_PACKAGER = 1015
+RPMTAG_GROUP = 1016
+RPMTAG_OS = 1021
+RPMTAG_ARCH = 1022
+RPMTAG_PREIN = 1023
+RPMTAG_POSTIN = 1024
+RPMTAG_PREUN = 1025
+RPMTAG_POSTUN = 1026
+RPMTAG_FILESIZES = 1028
+RPMTAG_FILEMODES = 1030
+RPMTAG_FILERDEVS = 1033
+RPMTAG_FILEMTIMES = 1034
+RPMTAG_FILEDIGESTS = 1035
+RPMTAG_FILELINKTOS = 1036
+RPMTAG_FILEFLAGS = 1037
+RPMTAG_FILEUSERNAME = 1039
+RPMTAG_FILEGROUPNAME = 1040
+RPMTAG_SOURCERPM = 1044
+RPMTAG_FILEVERIFYFLAGS = 1045
+RPMTAG_PROVIDENAME = 1047
+RPMTAG_REQUIREFLAGS = 1048
+RPMTAG_REQUIRENAME = 1049
+RPMTAG_REQUIREVERSION = 1050
+RPMTAG_CONFLICTFLAGS = 1053
+RPMTAG_CONFLICTNAME = 1054
+RPMTAG_CONFLICTVERSION = 1055
+RPMTAG_RPMVERSION = 1064
+RPMTAG_PREINPROG = 1085
+RPMTAG_POSTINPROG = 1086
+RPMTAG_PREUNPROG = 1087
+RPMTAG_POSTUNPROG = 1088
+RPMTAG_OBSOLETENAME = 1090
+RPMTAG_FILEDEVICES = 1095
+RPMTAG_FILEINODES = 1096
+RPMTAG_FILELANGS = 1097
+RPMTAG_PROVIDEFLAGS = 1112
+RPMTAG_PROVIDEVERSION = 1113
+RPMTAG_OBSOLETEFLAGS = 1114
+RPMTAG_OBSOLETEVERSION = 1115
+RPMTAG_DIRINDEXES = 1116
+RPMTAG_BASENAMES = 1117
+RPMTAG_DIRNAMES = 1118
+RPMTAG_PAYLOADFORMAT = 1124
+RPMTAG_PAYLOADCOMPRESSOR = 1125
+RPMTAG_PAYLOADFLAGS = 1126
+RPMTAG_LONGSIZE = 5009
+RPMTAG_FILEDIGESTALGO = 5011
+RPMTAG_PAYLOADDIGEST = 5092
+RPMTAG_PAYLOADDIGESTALGO = 5093
+
+PGPHASHALGO_SHA256 = 8
+
+# Dependency flags
+RPMSENSE_LESS = 0x02
+RPMSENSE_GREATER = 0x04
+RPMSENSE_EQUAL = 0x08
+RPMSENSE_INTERP = 0x100
+RPMSENSE_RPMLIB = 0x1000000
+
+SENSE_OPERATORS = {
+    "<": RPMSENSE_LESS,
+    "<<": RPMSENSE_LESS,
+    "<=": RPMSENSE_LESS | RPMSENSE_EQUAL,
+    "=": RPMSENSE_EQUAL,
+    "==": RPMSENSE_EQUAL,
+    ">=": RPMSENSE_GREATER | RPMSENSE_EQUAL,
+    ">": RPMSENSE_GREATER,
+    ">>": RPMSENSE_GREATER,
+}
+
+# Script tags and their dependency flags, keyed by debian script names
+SCRIPTS = {
+    "preinst": (RPMTAG_PREIN, RPMTAG_PREINPROG, 1 << 9),
+    "postinst": (RPMTAG_POSTIN, RPMTAG_POSTINPROG, 1 << 10),
+    "prerm": (RPMTAG_PREUN, RPMTAG_PREUNPROG, 1 << 11),
+    "postrm": (RPMTAG_POSTUN, RPMTAG_POSTUNPROG, 1 << 12),
+}
+
+MAX_CPIO_SIZE = 0xffffffff
+
+def parse_dependencies(text):
+    """
+    Parses comma separated list of dependencies, e.g.
+    "glibc, foo >= 1.0, bar (= 2.0)" into (name, flags, version) tuples
+    """
+
+    deps = []
+    if not text:
+        return deps
+
+    for item in str(text).split(","):
+        item = item.strip().replace("(", " ").replace(")", " ")
+        if not item:
+            continue
+        match = re.match(r"^([^\s<>=]+)\s*(<<|<=|==|>=|>>|<|=|>)?\s*(\S*)\s*$", item)
+        if match is None:
+            raise ValueError("Can't parse dependency '{0}'".format(item))
+        name, operator, version = match.groups()
+        flags = SENSE_OPERATORS[operator] if operator and version else 0
+        deps.append((name, flags, version if flags else ""))
+
+    return deps
+
+class Header:
+    """
+    RPM header structure with immutable region
+    """
+
+    def __init__(self, region_tag):
+        self.region_tag = region_tag
+        self.tags = {}
+
+    def add(self, tag, tag_type, value):
+        self.tags[tag] = (tag_type, value)
+
+    def encode(self, tag_type, value):
+        if tag_type in TYPE_FORMAT:
+            return struct.pack(">{0}{1}".format(len(value), TYPE_FORMAT[tag_type]), *value), len(value)
+        if tag_type == RPM_STRING_TYPE:
+            return value.encode("utf-8") + b"\0", 1
+        if tag_type == RPM_BIN_TYPE:
+            return value, len(value)
+        # string arrays, i18n strings are stored for the only "C" locale
+        return b"".join(v.encode("utf-8") + b"\0" for v in value), len(value)
+
+    def bytes(self):
+        index = []
+        data = b""
+        for tag in sorted(self.tags):
+            tag_type, value = self.tags[tag]
+            encoded, count = self.encode(tag_type, value)
+            align = TYPE_ALIGN.get(tag_type, 1)
+            if len(data) % align:
+                data += b"\0" * (align - len(data) % align)
+            index.append(struct.pack(">iIiI", tag, tag_type, len(data), count))
+            data += encoded
+
+        entries = len(index) + 1
+        region = struct.pack(">iIiI", self.region_tag, RPM_BIN_TYPE, len(data), 16)
+        data += struct.pack(">iIiI", self.region_tag, RPM_BIN_TYPE, -entries * 16, 16)
+
+        return HEADER_MAGIC + struct.pack(">II", entries, len(data)) + region + b"".join(index) + data
+
+class HashingWriter:
+    """
+    File object passing data to fp while computing their sha256
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.fp.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        self.fp.flush()
+
+class CpioWriter:
+    """
+    Writes cpio archive in SVR4 "newc" format
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.size = 0
+
+    def write(self, data):
+        self.fp.write(data)
+        self.size += len(data)
+
+    def pad(self):
+        if self.size % 4:
+            self.write(b"\0" * (4 - self.size % 4))
+
+    def add(self, name, ino, mode, mtime, filesize, nlink=1, rdevmajor=0, rdevminor=0):
+        name = name.encode("utf-8") + b"\0"
+        fields = (ino, mode, 0, 0, nlink, mtime, filesize, 0, 0, rdevmajor, rdevminor, len(name), 0)
+        self.write(b"070701" + "".join("{0:08x}".format(f) for f in fields).encode("ascii"))
+        self.write(name)
+        self.pad()
+
+    def close(self):
+        self.add("TRAILER!!!", 0, 0, 0, 0)
+
+class RPMWriter:
+    """
+    Writes binary RPM package of files from a build root
+    """
+
+    def __init__(self, filename, name, version, release, architecture, compression="gzip", level=None, threads=None, source_date_epoch=None):
+        self.filename = filename
+        # Reproducible output: newer mtimes are clamped, build time is set to it
+        self.source_date_epoch = source_date_epoch
+        self.name = name
+        self.version = version
+        self.release = release
+        self.architecture = architecture
+        self.compression = compression
+        self.level = level = DEFAULT_LEVELS[compression] if level is None else int(level)
+        self.threads = threads
+        self.header = Header(RPMTAG_HEADERIMMUTABLE)
+        self.deps = {"requires": [], "provides": [], "conflicts": [], "obsoletes": []}
+
+        self.header.add(RPMTAG_HEADERI18NTABLE, RPM_STRING_ARRAY_TYPE, ["C"])
+        self.header.add(RPMTAG_NAME, RPM_STRING_TYPE, name)
+        self.header.add(RPMTAG_VERSION, RPM_STRING_TYPE, version)
+        self.header.add(RPMTAG_RELEASE, RPM_STRING_TYPE, release)
+        self.header.add(RPMTAG_OS, RPM_STRING_TYPE, "linux")
+        self.header.add(RPMTAG_ARCH, RPM_STRING_TYPE, architecture)
+        self.header.add(RPMTAG_RPMVERSION, RPM_STRING_TYPE, "4.11.0")
+        self.header.add(RPMTAG_SOURCERPM, RPM_STRING_TYPE, "{0}-{1}-{2}.src.rpm".format(name, version, release))
+        self.header.add(RPMTAG_PAYLOADFORMAT, RPM_STRING_TYPE, "cpio")
+        self.header.add(RPMTAG_PAYLOADCOMPRESSOR, RPM_STRING_TYPE, compression)
+        self.header.add(RPMTAG_PAYLOADFLAGS, RPM_STRING_TYPE, str(level))
+        if source_date_epoch is None:
+            self.header.add(RPMTAG_BUILDTIME, RPM_INT32_TYPE, [int(time.time())])
+            self.header.add(RPMTAG_BUILDHOST, RPM_STRING_TYPE, socket.gethostname())
+        else:
+            self.header.add(RPMTAG_BUILDTIME, RPM_INT32_TYPE, [source_date_epoch])
+            self.header.add(RPMTAG_BUILDHOST, RPM_STRING_TYPE, "localhost")
+
+        self.add_dependencies("provides", "{0} = {1}-{2}".format(name, version, release))
+        self.add_rpmlib_dependency("CompressedFileNames", "3.0.4-1")
+        self.add_rpmlib_dependency("PayloadFilesHavePrefix", "4.0-1")
+        self.add_rpmlib_dependency("FileDigests", "4.6.0-1")
+        if compression == "xz":
+            self.add_rpmlib_dependency("PayloadIsXz", "5.2-1")
+        elif compression == "zstd":
+            self.add_rpmlib_dependency("PayloadIsZstd", "5.4.18-1")
+
+    def set_metadata(self, summary, description, license="N/A", group="Applications/Productivity", packager=None):
+        self.header.add(RPMTAG_SUMMARY, RPM_I18NSTRING_TYPE, [summary])
+        self.header.add(RPMTAG_DESCRIPTION, RPM_I18NSTRING_TYPE, [description])
+        self.header.add(RPMTAG_LICENSE, RPM_STRING_TYPE, license)
+        self.header.add(RPMTAG_GROUP, RPM_I18NSTRING_TYPE, [group])
+        if packager:
+            self.header.add(RPMTAG_PACKAGER, RPM_STRING_TYPE, packager)
+
+    def add_dependencies(self, kind, text):
+        self.deps[kind].extend(parse_dependencies(text))
+
+    def add_rpmlib_dependency(self, feature, version):
+        self.deps["requires"].append(("rpmlib({0})".format(feature), RPMSENSE_RPMLIB | RPMSENSE_LESS | RPMSENSE_EQUAL, version))
+
+    def add_script(self, script, body, interpreter="/bin/sh"):
+        """
+        Adds installation script, script names are the debian ones
+        (preinst, postinst, prerm, postrm)
+        """
+
+        tag, progtag, sense = SCRIPTS[script]
+        self.header.add(tag, RPM_STRING_TYPE, body)
+        self.header.add(progtag, RPM_STRING_TYPE, interpreter)
+        self.deps["requires"].append((interpreter, RPMSENSE_INTERP | sense, ""))
+
+    def add_dependency_tags(self):
+        tags = {
+            "requires": (RPMTAG_REQUIRENAME, RPMTAG_REQUIREFLAGS, RPMTAG_REQUIREVERSION),
+            "provides": (RPMTAG_PROVIDENAME, RPMTAG_PROVIDEFLAGS, RPMTAG_PROVIDEVERSION),
+            "conflicts": (RPMTAG_CONFLICTNAME, RPMTAG_CONFLICTFLAGS, RPMTAG_CONFLICTVERSION),
+            "obsoletes": (RPMTAG_OBSOLETENAME, RPMTAG_OBSOLETEFLAGS, RPMTAG_OBSOLETEVERSION),
+        }
+        for kind, deps in self.deps.items():
+            if not deps:
+                continue
+            nametag, flagstag, versiontag = tags[kind]
+            self.header.add(nametag, RPM_STRING_ARRAY_TYPE, [d[0] for d in deps])
+            self.header.add(flagstag, RPM_INT32_TYPE, [d[1] for d in deps])
+            self.header.add(versiontag, RPM_STRING_ARRAY_TYPE, [d[2] for d in deps])
+
+    def write_payload(self, fp, root, paths, follow_symlinks=False, preserve_permissions=True, digests={}, fanout=None):
+        """
+        Writes compressed cpio payload of paths (absolute install paths)
+        found in root, returns list of file records for the header.
+        Files with sha256 given in digests are not hashed again.
+        With fanout, regular files are taken from the fan-out reader.
+        """
+
+        files = []
+        compressor = open_compressor(fp, self.compression, self.level, self.threads, stable=self.source_date_epoch is not None)
+        cpio = CpioWriter(compressor)
+
+        if not preserve_permissions:
+            umask = os.umask(0)
+            os.umask(umask)
+
+        for ino, path in enumerate(sorted(paths), 1):
+            source = os.path.join(root, path.lstrip("/"))
+            st = os.stat(source) if follow_symlinks else os.lstat(source)
+            mode = st.st_mode
+            if not preserve_permissions and not stat.S_ISLNK(mode):
+                # Same modes as a copy of the tree made without preserving permissions
+                mode = stat.S_IFMT(mode) | ((0o777 if stat.S_ISDIR(mode) else 0o666) & ~umask)
+            linkto = ""
+            digest = ""
+            stream = None
+
+            if stat.S_ISLNK(mode):
+                linkto = os.readlink(source)
+                size = len(linkto.encode("utf-8"))
+            elif stat.S_ISREG(mode):
+                size = st.st_size
+                if fanout is not None:
+                    stream = fanout.open(source)
+                    size = stream.size
+            else:
+                size = 0
+
+            if size > MAX_CPIO_SIZE:
+                raise ValueError("File {0} is too large for cpio payload, use rpmbuild".format(path))
+
+            mtime = int(st.st_mtime)
+            if self.source_date_epoch is not None:
+                mtime = min(mtime, self.source_date_epoch)
+
+            cpio.add("." + path, ino, mode, mtime, size, nlink=2 if stat.S_ISDIR(mode) else 1)
+
+            if stat.S_ISLNK(mode):
+                cpio.write(linkto.encode("utf-8"))
+            elif stream is not None:
+                # Fan-out reader hashes files missing in digest cache
+                with stream:
+                    for chunk in iter(lambda: stream.read(1024 * 1024), b""):
+                        cpio.write(chunk)
+                digest = stream.sha256
+            elif stat.S_ISREG(mode):
+                digest = digests.get(path)
+                sha = None if digest else hashlib.sha256()
+                with open(source, "rb") as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        if sha:
+                            sha.update(chunk)
+                        cpio.write(chunk)
+                if sha:
+                    digest = sha.hexdigest()
+            cpio.pad()
+
+            files.append((path, ino, mode, mtime, size, digest, linkto))
+
+        cpio.close()
+        compressor.close()
+
+        return files, cpio.size
+
+    def add_file_tags(self, files):
+        dirnames = []
+        dirindex = {}
+        dirindexes = []
+        basenames = []
+
+        for path, ino, mode, mtime, size, digest, linkto in files:
+            dirname, basename = path.rsplit("/", 1)
+            dirname += "/"
+            if dirname not in dirindex:
+                dirindex[dirname] = len(dirnames)
+                dirnames.append(dirname)
+            dirindexes.append(dirindex[dirname])
+            basenames.append(basename)
+
+        count = len(files)
+        h = self.header
+        size = sum(f[4] for f in files)
+        if size > 0xffffffff:
+            h.add(RPMTAG_LONGSIZE, RPM_INT64_TYPE, [size])
+        else:
+            h.add(RPMTAG_SIZE, RPM_INT32_TYPE, [size])
+        if not count:
+            return
+
+        h.add(RPMTAG_DIRNAMES, RPM_STRING_ARRAY_TYPE, dirnames)
+        h.add(RPMTAG_DIRINDEXES, RPM_INT32_TYPE, dirindexes)
+        h.add(RPMTAG_BASENAMES, RPM_STRING_ARRAY_TYPE, basenames)
+        h.add(RPMTAG_FILESIZES, RPM_INT32_TYPE, [f[4] for f in files])
+        h.add(RPMTAG_FILEMODES, RPM_INT16_TYPE, [f[2] & 0xffff for f in files])
+        h.add(RPMTAG_FILERDEVS, RPM_INT16_TYPE, [0] * count)
+        h.add(RPMTAG_FILEMTIMES, RPM_INT32_TYPE, [f[3] & 0xffffffff for f in files])
+        h.add(RPMTAG_FILEDIGESTS, RPM_STRING_ARRAY_TYPE, [f[5] for f in files])
+        h.add(RPMTAG_FILELINKTOS, RPM_STRING_ARRAY_TYPE, [f[6] for f in files])
+        h.add(RPMTAG_FILEFLAGS, RPM_INT32_TYPE, [0] * count)
+        h.add(RPMTAG_FILEUSERNAME, RPM_STRING_ARRAY_TYPE, ["root"] * count)
+        h.add(RPMTAG_FILEGROUPNAME, RPM_STRING_ARRAY_TYPE, ["root"] * count)
+        h.add(RPMTAG_FILEVERIFYFLAGS, RPM_INT32_TYPE, [0xffffffff] * count)
+        h.add(RPMTAG_FILEDEVICES, RPM_INT32_TYPE, [1] * count)
+        h.add(RPMTAG_FILEINODES, RPM_INT32_TYPE, [f[1] for f in files])
+        h.add(RPMTAG_FILELANGS, RPM_STRING_ARRAY_TYPE, [""] * count)
+        h.add(RPMTAG_FILEDIGESTALGO, RPM_INT32_TYPE, [PGPHASHALGO_SHA256])
+
+    def lead(self):
+        name = "{0}-{1}-{2}".format(self.name, self.version, self.release).encode("utf-8")[:65]
+        archnum = 1 if self.architecture in ("i386", "i686", "x86_64", "noarch") else 0
+        return struct.pack(">4sBBhh66shh16s", LEAD_MAGIC, 3, 0, 0, archnum, name, 1, 5, b"")
+
+    def signature(self, header, header_md5, payload_size, archive_size):
+        sig = Header(RPMTAG_HEADERSIGNATURES)
+        sig.add(RPMSIGTAG_SHA1, RPM_STRING_TYPE, hashlib.sha1(header).hexdigest())
+        sig.add(RPMSIGTAG_SHA256, RPM_STRING_TYPE, hashlib.sha256(header).hexdigest())
+        sig.add(RPMSIGTAG_MD5, RPM_BIN_TYPE, header_md5.digest())
+        if len(header) + payload_size > 0xffffffff or archive_size > 0xffffffff:
+            sig.add(RPMSIGTAG_LONGSIZE, RPM_INT64_TYPE, [len(header) + payload_size])
+            sig.add(RPMSIGTAG_LONGARCHIVESIZE, RPM_INT64_TYPE, [archive_size])
+        else:
+            sig.add(RPMSIGTAG_SIZE, RPM_INT32_TYPE, [len(header) + payload_size])
+            sig.add(RPMSIGTAG_PAYLOADSIZE, RPM_INT32_TYPE, [archive_size])
+
+        data = sig.bytes()
+        if len(data) % 8:
+            data += b"\0" * (8 - len(data) % 8)
+        return data
+
+    def write(self, root, paths, follow_symlinks=False, preserve_permissions=True, digests={}, fanout=None):
+        """
+        Creates the package from paths found in root
+        """
+
+        outdir = os.path.dirname(os.path.abspath(self.filename))
+        # rpmbuild creates _rpmdir itself
+        os.makedirs(outdir, exist_ok=True)
+        tmpfile = self.filename + ".tmp"
+
+        try:
+            with tempfile.TemporaryFile(dir=outdir) as payload:
+                writer = HashingWriter(payload)
+                files, archive_size = self.write_payload(writer, root, paths, follow_symlinks, preserve_permissions, digests, fanout)
+                payload_size = writer.size
+
+                self.add_file_tags(files)
+                self.add_dependency_tags()
+                self.header.add(RPMTAG_PAYLOADDIGEST, RPM_STRING_ARRAY_TYPE, [writer.sha256.hexdigest()])
+                self.header.add(RPMTAG_PAYLOADDIGESTALGO, RPM_INT32_TYPE, [PGPHASHALGO_SHA256])
+                header = self.header.bytes()
+
+                with open(tmpfile, "wb") as fp:
+                    fp.write(self.lead())
+                    # Signature has fixed size, it is written when md5 of the payload is known
+                    header_md5 = hashlib.md5(header)
+                    sig_offset = fp.tell()
+                    fp.write(self.signature(header, header_md5, payload_size, archive_size))
+                    fp.write(header)
+
+                    payload.seek(0)
+                    for chunk in iter(lambda: payload.read(1024 * 1024), b""):
+                        header_md5.update(chunk)
+                        fp.write(chunk)
+
+                    fp.seek(sig_offset)
+                    fp.write(self.signature(header, header_md5, payload_size, archive_size))
+
+            os.rename(tmpfile, self.filename)
+        except:
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+            raise
+
+        logger.debug("RPM package {0} written".format(self.filename))
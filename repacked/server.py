@@ -0,0 +1,232 @@
+"""
+Build server
+
+repacked.py --serve listens on a Unix socket and builds packagespecs sent
+by clients (repacked.py --server). Plugins are loaded and templates are
+compiled once, jobs run in a bounded pool of forked worker processes which
+keep their version DB connection and digest cache between jobs. Output of
+every job is written to its own log file.
+
+Requests and responses are JSON objects, one per line:
+
+    {"action": "build", "args": ["packagespec", "-f", "rpm"], "cwd": "/src/foo"}
+    {"action": "status", "id": 3}
+    {"action": "wait", "id": 3}
+    {"action": "shutdown"}
+"""
+
+import os
+import json
+import time
+import signal
+import socket
+import threading
+import socketserver
+import multiprocessing
+import concurrent.futures
+import logging
+
+logger = logging.getLogger()
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+class Job:
+    def __init__(self, id, args, cwd, logfile):
+        self.id = id
+        self.args = list(args)
+        self.cwd = cwd
+        self.logfile = logfile
+        self.state = QUEUED
+        self.future = None
+        self.submitted = time.time()
+        self.finished = None
+        self.failed = []
+        self.versions = {}
+        self.error = None
+
+    def info(self):
+        state = self.state
+        if state == QUEUED and self.future is not None and self.future.running():
+            state = RUNNING
+        return {
+            "id": self.id,
+            "state": state,
+            "args": self.args,
+            "cwd": self.cwd,
+            "log": self.logfile,
+            "submitted": self.submitted,
+            "finished": self.finished,
+            "failed": self.failed,
+            "versions": self.versions,
+            "error": self.error,
+        }
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = self.server.dispatch(json.loads(line.decode("utf-8")))
+            except (ValueError, KeyError, TypeError) as e:
+                response = {"error": "Invalid request: {0}".format(e)}
+            self.wfile.write((json.dumps(response, default=str) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+class BuildServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Accepts build jobs on socket path, build(args, cwd, logfile) is run
+    in one of workers processes for every job
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, build, workers=1, log_dir="/var/tmp/repacked-jobs", max_jobs=1000):
+        self.build = build
+        self.workers = max(workers, 1)
+        self.log_dir = os.path.abspath(log_dir)
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        self.next_id = 1
+        # Job ids start at 1 again after a restart, log names of every server instance differ
+        self.instance = "{0}-{1}".format(time.strftime("%Y%m%d-%H%M%S"), os.getpid())
+        self.condition = threading.Condition()
+        self.executor = None
+
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+
+        # Workers are forked before any server thread is started
+        self.start_pool()
+
+        if os.path.exists(path):
+            if is_listening(path):
+                raise OSError("Build server already listens on {0}".format(path))
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+        os.chmod(path, 0o600)
+
+    def start_pool(self):
+        context = multiprocessing.get_context("fork")
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        # All workers of a fork pool are started with the first job
+        self.executor.submit(os.getpid).result()
+
+    def submit(self, args, cwd):
+        with self.condition:
+            job = Job(self.next_id, args, cwd, os.path.join(self.log_dir, "job-{0}-{1}.log".format(self.instance, self.next_id)))
+            self.next_id += 1
+            self.jobs[job.id] = job
+            self.expire_jobs()
+            if self.executor is None:
+                self.start_pool()
+            job.future = self.executor.submit(self.build, job.args, job.cwd, job.logfile)
+        logger.info("Job {0} queued: {1}".format(job.id, " ".join(job.args)))
+        job.future.add_done_callback(lambda future: self.finish(job, future))
+        return job
+
+    def finish(self, job, future):
+        with self.condition:
+            try:
+                job.failed, job.versions = future.result()
+                job.state = FAILED if job.failed else DONE
+            except concurrent.futures.process.BrokenProcessPool as e:
+                job.state = FAILED
+                job.error = "Build worker died: {0}".format(e)
+                self.executor = None
+            except BaseException as e:
+                job.state = FAILED
+                job.error = str(e)
+            job.finished = time.time()
+            self.condition.notify_all()
+        logger.info("Job {0} {1} in {2:.1f}s".format(job.id, job.state, job.finished - job.submitted))
+
+    def expire_jobs(self):
+        # Only records of finished jobs are dropped, their logs are kept
+        finished = [job for job in self.jobs.values() if job.finished is not None]
+        for job in sorted(finished, key=lambda job: job.id)[:max(len(self.jobs) - self.max_jobs, 0)]:
+            del self.jobs[job.id]
+
+    def wait(self, job, timeout=None):
+        with self.condition:
+            self.condition.wait_for(lambda: job.finished is not None, timeout)
+
+    def get_job(self, request):
+        job = self.jobs.get(int(request["id"]))
+        if job is None:
+            raise KeyError("no job {0}".format(request["id"]))
+        return job
+
+    def dispatch(self, request):
+        action = request.get("action")
+        if action == "build":
+            if not request.get("args"):
+                return {"error": "No packagespec given"}
+            return self.submit(request["args"], request.get("cwd") or "/").info()
+        if action == "status":
+            if request.get("id") is not None:
+                return self.get_job(request).info()
+            return {"jobs": [job.info() for job in sorted(self.jobs.values(), key=lambda job: job.id)]}
+        if action == "wait":
+            job = self.get_job(request)
+            self.wait(job, request.get("timeout"))
+            return job.info()
+        if action == "shutdown":
+            threading.Thread(target=self.shutdown).start()
+            return {"state": "shutdown"}
+        return {"error": "Unknown action {0}".format(action)}
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+def is_listening(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+def serve(path, build, workers=1, log_dir="/var/tmp/repacked-jobs"):
+    """
+    Runs build server until it gets shutdown request or is interrupted
+    """
+
+    server = BuildServer(path, build, workers, log_dir)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    logger.info("Build server listening on {0} with {1} workers, job logs in {2}".format(path, server.workers, server.log_dir))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def request(path, message):
+    """
+    Sends request to build server, returns its response
+    """
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        with sock.makefile("rwb") as f:
+            f.write((json.dumps(message) + "\n").encode("utf-8"))
+            f.flush()
+            line = f.readline()
+    finally:
+        sock.close()
+    if not line:
+        raise OSError("Build server on {0} closed the connection".format(path))
+    return json.loads(line.decode("utf-8"))
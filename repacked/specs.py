@@ -0,0 +1,204 @@
+"""
+Loading and validation of packagespec files
+
+Specs are parsed with the libyaml based loader when PyYAML has it and
+checked against the schema below before anything is built, so a broken
+spec fails before hooks run or packagetree is copied. Parsed specs are
+cached in ~/.repacked/specs keyed by sha256 of the spec file, an
+unchanged spec is not parsed again.
+"""
+
+import os
+import pickle
+import hashlib
+import logging
+
+logger = logging.getLogger()
+
+cache_dir = os.path.expanduser("~/.repacked/specs")
+
+# Bumped whenever parsing or normalization changes, old entries are not used
+CACHE_VERSION = 1
+
+# Number of parsed specs kept in the cache directory
+CACHE_SIZE = 500
+
+SCALAR = (str, int, float)
+
+# Spec keys: (allowed types, required), optional keys can be left empty
+SPEC_FIELDS = {
+    "name": (str, True),
+    "version": (SCALAR, False),
+    "release": (SCALAR, False),
+    "maintainer": (str, True),
+    "summary": (SCALAR, True),
+    "description": (SCALAR, True),
+    "packagetree": (str, False),
+    "scripts": (dict, False),
+    "packages": (list, True),
+    "pkgbuild": (dict, False),
+}
+
+PACKAGE_FIELDS = {
+    "package": (str, True),
+    "architecture": (str, True),
+    "requires": (str, False),
+    "provides": (str, False),
+    "conflicts": (str, False),
+    "replaces": (str, False),
+    "predepends": (str, False),
+    "profile": (SCALAR, False),
+    "pkg-version": (SCALAR, False),
+    "scripts": (dict, False),
+    "directory_exclude_list": (list, False),
+    "lintian-overrides": (str, False),
+}
+
+# Values used as strings by builders
+STRING_FIELDS = ["version", "release", "summary", "description"]
+
+memory_cache = {}
+
+class SpecError(Exception):
+    pass
+
+def check_fields(item, fields, where, errors):
+    for key, (types, required) in sorted(fields.items()):
+        value = item.get(key)
+        if value is None:
+            if required:
+                errors.append("{0}: missing {1}".format(where, key))
+            continue
+        if not isinstance(value, types) or isinstance(value, bool):
+            errors.append("{0}: {1} has wrong type {2}".format(where, key, type(value).__name__))
+
+def check_scripts(scripts, where, errors):
+    for name, path in scripts.items():
+        if not isinstance(path, str):
+            errors.append("{0}: script {1} has to be a file name".format(where, name))
+
+def validate(spec):
+    """
+    Returns list of problems found in parsed spec, empty if it is valid
+    """
+
+    if not isinstance(spec, dict):
+        return ["packagespec has to be a mapping, not {0}".format(type(spec).__name__)]
+
+    errors = []
+    check_fields(spec, SPEC_FIELDS, "spec", errors)
+    if isinstance(spec.get("scripts"), dict):
+        check_scripts(spec["scripts"], "spec", errors)
+
+    packages = spec.get("packages")
+    if isinstance(packages, list):
+        if not packages:
+            errors.append("spec: no packages")
+        for index, package in enumerate(packages):
+            where = "package {0}".format(index + 1)
+            if not isinstance(package, dict):
+                errors.append("{0}: has to be a mapping".format(where))
+                continue
+            check_fields(package, PACKAGE_FIELDS, where, errors)
+            if isinstance(package.get("scripts"), dict):
+                check_scripts(package["scripts"], where, errors)
+            if isinstance(package.get("directory_exclude_list"), list):
+                for pattern in package["directory_exclude_list"]:
+                    if not isinstance(pattern, str):
+                        errors.append("{0}: directory_exclude_list entry {1} is not a string".format(where, pattern))
+
+    pkgbuild = spec.get("pkgbuild")
+    if isinstance(pkgbuild, dict) and pkgbuild.get("hooks") is not None:
+        hooks = pkgbuild["hooks"]
+        if not isinstance(hooks, list):
+            errors.append("pkgbuild: hooks has to be a list")
+        else:
+            for hook in hooks:
+                if not isinstance(hook, dict) or not hook.get("name") or not hook.get("command"):
+                    errors.append("pkgbuild: hooks need name and command: {0}".format(hook))
+
+    return errors
+
+def normalize(spec):
+    for key in STRING_FIELDS:
+        if spec.get(key) is not None:
+            spec[key] = str(spec[key])
+    return spec
+
+def cache_path(digest):
+    return os.path.join(cache_dir, "{0}-{1}.pickle".format(digest, CACHE_VERSION))
+
+def read_cache(digest):
+    data = memory_cache.get(digest)
+    if data is None:
+        try:
+            with open(cache_path(digest), "rb") as f:
+                data = f.read()
+            # Recently used entries are kept by prune_cache
+            os.utime(cache_path(digest))
+        except OSError:
+            return None
+    try:
+        spec = pickle.loads(data)
+    except Exception:
+        return None
+    memory_cache[digest] = data
+    return spec
+
+def write_cache(digest, spec):
+    data = pickle.dumps(spec, pickle.HIGHEST_PROTOCOL)
+    if len(memory_cache) >= CACHE_SIZE:
+        memory_cache.clear()
+    memory_cache[digest] = data
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmpfile = "{0}.{1}".format(cache_path(digest), os.getpid())
+        with open(tmpfile, "wb") as f:
+            f.write(data)
+        os.rename(tmpfile, cache_path(digest))
+        prune_cache()
+    except OSError as e:
+        logger.debug("Can't write spec cache {0}: {1}".format(cache_dir, e))
+
+def prune_cache():
+    entries = [entry for entry in os.scandir(cache_dir) if entry.name.endswith(".pickle")]
+    if len(entries) <= CACHE_SIZE:
+        return
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    for entry in entries[:len(entries) - CACHE_SIZE]:
+        try:
+            os.unlink(entry.path)
+        except OSError:
+            pass
+
+def load_spec(filename):
+    """
+    Returns parsed and validated spec, raises SpecError when it can't
+    be parsed or doesn't match the schema
+    """
+
+    with open(filename, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+
+    spec = read_cache(digest)
+    if spec is not None:
+        return spec
+
+    # yaml is imported only when a spec has to be parsed
+    import yaml
+
+    try:
+        # libyaml based loader is many times faster on large specs
+        spec = yaml.load(data, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    except yaml.YAMLError as e:
+        raise SpecError("Can't parse {0}: {1}".format(filename, e))
+
+    errors = validate(spec)
+    if errors:
+        raise SpecError("Invalid {0}:\n  {1}".format(filename, "\n  ".join(errors)))
+
+    spec = normalize(spec)
+    write_cache(digest, spec)
+    return spec
@@ -0,0 +1,346 @@
+"""
+Shared staging of package trees
+
+The packagetree is materialized only once per run and every package
+plugin gets its own view of it made of hardlinks (or reflinks when
+hardlinks are not possible), so plugins can add their control files
+without copying the whole tree again.
+
+Persistent stages are kept between runs and synchronized with the
+packagetree like rsync does, entries with the same type, size and mtime
+are left alone, so a build copies only files changed since the last one.
+"""
+
+import os
+import errno
+import fcntl
+import shutil
+import stat
+import hashlib
+import tempfile
+import logging
+
+from tracing import span
+
+logger = logging.getLogger()
+
+# ioctl request sharing data blocks between two files (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# errors saying that the method is not supported between given file systems
+UNSUPPORTED_ERRORS = (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EBADF)
+
+class FileLinker:
+    """
+    Copies files using the cheapest method the file system supports,
+    methods which failed once are not tried again
+    """
+
+    def __init__(self, methods, preserve_permissions=True):
+        self.methods = list(methods)
+        self.preserve_permissions = preserve_permissions
+
+    def link(self, src, dst, st):
+        for method in list(self.methods):
+            try:
+                getattr(self, "_" + method)(src, dst, st)
+                return method
+            except OSError as e:
+                if os.path.lexists(dst):
+                    os.unlink(dst)
+                if e.errno in UNSUPPORTED_ERRORS:
+                    logger.debug("Can't {0} {1}, falling back to next copy method".format(method, src))
+                    self.methods.remove(method)
+                elif e.errno != errno.EMLINK:
+                    raise
+
+        self._copy(src, dst, st)
+        return "copy"
+
+    def _open_destination(self, dst, st):
+        mode = stat.S_IMODE(st.st_mode) if self.preserve_permissions else 0o666
+        return os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+
+    def _finish(self, dst, fd, st):
+        if self.preserve_permissions:
+            os.fchmod(fd, stat.S_IMODE(st.st_mode))
+        os.close(fd)
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    def _hardlink(self, src, dst, st):
+        os.link(src, dst, follow_symlinks=False)
+
+    def _reflink(self, src, dst, st):
+        with open(src, "rb") as sf:
+            fd = self._open_destination(dst, st)
+            try:
+                fcntl.ioctl(fd, FICLONE, sf.fileno())
+            except:
+                os.close(fd)
+                raise
+            self._finish(dst, fd, st)
+
+    def _copy_range(self, src, dst, st):
+        with open(src, "rb") as sf:
+            fd = self._open_destination(dst, st)
+            try:
+                remaining = st.st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(sf.fileno(), fd, remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            except:
+                os.close(fd)
+                raise
+            self._finish(dst, fd, st)
+
+    def _copy(self, src, dst, st):
+        with open(src, "rb") as sf:
+            fd = self._open_destination(dst, st)
+            with os.fdopen(fd, "wb", closefd=False) as df:
+                shutil.copyfileobj(sf, df, 1024 * 1024)
+            self._finish(dst, fd, st)
+
+def link_tree(src, dst, linker, preserve_symlinks=False):
+    """
+    Recreates directory tree src in dst, files are created by linker.
+    Returns number of files created.
+    """
+
+    count = 0
+
+    if not os.path.isdir(dst):
+        os.makedirs(dst)
+
+    for entry in os.scandir(src):
+        src_path = entry.path
+        dst_path = os.path.join(dst, entry.name)
+
+        if entry.is_symlink() and preserve_symlinks:
+            os.symlink(os.readlink(src_path), dst_path)
+        elif entry.is_dir():
+            count += link_tree(src_path, dst_path, linker, preserve_symlinks)
+        else:
+            linker.link(src_path, dst_path, os.stat(src_path))
+        count += 1
+
+    return count
+
+def remove_entry(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+def sync_tree(src, dst, linker, preserve_symlinks=False, preserve_permissions=True):
+    """
+    Makes directory tree dst the same as src, only entries added,
+    changed or removed in src are touched. Returns (copied, removed,
+    unchanged) entry counts.
+    """
+
+    copied = removed = unchanged = 0
+
+    if os.path.lexists(dst) and (os.path.islink(dst) or not os.path.isdir(dst)):
+        os.unlink(dst)
+    if not os.path.isdir(dst):
+        os.makedirs(dst)
+
+    existing = dict((entry.name, entry) for entry in os.scandir(dst))
+
+    for entry in os.scandir(src):
+        src_path = entry.path
+        dst_path = os.path.join(dst, entry.name)
+        old = existing.pop(entry.name, None)
+
+        if entry.is_symlink() and preserve_symlinks:
+            target = os.readlink(src_path)
+            if old is not None and old.is_symlink() and os.readlink(dst_path) == target:
+                unchanged += 1
+                continue
+            if old is not None:
+                remove_entry(dst_path)
+            os.symlink(target, dst_path)
+            copied += 1
+        elif entry.is_dir():
+            counts = sync_tree(src_path, dst_path, linker, preserve_symlinks, preserve_permissions)
+            copied, removed, unchanged = copied + counts[0], removed + counts[1], unchanged + counts[2] + 1
+            if preserve_permissions:
+                mode = stat.S_IMODE(os.stat(src_path).st_mode)
+                if stat.S_IMODE(os.stat(dst_path).st_mode) != mode:
+                    os.chmod(dst_path, mode)
+        else:
+            st = os.stat(src_path)
+            if old is not None and old.is_file(follow_symlinks=False):
+                old_st = old.stat(follow_symlinks=False)
+                if old_st.st_size == st.st_size and old_st.st_mtime_ns == st.st_mtime_ns:
+                    if preserve_permissions and stat.S_IMODE(old_st.st_mode) != stat.S_IMODE(st.st_mode):
+                        os.chmod(dst_path, stat.S_IMODE(st.st_mode))
+                    unchanged += 1
+                    continue
+            if old is not None:
+                remove_entry(dst_path)
+            linker.link(src_path, dst_path, st)
+            copied += 1
+
+    for name in existing:
+        remove_entry(os.path.join(dst, name))
+        removed += 1
+
+    return copied, removed, unchanged
+
+class StagingArea:
+    """
+    Holds packagetrees materialized during this run and hands out
+    views of them to package plugins. With persistent directory the
+    stages are kept there between runs, one per spec and packagetree.
+    """
+
+    def __init__(self, preserve_symlinks=False, preserve_permissions=True, persistent_dir=None, name=None):
+        self.preserve_symlinks = preserve_symlinks
+        self.preserve_permissions = preserve_permissions
+        self.persistent_dir = os.path.abspath(os.path.expanduser(persistent_dir)) if persistent_dir else None
+        self.name = name
+        self.stages = {}
+        self.locks = {}
+        self.view_linker = FileLinker(["hardlink", "reflink", "copy_range"])
+
+    def __getstate__(self):
+        # Locks are held by the parent process, not by build workers
+        state = self.__dict__.copy()
+        state['locks'] = {}
+        return state
+
+    def persistent_stage(self, packagetree):
+        """
+        Returns persistent stage directory of packagetree, locked
+        for this run
+        """
+
+        key = "{0}\0{1}\0{2}".format(os.path.abspath(packagetree), self.preserve_symlinks, self.preserve_permissions)
+        stagedir = os.path.join(self.persistent_dir, "{0}-{1}".format(self.name or "stage",
+            hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]))
+        if stagedir in self.locks:
+            return stagedir
+        if not os.path.isdir(self.persistent_dir):
+            os.makedirs(self.persistent_dir)
+
+        # Concurrent runs of the same spec take turns
+        lock = open(stagedir + ".lock", "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info("Waiting for persistent stage {0} used by another build".format(stagedir))
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        self.locks[stagedir] = lock
+        return stagedir
+
+    def stage(self, packagetree):
+        """
+        Materializes packagetree once, returns its staged copy
+        """
+
+        key = os.path.abspath(packagetree)
+        if key not in self.stages:
+            # Never hardlink to the source tree, build tools may change the staged files
+            linker = FileLinker(["reflink", "copy_range"], self.preserve_permissions)
+            if self.persistent_dir:
+                # Files changed through views differ in size or mtime and are copied again
+                stagedir = self.persistent_stage(packagetree)
+                with span("stage", files=0) as args:
+                    copied, removed, unchanged = sync_tree(packagetree, stagedir, linker, self.preserve_symlinks, self.preserve_permissions)
+                    args.update(files=copied, removed=removed, unchanged=unchanged)
+                logger.info("Synchronized {0} in {1}: {2} copied, {3} removed, {4} unchanged".format(
+                    packagetree, stagedir, copied, removed, unchanged))
+            else:
+                stagedir = tempfile.mkdtemp(prefix="repacked-stage-")
+                with span("stage", files=0) as args:
+                    count = args["files"] = link_tree(packagetree, stagedir, linker, self.preserve_symlinks)
+                logger.debug("Staged {0} entries of {1} in {2}".format(count, packagetree, stagedir))
+            self.stages[key] = stagedir
+
+        return self.stages[key]
+
+    def view(self, packagetree, destination):
+        """
+        Creates a view of staged packagetree in destination directory
+        """
+
+        stagedir = self.stage(packagetree)
+        with span("view", files=0) as args:
+            args["files"] = link_tree(stagedir, destination, self.view_linker, preserve_symlinks=True)
+        logger.debug("Linked {0} into {1} using {2}".format(stagedir, destination, self.view_linker.methods[:1] or ["copy"]))
+
+    def update(self, packagetree, paths):
+        """
+        Updates staged copy of packagetree after paths in it changed,
+        only the changed entries are copied again. The whole tree is
+        staged again by the next build when paths is None.
+        """
+
+        key = os.path.abspath(packagetree)
+        stagedir = self.stages.get(key)
+        if stagedir is None:
+            return
+        if paths is None:
+            # Persistent stage is synchronized again by the next build
+            if not self.persistent_dir:
+                shutil.rmtree(stagedir, ignore_errors=True)
+            del self.stages[key]
+            return
+
+        linker = FileLinker(["reflink", "copy_range"], self.preserve_permissions)
+        copied = []
+        with span("stage update", files=0) as args:
+            # Parents go first, entries of a copied directory are skipped
+            for path in sorted(set(os.path.abspath(path) for path in paths)):
+                relpath = os.path.relpath(path, key)
+                if relpath == "." or relpath.startswith(".." + os.sep) or any(path.startswith(d + os.sep) for d in copied):
+                    continue
+                src = path
+                dst = os.path.join(stagedir, relpath)
+
+                if os.path.isdir(src) and os.path.isdir(dst) and not os.path.islink(src) and not os.path.islink(dst):
+                    # Existing directory, only its own attributes may have changed
+                    if self.preserve_permissions:
+                        os.chmod(dst, stat.S_IMODE(os.stat(src).st_mode))
+                    continue
+
+                if os.path.isdir(dst) and not os.path.islink(dst):
+                    shutil.rmtree(dst)
+                elif os.path.lexists(dst):
+                    os.unlink(dst)
+                if not os.path.lexists(src):
+                    continue
+
+                if not os.path.isdir(os.path.dirname(dst)):
+                    os.makedirs(os.path.dirname(dst))
+                if os.path.islink(src) and self.preserve_symlinks:
+                    os.symlink(os.readlink(src), dst)
+                elif os.path.isdir(src):
+                    args["files"] += link_tree(src, dst, linker, self.preserve_symlinks)
+                    copied.append(path)
+                else:
+                    linker.link(src, dst, os.stat(src))
+                args["files"] += 1
+        logger.debug("Updated {0} entries of {1} in {2}".format(args["files"], packagetree, stagedir))
+
+    def directories(self):
+        """
+        Returns temporary stage directories, persistent ones are kept
+        """
+        if self.persistent_dir:
+            return []
+        return list(self.stages.values())
+
+    def close(self):
+        """
+        Releases persistent stages for other runs
+        """
+
+        for lock in self.locks.values():
+            lock.close()
+        self.locks = {}
+        if self.persistent_dir:
+            self.stages = {}
@@ -0,0 +1,72 @@
+"""
+Shared registry of compiled Mako templates
+
+Template files are compiled once per process, compiled modules are kept
+in ~/.repacked/modules and recompiled only when the template file changes.
+Inline templates (e.g. requires of a package) are memoized by their text.
+"""
+
+import os
+import hashlib
+import logging
+
+from mako.lookup import TemplateLookup
+from mako.template import Template
+
+logger = logging.getLogger()
+
+module_root = os.path.expanduser("~/.repacked/modules")
+
+template_lookup = None
+inline_templates = {}
+
+def find_template_dir():
+    tmpl_dir = os.path.expanduser("~/.repacked/templates")
+    if not os.path.exists(tmpl_dir):
+        tmpl_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+    if not os.path.exists(tmpl_dir):
+        tmpl_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../repacked/templates')
+    return tmpl_dir
+
+def get_lookup():
+    global template_lookup
+
+    if template_lookup is None:
+        tmpl_dir = os.path.abspath(find_template_dir())
+        # Every template directory gets its own module cache, file names would clash
+        module_dir = os.path.join(module_root, hashlib.sha1(tmpl_dir.encode("utf-8")).hexdigest()[:12])
+        try:
+            if not os.path.isdir(module_dir):
+                os.makedirs(module_dir)
+        except OSError:
+            logger.debug("Can't create template module cache {0}, compiling in memory".format(module_dir))
+            module_dir = None
+        template_lookup = TemplateLookup(directories=[tmpl_dir], module_directory=module_dir, filesystem_checks=True)
+
+    return template_lookup
+
+def get_template(name):
+    """
+    Returns compiled template of file name from template directory
+    """
+    return get_lookup().get_template(name)
+
+def compile_all():
+    """
+    Compiles all templates of template directory, e.g. before build
+    workers are forked
+    """
+
+    for name in sorted(os.listdir(find_template_dir())):
+        if name.endswith(".tmpl"):
+            get_template(name)
+
+def render_inline(text, **kwargs):
+    """
+    Renders template given as text, compiled templates are reused
+    """
+
+    template = inline_templates.get(text)
+    if template is None:
+        template = inline_templates[text] = Template(text)
+    return template.render(**kwargs)
@@ -0,0 +1,34 @@
+"""
+Running of external packaging tools
+
+dpkg-deb and rpmbuild run with their output captured and logged line by
+line, so it ends up in the job log of parallel builds. A tool which
+can't be started or exits with non zero status fails the build.
+"""
+
+import subprocess
+import logging
+
+logger = logging.getLogger()
+
+class ToolError(Exception):
+    pass
+
+def run_tool(name, command, env=None):
+    """
+    Runs command, list of arguments, raises ToolError when it fails
+    """
+
+    logger.debug("Running {0}".format(subprocess.list2cmdline(command)))
+    try:
+        process = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+    except OSError as e:
+        raise ToolError("Can't run {0}: {1}".format(name, e))
+
+    # Output of a failed tool is shown also when there is no job log
+    level = logging.ERROR if process.returncode else logging.INFO
+    for line in process.stdout.decode("utf-8", "replace").splitlines():
+        logger.log(level, "{0}: {1}".format(name, line))
+
+    if process.returncode:
+        raise ToolError("{0} failed with exit status {1}".format(name, process.returncode))
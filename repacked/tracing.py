@@ -0,0 +1,138 @@
+"""
+Tracing of build stages
+
+When tracing is started every stage of the build is recorded as a span
+with its duration, byte and file counts. Every process (build workers
+are forked) writes its spans to its own part file, the parts are merged
+at the end of the run into one file in Chrome trace format, which can be
+loaded into chrome://tracing or Perfetto, and a summary table is printed.
+Tracing is off by default and spans cost nothing then.
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import contextlib
+import logging
+
+logger = logging.getLogger()
+
+tracer = None
+
+class Tracer:
+    def __init__(self, filename):
+        self.filename = filename
+        self.directory = tempfile.mkdtemp(prefix="repacked-trace-")
+        self.parts = {}
+        self.lock = threading.Lock()
+
+    def add(self, event):
+        pid = os.getpid()
+        event["pid"] = pid
+        line = json.dumps(event, default=str) + "\n"
+        with self.lock:
+            part = self.parts.get(pid)
+            if part is None:
+                part = self.parts[pid] = open(os.path.join(self.directory, "{0}.json".format(pid)), "a")
+            # Workers may exit without closing their part, every span is flushed
+            part.write(line)
+            part.flush()
+
+    def events(self):
+        events = []
+        for name in sorted(os.listdir(self.directory)):
+            with open(os.path.join(self.directory, name)) as f:
+                events.extend(json.loads(line) for line in f if line.strip())
+        # Enclosing spans come before the spans started at the same time
+        events.sort(key=lambda e: (e["ts"], -e["dur"]))
+        return events
+
+    def close(self):
+        for part in self.parts.values():
+            part.close()
+        self.parts = {}
+
+class Span:
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self.args
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.time()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        if tracer is not None:
+            tracer.add({
+                "name": self.name,
+                "cat": self.category,
+                "ph": "X",
+                "ts": int(self.start * 1e6),
+                "dur": int((end - self.start) * 1e6),
+                "tid": threading.get_ident() % 1000000,
+                "args": self.args,
+            })
+        return False
+
+def span(name, category="build", **args):
+    """
+    Returns context manager recording stage name, it yields dict of
+    span arguments which can be filled in (e.g. bytes and files)
+    """
+
+    if tracer is None:
+        return contextlib.nullcontext(args)
+    return Span(name, category, args)
+
+def start(filename):
+    global tracer
+    tracer = Tracer(filename)
+
+def summary(events):
+    """
+    Returns table of time, bytes and files of stages
+    """
+
+    stages = {}
+    for event in events:
+        stage = stages.setdefault(event["name"], {"count": 0, "time": 0, "max": 0, "bytes": 0, "files": 0})
+        stage["count"] += 1
+        stage["time"] += event["dur"] / 1e6
+        stage["max"] = max(stage["max"], event["dur"] / 1e6)
+        stage["bytes"] += event["args"].get("bytes") or 0
+        stage["files"] += event["args"].get("files") or 0
+
+    lines = [["stage", "count", "total", "max", "files", "bytes"]]
+    for name, stage in sorted(stages.items(), key=lambda item: -item[1]["time"]):
+        lines.append([name, str(stage["count"]), "{0:.2f}s".format(stage["time"]), "{0:.2f}s".format(stage["max"]),
+            str(stage["files"] or ""), str(stage["bytes"] or "")])
+    widths = [max(len(line[i]) for line in lines) for i in range(len(lines[0]))]
+    return "\n".join("  ".join(value.ljust(width) if i == 0 else value.rjust(width)
+        for i, (value, width) in enumerate(zip(line, widths))) for line in lines)
+
+def finish():
+    """
+    Merges spans of all processes into the trace file and prints
+    the summary table
+    """
+
+    global tracer
+    if tracer is None:
+        return
+
+    tracer.close()
+    events = tracer.events()
+    with open(tracer.filename, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    shutil.rmtree(tracer.directory, ignore_errors=True)
+    logger.info("Trace of {0} spans written to {1}".format(len(events), tracer.filename))
+    tracer = None
+
+    print(summary(events))
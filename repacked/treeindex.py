@@ -0,0 +1,139 @@
+"""
+Index of package trees
+
+The packagetree is walked only once using os.scandir, every entry is
+recorded with its type, mode, size, link target and inode. Plugins and
+the build cache take file lists, directory lists and sizes from the
+index instead of walking the tree again.
+"""
+
+import os
+import stat
+import logging
+
+from tracing import span
+
+logger = logging.getLogger()
+
+DIRECTORY = "d"
+FILE = "f"
+SYMLINK = "l"
+OTHER = "o"
+
+class TreeEntry:
+    """
+    One entry of the tree, path is relative to the tree root
+    """
+
+    __slots__ = ("path", "type", "mode", "size", "linkto", "dev", "inode", "nlink", "mtime_ns")
+
+    def __init__(self, path, st, linkto=""):
+        mode = st.st_mode
+        if stat.S_ISDIR(mode):
+            self.type = DIRECTORY
+        elif stat.S_ISREG(mode):
+            self.type = FILE
+        elif stat.S_ISLNK(mode):
+            self.type = SYMLINK
+        else:
+            self.type = OTHER
+        self.path = path
+        self.mode = mode
+        self.size = st.st_size
+        self.linkto = linkto
+        self.dev = st.st_dev
+        self.inode = st.st_ino
+        self.nlink = st.st_nlink
+        self.mtime_ns = st.st_mtime_ns
+
+class TreeIndex:
+    """
+    Entries of a tree sorted by name, directories precede their content.
+    Symlinks are followed when follow_symlinks is set, the same way
+    the tree is copied when symlinks are not preserved.
+    """
+
+    def __init__(self, root, follow_symlinks=False):
+        self.root = root
+        self.follow_symlinks = follow_symlinks
+        self.entries = []
+        # {path: (md5, sha256)} filled in by digests.tree_digests
+        self.digests = None
+        self.scan(root, "", set())
+        logger.debug("Indexed {0} entries of {1}".format(len(self.entries), root))
+
+    def scan(self, directory, top, parents):
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda e: e.name)
+
+        for entry in entries:
+            path = top + entry.name
+            st = entry.stat(follow_symlinks=False)
+            if self.follow_symlinks and stat.S_ISLNK(st.st_mode):
+                try:
+                    st = os.stat(entry.path)
+                except OSError:
+                    logger.warning("Broken symlink {0}".format(entry.path))
+            linkto = os.readlink(entry.path) if stat.S_ISLNK(st.st_mode) else ""
+            self.entries.append(TreeEntry(path, st, linkto))
+
+            if stat.S_ISDIR(st.st_mode):
+                key = (st.st_dev, st.st_ino)
+                if key in parents:
+                    logger.warning("Symlink loop at {0}, not descending".format(entry.path))
+                    continue
+                parents.add(key)
+                self.scan(entry.path, path + "/", parents)
+                parents.discard(key)
+
+    def directories(self):
+        return [e for e in self.entries if e.type == DIRECTORY]
+
+    def files(self):
+        return [e for e in self.entries if e.type != DIRECTORY]
+
+    def total_size(self):
+        """
+        Returns size of regular files and link targets in bytes
+        """
+        return sum(e.size for e in self.entries if e.type in (FILE, SYMLINK))
+
+    def installed_size(self):
+        """
+        Returns installed size in KiB computed the way dpkg-gencontrol
+        does: files are rounded up to whole KiB, hardlinked files are
+        counted once, every other entry takes 1 KiB
+        """
+
+        size = 0
+        seen = set()
+        for e in self.entries:
+            if e.type == FILE:
+                if e.nlink > 1:
+                    if (e.dev, e.inode) in seen:
+                        continue
+                    seen.add((e.dev, e.inode))
+                size += (e.size + 1023) // 1024
+            else:
+                size += 1
+        return size
+
+indexes = {}
+
+def index_tree(root, follow_symlinks=False):
+    """
+    Returns index of root, every tree is walked only once per build
+    """
+
+    key = (os.path.abspath(root), bool(follow_symlinks))
+    if key not in indexes:
+        with span("index") as args:
+            indexes[key] = TreeIndex(root, follow_symlinks)
+            args["files"] = len(indexes[key].entries)
+    return indexes[key]
+
+def clear_indexes():
+    """
+    Forgets indexed trees, called when trees could have changed
+    """
+    indexes.clear()
@@ -0,0 +1,141 @@
+"""
+Store of built package versions
+
+Every build is recorded into a SQLite database with name, version,
+release, profile, package format, artifact path and digest, duration and
+time of the build. The database is in WAL mode and every build is
+written in its own transaction, so concurrent repacked runs on one host
+can share it safely. Connections are opened per process, forked build
+workers get their own.
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+
+logger = logging.getLogger()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    version TEXT,
+    release TEXT,
+    profile TEXT,
+    format TEXT,
+    artifact TEXT,
+    digest TEXT,
+    duration REAL,
+    built_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS builds_name ON builds (name, format, built_at);
+"""
+
+def digest_artifact(filename):
+    if not filename or not os.path.isfile(filename):
+        return None
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+class VersionStore:
+    """
+    Records builds and answers queries about them
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connections = {}
+        # Fail early when the database can't be opened
+        self.connection()
+
+    def connection(self):
+        pid = os.getpid()
+        if pid not in self.connections:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            db = sqlite3.connect(self.path, timeout=60)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+            self.connections[pid] = db
+        return self.connections[pid]
+
+    def __getstate__(self):
+        # Connections are not passed to build workers
+        state = self.__dict__.copy()
+        state['connections'] = {}
+        return state
+
+    def record(self, name, version, release=None, profile=None, format=None, artifact=None, duration=None, digest=None):
+        """
+        Records a build, digest is the sha256 of artifact known by the
+        caller, the artifact isn't read here
+        """
+        db = self.connection()
+        with db:
+            db.execute("INSERT INTO builds (name, version, release, profile, format, artifact, digest, duration, built_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (name, None if version is None else str(version), None if release is None else str(release),
+                 profile, format, artifact, digest, duration, time.time()))
+
+    def latest(self):
+        """
+        Returns the last build of every package name and format
+        """
+        return self.connection().execute("SELECT * FROM builds WHERE id IN "
+            "(SELECT MAX(id) FROM builds GROUP BY name, format) ORDER BY name, format").fetchall()
+
+    def history(self, name, limit=None):
+        """
+        Returns builds of package name, newest first
+        """
+        return self.connection().execute("SELECT * FROM builds WHERE name = ? ORDER BY id DESC LIMIT ?",
+            (name, -1 if limit is None else limit)).fetchall()
+
+    def recent_digests(self, keep):
+        """
+        Returns digests of artifacts of the last keep builds of every
+        package name, format and profile
+        """
+        rows = self.connection().execute("SELECT digest FROM (SELECT digest, ROW_NUMBER() OVER "
+            "(PARTITION BY name, format, profile ORDER BY id DESC) AS n FROM builds WHERE digest IS NOT NULL) "
+            "WHERE n <= ?", (keep,)).fetchall()
+        return set(row['digest'] for row in rows)
+
+    def close(self):
+        db = self.connections.pop(os.getpid(), None)
+        if db is not None:
+            db.close()
+
+def open_store(path):
+    """
+    Returns version store, None when the database can't be opened
+    """
+    try:
+        return VersionStore(path)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning("Version DB {0} not available, versions are not recorded: {1}".format(path, e))
+        return None
+
+def format_builds(rows):
+    """
+    Returns text table of build records
+    """
+
+    columns = ["name", "version", "release", "format", "profile", "built", "duration", "artifact"]
+    lines = [columns]
+    for row in rows:
+        lines.append([
+            row['name'], row['version'] or "", row['release'] or "", row['format'] or "", row['profile'] or "",
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row['built_at'])),
+            "" if row['duration'] is None else "{0:.1f}s".format(row['duration']),
+            row['artifact'] or "",
+        ])
+    widths = [max(len(line[i]) for line in lines) for i in range(len(columns))]
+    return "\n".join("  ".join(value.ljust(width) for value, width in zip(line, widths)).rstrip() for line in lines)
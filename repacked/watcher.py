@@ -0,0 +1,222 @@
+"""
+Watching of build inputs
+
+Directory trees and single files are watched with inotify (through ctypes,
+no extra module is needed). Files are watched through their directory, so
+editors replacing a file by rename are noticed too. Where inotify is not
+available the watched paths are polled.
+"""
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+logger = logging.getLogger()
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+    IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT = struct.Struct("iIII")
+
+class Watcher:
+    """
+    Common part of watchers, keeps watched trees and files
+    """
+
+    def __init__(self):
+        self.trees = []
+        self.files = {}
+
+    def watch_tree(self, path):
+        self.trees.append(os.path.abspath(path))
+
+    def watch_file(self, path):
+        path = os.path.abspath(path)
+        self.files.setdefault(os.path.dirname(path), set()).add(os.path.basename(path))
+
+    def in_tree(self, path):
+        return any(path == tree or path.startswith(tree + os.sep) for tree in self.trees)
+
+    def relevant(self, path):
+        return self.in_tree(path) or os.path.basename(path) in self.files.get(os.path.dirname(path), ())
+
+    def start(self):
+        """
+        Called when all paths are added, changes made since then are
+        reported by wait()
+        """
+        pass
+
+    def close(self):
+        pass
+
+class InotifyWatcher(Watcher):
+    def __init__(self):
+        Watcher.__init__(self)
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.directories = {}
+        self.watches = {}
+
+    def add_directory(self, path):
+        if path in self.watches:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                # Removed meanwhile, its parent reports it
+                return
+            raise OSError(error, "Can't watch {0}: {1}".format(path, os.strerror(error)))
+        self.directories[wd] = path
+        self.watches[path] = wd
+
+    def add_tree(self, path):
+        for root, dirs, files in os.walk(path):
+            self.add_directory(root)
+
+    def watch_tree(self, path):
+        Watcher.watch_tree(self, path)
+        self.add_tree(os.path.abspath(path))
+
+    def watch_file(self, path):
+        Watcher.watch_file(self, path)
+        self.add_directory(os.path.dirname(os.path.abspath(path)))
+
+    def read_events(self):
+        """
+        Returns changed paths of pending events, None when events
+        were lost and everything has to be considered changed
+        """
+
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changed
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0")
+                offset += EVENT.size + length
+
+                if mask & IN_Q_OVERFLOW:
+                    logger.warning("Watch events were lost, rebuilding everything")
+                    return None
+                directory = self.directories.get(wd)
+                if directory is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self.directories[wd]
+                    self.watches.pop(directory, None)
+                    continue
+
+                path = os.path.join(directory, os.fsdecode(name)) if name else directory
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF) and directory in self.trees:
+                    # Watched tree itself was replaced
+                    return None
+                if not self.relevant(path):
+                    continue
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and self.in_tree(path):
+                    # Entries created before the watch was added have no events of their own
+                    self.add_tree(path)
+                changed.add(path)
+
+    def wait(self, delay=0.2):
+        """
+        Blocks until watched paths change, returns changed paths once
+        no more events came for delay seconds
+        """
+
+        changed = set()
+        while True:
+            select.select([self.fd], [], [], None if not changed else delay)
+            events = self.read_events()
+            if events is None:
+                return None
+            if not events and changed:
+                return changed
+            changed.update(events)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class PollingWatcher(Watcher):
+    def __init__(self, interval=1.0):
+        Watcher.__init__(self)
+        self.interval = interval
+        self.state = None
+
+    def snapshot(self):
+        state = {}
+        for tree in self.trees:
+            for root, dirs, files in os.walk(tree):
+                for name in [""] + dirs + files:
+                    path = os.path.join(root, name) if name else root
+                    try:
+                        st = os.lstat(path)
+                    except OSError:
+                        continue
+                    state[path] = (st.st_mode, st.st_size, st.st_mtime_ns, st.st_ino)
+        for directory, names in self.files.items():
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                state[path] = (st.st_mode, st.st_size, st.st_mtime_ns, st.st_ino)
+        return state
+
+    def start(self):
+        self.state = self.snapshot()
+
+    def wait(self, delay=None):
+        if self.state is None:
+            self.start()
+        while True:
+            time.sleep(self.interval)
+            state = self.snapshot()
+            changed = set(path for path in set(state) | set(self.state) if state.get(path) != self.state.get(path))
+            self.state = state
+            if changed:
+                return changed
+
+def open_watcher():
+    """
+    Returns inotify watcher, polling one when inotify can't be used
+    """
+
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError) as e:
+        logger.warning("inotify not available ({0}), polling for changes".format(e))
+        return PollingWatcher()
@@ -0,0 +1,98 @@
+"""
+Readers of package formats used to check output of the native writers
+"""
+
+import gzip
+import lzma
+import struct
+import hashlib
+
+HEADER_MAGIC = b"\x8e\xad\xe8\x01\0\0\0\0"
+
+def read_ar(filename):
+    """
+    Returns [(name, mtime, data)] of members of ar archive
+    """
+    members = []
+    with open(filename, "rb") as f:
+        assert f.read(8) == b"!<arch>\n"
+        while True:
+            header = f.read(60)
+            if not header:
+                return members
+            assert header[58:60] == b"`\n"
+            name = header[:16].decode().strip().rstrip("/")
+            size = int(header[48:58])
+            members.append((name, int(header[16:28]), f.read(size)))
+            if size % 2:
+                assert f.read(1) == b"\n"
+
+def read_header(data, offset, region):
+    """
+    Returns ({tag: value}, end offset) of RPM header at offset
+    """
+    assert data[offset:offset + 8] == HEADER_MAGIC
+    count, size = struct.unpack(">II", data[offset + 8:offset + 16])
+    store = offset + 16 + count * 16
+    entries = [struct.unpack(">iIiI", data[offset + 16 + i * 16:offset + 32 + i * 16]) for i in range(count)]
+    assert entries[0][0] == region
+
+    tags = {}
+    for tag, kind, start, items in entries[1:]:
+        start += store
+        if kind in (3, 4, 5):
+            width, code = {3: (2, "H"), 4: (4, "I"), 5: (8, "Q")}[kind]
+            assert start % width == 0
+            tags[tag] = list(struct.unpack(">{0}{1}".format(items, code), data[start:start + items * width]))
+        elif kind == 7:
+            tags[tag] = data[start:start + items]
+        else:
+            values = []
+            for i in range(items):
+                end = data.index(b"\0", start)
+                values.append(data[start:end].decode())
+                start = end + 1
+            tags[tag] = values[0] if kind == 6 else values
+    return tags, store + size
+
+def read_rpm(filename):
+    """
+    Returns (signature, header, uncompressed payload) of RPM package,
+    digests of the signature are checked
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+    assert data[:4] == b"\xed\xab\xee\xdb"
+
+    signature, end = read_header(data, 96, 62)
+    end += -end % 8
+    header, payload_start = read_header(data, end, 63)
+    header_data, payload = data[end:payload_start], data[payload_start:]
+
+    assert hashlib.md5(header_data + payload).digest() == signature[1004]
+    assert hashlib.sha256(header_data).hexdigest() == signature[273]
+    assert signature[1000] == [len(header_data) + len(payload)]
+    assert hashlib.sha256(payload).hexdigest() == header[5092][0]
+
+    compressor = header[1125]
+    raw = gzip.decompress(payload) if compressor == "gzip" else lzma.decompress(payload)
+    assert signature[1007] == [len(raw)]
+    return signature, header, raw
+
+def read_cpio(data):
+    """
+    Returns [(name, mode, mtime, data)] of entries of newc cpio archive
+    """
+    entries = []
+    offset = 0
+    while True:
+        assert data[offset:offset + 6] == b"070701"
+        fields = [int(data[offset + 6 + i * 8:offset + 14 + i * 8], 16) for i in range(13)]
+        mode, mtime, size, namesize = fields[1], fields[5], fields[6], fields[11]
+        start = offset + 110
+        name = data[start:start + namesize - 1].decode()
+        start += namesize + (-(110 + namesize) % 4)
+        if name == "TRAILER!!!":
+            return entries
+        entries.append((name, mode, mtime, data[start:start + size]))
+        offset = start + size + (-size % 4)
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# Modules of repacked import each other by their plain names
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "repacked")
+sys.path.insert(0, os.path.join(root, "plugins"))
+sys.path.insert(0, root)
+
+@pytest.fixture(autouse=True)
+def cache_dirs(tmp_path, monkeypatch):
+    """
+    Caches of parsed specs and digests are kept in the test directory
+    """
+    import specs
+    import digests
+    monkeypatch.setattr(specs, "cache_dir", str(tmp_path / "specs-cache"))
+    monkeypatch.setattr(specs, "memory_cache", {})
+    monkeypatch.setattr(digests, "cache_path", str(tmp_path / "digests.sqlite"))
+    monkeypatch.setattr(digests, "caches", {})
@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+from artifacts import ArtifactStore
+
+@pytest.fixture
+def store(tmp_path):
+    (tmp_path / "out").mkdir()
+    return ArtifactStore(str(tmp_path / "out"))
+
+def build(store, filename, content):
+    path = os.path.join(store.output_dir, filename)
+    store.release(filename)
+    with open(path, "wb") as f:
+        f.write(content)
+    return store.add(filename)
+
+def stored(store):
+    return sorted(digest for digest, path in store.objects())
+
+def test_identical_packages_are_stored_once(store):
+    first = build(store, "demo_1.0-1_all.deb", b"package")
+    second = build(store, "demo-dev_1.0-1_all.deb", b"package")
+    assert first == second
+    assert stored(store) == [first]
+    assert os.path.samefile(os.path.join(store.output_dir, "demo_1.0-1_all.deb"), store.path(first))
+    assert os.path.samefile(os.path.join(store.output_dir, "demo-dev_1.0-1_all.deb"), store.path(first))
+
+def test_rebuild_keeps_stored_object(store):
+    old = build(store, "demo.deb", b"old")
+    new = build(store, "demo.deb", b"new")
+    with open(store.path(old), "rb") as f:
+        assert f.read() == b"old"
+    assert stored(store) == sorted([old, new])
+
+def test_collect_removes_packages_not_kept(store):
+    old = build(store, "demo_1.0-1_all.deb", b"old")
+    new = build(store, "demo_1.0-2_all.deb", b"new")
+    removed, size = store.collect({new})
+    assert (removed, size) == (1, 3)
+    assert stored(store) == [new]
+    assert sorted(os.listdir(store.output_dir)) == [".artifacts", "demo_1.0-2_all.deb"]
+
+def test_collect_keeps_moved_packages(store, tmp_path):
+    # Kept packages stay in the store when no name links to them anymore
+    kept = build(store, "demo_1.0-1_all.deb", b"kept")
+    orphan = build(store, "demo_1.0-2_all.deb", b"orphan")
+    os.rename(os.path.join(store.output_dir, "demo_1.0-1_all.deb"), str(tmp_path / "moved.deb"))
+    os.unlink(os.path.join(store.output_dir, "demo_1.0-2_all.deb"))
+    assert store.collect({kept}) == (1, 6)
+    assert stored(store) == [kept]
+
+def test_collect_ignores_unmanaged_files(store):
+    kept = build(store, "demo.deb", b"kept")
+    with open(os.path.join(store.output_dir, "other.deb"), "wb") as f:
+        f.write(b"other")
+    assert store.collect(set()) == (1, 4)
+    assert sorted(os.listdir(store.output_dir)) == [".artifacts", "other.deb"]
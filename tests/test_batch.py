@@ -0,0 +1,90 @@
+import os
+import types
+
+import pytest
+
+import repacked
+from repacked import build_batch, find_specs, option_parser
+
+SPEC = """
+name: {0}
+version: 1.0
+release: 1
+maintainer: Jane Doe <jane@example.com>
+summary: Demo package
+description: Demo package
+packagetree: tree
+packages:
+  - package: debian
+    architecture: all
+"""
+
+@pytest.fixture
+def spec_dir(tmp_path):
+    spec_dir = tmp_path / "specs"
+    for name in ["first", "broken", "failed", os.path.join("nested", "third")]:
+        (spec_dir / name).mkdir(parents=True)
+        (spec_dir / name / "packagespec").write_text("name: {0}\n".format(os.path.basename(name)))
+    (spec_dir / "empty").mkdir()
+    return spec_dir
+
+@pytest.fixture
+def built(tmp_path, monkeypatch):
+    """
+    Replaces build_spec, every build is written into a file, also by
+    forked workers
+    """
+    log = tmp_path / "built"
+
+    def build_spec(specfile, options, version_db=None):
+        name = os.path.basename(os.getcwd())
+        with open(str(log), "a") as f:
+            f.write("{0} {1} {2}\n".format(name, specfile, options.outputdir))
+        if name == "broken":
+            raise SystemExit(1)
+        return (["debian"] if name == "failed" else []), {name + "_version": "1.0"}
+
+    monkeypatch.setattr(repacked, "build_spec", build_spec)
+    return lambda: sorted(log.read_text().splitlines())
+
+def test_find_specs(spec_dir):
+    assert find_specs(str(spec_dir)) == [os.path.join(str(spec_dir), name, "packagespec")
+        for name in ["broken", "failed", "first", "nested/third"]]
+
+@pytest.mark.parametrize("batch_jobs", [1, 2])
+def test_build_batch(spec_dir, built, tmp_path, monkeypatch, batch_jobs):
+    monkeypatch.chdir(str(tmp_path))
+    options = types.SimpleNamespace(outputdir="out", log_dir=None, batch_jobs=batch_jobs)
+    specfiles = find_specs(str(spec_dir))
+    assert sorted(build_batch(specfiles, options)) == specfiles[:2]
+    assert os.getcwd() == str(tmp_path)
+
+    # Specs are built from their own directories, output goes to the same place
+    out = str(tmp_path / "out")
+    assert built() == ["{0} packagespec {1}".format(name, out) for name in ["broken", "failed", "first", "third"]]
+
+@pytest.fixture
+def package_specs(tmp_path, monkeypatch):
+    monkeypatch.setattr(repacked, "plugin_dir", os.path.join(os.path.dirname(repacked.__file__), "plugins"))
+    monkeypatch.setattr(repacked, "plugin_index_path", str(tmp_path / "plugin-index.json"))
+    monkeypatch.setattr(repacked, "pkg_plugins", {})
+    repacked.load_plugins(["debian"])
+    spec_dir = tmp_path / "packages"
+    for name in ["first", "second", os.path.join("nested", "third")]:
+        (spec_dir / name / "tree" / "etc").mkdir(parents=True)
+        (spec_dir / name / "tree" / "etc" / "demo.conf").write_text(name)
+        (spec_dir / name / "packagespec").write_text(SPEC.format(os.path.basename(name)))
+    # A broken packagespec doesn't stop the others
+    (spec_dir / "broken").mkdir()
+    (spec_dir / "broken" / "packagespec").write_text("name: [broken\n")
+    return spec_dir
+
+@pytest.mark.parametrize("batch_jobs", [1, 2])
+def test_build_batch_packages(package_specs, tmp_path, monkeypatch, batch_jobs):
+    monkeypatch.chdir(str(tmp_path))
+    options, args = option_parser().parse_args(["--outputdir", "out", "--pkg-format", "debian",
+        "--deb-builder", "native", "--staging", "none", "--batch-jobs", str(batch_jobs)])
+    specfiles = find_specs(str(package_specs))
+    assert build_batch(specfiles, options) == [specfiles[0]]
+    assert os.getcwd() == str(tmp_path)
+    assert sorted(os.listdir(str(tmp_path / "out"))) == ["first_1.0-1_all.deb", "second_1.0-1_all.deb", "third_1.0-1_all.deb"]
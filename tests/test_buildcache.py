@@ -0,0 +1,97 @@
+import os
+import types
+import shutil
+
+import pytest
+
+import debian
+import repacked
+import treeindex
+from repacked import Configuration
+from buildcache import BuildCache
+from specs import load_spec
+
+SPEC = """
+name: demo
+version: 1.0
+release: 1
+maintainer: Jane Doe <jane@example.com>
+summary: Demo package
+description: Demo package
+packagetree: {0}
+packages:
+  - package: debian
+    architecture: all
+"""
+
+@pytest.fixture
+def spec(tmp_path):
+    tree = tmp_path / "tree"
+    (tree / "etc").mkdir(parents=True)
+    (tree / "etc" / "demo.conf").write_text("setting = 1\n")
+    specfile = tmp_path / "packagespec"
+    specfile.write_text(SPEC.format(tree))
+    return load_spec(str(specfile))
+
+def configure(spec, tmp_path, output_dir):
+    config = Configuration()
+    config.output_dir = str(tmp_path / output_dir)
+    config.version = spec['version']
+    config.release = spec['release']
+    config.deb_builder = "native"
+    config.build_cache = BuildCache(str(tmp_path / "cache"))
+    return config
+
+def build(spec, config):
+    """
+    Returns filename of the package and whether it was built
+    """
+    plugin = debian.DebianPackager()
+    built = []
+    build = plugin.build
+    plugin.build = lambda *args: built.append(build(*args))
+    builder = types.SimpleNamespace(name="debian", plugin_object=plugin)
+    directory, filename = repacked.build_package(spec, config, spec['packages'][0], builder)
+    if directory:
+        shutil.rmtree(directory)
+    return filename, bool(built)
+
+def key(spec, config):
+    return config.build_cache.key(spec, spec['packages'][0], config, "debian", "all", None)
+
+def test_key(spec, tmp_path):
+    config = configure(spec, tmp_path, "out")
+    first = key(spec, config)
+    assert key(spec, config) == first
+
+    config.release = "2"
+    assert key(spec, config) != first
+    config.release = spec['release']
+
+    # Content of packagetree is part of the key
+    with open(os.path.join(spec['packagetree'], "etc", "demo.conf"), "a") as f:
+        f.write("setting = 2\n")
+    treeindex.clear_indexes()
+    assert key(spec, config) != first
+
+def test_miss_then_hit(spec, tmp_path):
+    config = configure(spec, tmp_path, "out")
+    filename, built = build(spec, config)
+    assert built
+    with open(os.path.join(config.output_dir, filename), "rb") as f:
+        content = f.read()
+
+    # Nothing changed, the package is taken from the cache
+    assert build(spec, config) == (filename, False)
+
+    # Cached package is placed also into an output directory not created yet
+    config = configure(spec, tmp_path, "new/out")
+    assert build(spec, config) == (filename, False)
+    with open(os.path.join(config.output_dir, filename), "rb") as f:
+        assert f.read() == content
+
+def test_rebuild_after_change(spec, tmp_path):
+    config = configure(spec, tmp_path, "out")
+    build(spec, config)
+    config.release = "2"
+    assert build(spec, config) == ("demo_1.0-2_all.deb", True)
@@ -0,0 +1,77 @@
+import io
+import os
+import gzip
+import lzma
+import shutil
+import subprocess
+
+import pytest
+
+import compression
+from compression import open_compressor, XzBlockCompressor, GzipBlockCompressor
+
+def payload(size):
+    # Compressible data with some noise, blocks don't compress to nothing
+    chunk = os.urandom(4096) + b"repacked " * 1024
+    return (chunk * (size // len(chunk) + 1))[:size]
+
+def compress(compressor_class, data, block_size, level=0, threads=4, writes=70001):
+    out = io.BytesIO()
+    compressor = compressor_class(out, level, threads)
+    compressor.block_size = block_size
+    for offset in range(0, len(data), writes):
+        compressor.write(data[offset:offset + writes])
+    compressor.close()
+    return out.getvalue(), compressor.blocks
+
+def test_xz_varint():
+    for value in [0, 1, 127, 128, 300, 1 << 20, (1 << 35) + 5]:
+        encoded = compression.xz_varint(value)
+        assert compression.xz_read_varint(encoded, 0) == (value, len(encoded))
+
+@pytest.mark.parametrize("size", [0, 1, 100000, 100001, 1000000])
+def test_xz_multi_block(size):
+    data = payload(size)
+    compressed, blocks = compress(XzBlockCompressor, data, 100000)
+    assert blocks == max(1, -(-size // 100000))
+    # One stream: lzma reads the whole thing and validates index and checks
+    assert lzma.decompress(compressed, format=lzma.FORMAT_XZ) == data
+    assert compressed.count(compression.XZ_MAGIC) == 1
+
+@pytest.mark.skipif(shutil.which("xz") is None, reason="xz is not installed")
+def test_xz_tool_lists_blocks(tmp_path):
+    data = payload(1000000)
+    compressed, blocks = compress(XzBlockCompressor, data, 100000)
+    filename = tmp_path / "payload.xz"
+    filename.write_bytes(compressed)
+    listing = subprocess.check_output(["xz", "--robot", "--list", str(filename)]).decode()
+    totals = [line.split("\t") for line in listing.splitlines() if line.startswith("totals")][0]
+    assert (int(totals[1]), int(totals[2])) == (1, blocks)
+    assert subprocess.check_output(["xz", "-dc", str(filename)]) == data
+
+def test_gzip_members():
+    data = payload(500000)
+    compressed, blocks = compress(GzipBlockCompressor, data, 100000, level=6)
+    assert blocks == 5
+    assert gzip.decompress(compressed) == data
+
+@pytest.mark.parametrize("codec", ["gzip", "xz"])
+def test_stable_output(codec):
+    # Stable output doesn't depend on the number of threads
+    data = payload(300000)
+    outputs = []
+    for threads in [1, 2, 4]:
+        out = io.BytesIO()
+        compressor = open_compressor(out, codec, 1, threads, stable=True)
+        compressor.write(data)
+        compressor.close()
+        outputs.append(out.getvalue())
+    assert outputs[0] == outputs[1] == outputs[2]
+    assert (gzip.decompress if codec == "gzip" else lzma.decompress)(outputs[0]) == data
+
+def test_check_settings():
+    assert compression.check_settings("xz", 9) is None
+    assert compression.check_settings(None, None) is None
+    assert "not supported" in compression.check_settings("bzip2", None)
+    assert "out of range" in compression.check_settings("gzip", 0)
+    assert "not a number" in compression.check_settings("xz", "fast")
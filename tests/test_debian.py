@@ -0,0 +1,74 @@
+import io
+import os
+import tarfile
+
+import debian
+from repacked import Configuration
+from specs import load_spec
+from archives import read_ar
+
+SPEC = """
+name: demo
+version: 1.0
+release: 1
+maintainer: Jane Doe <jane@example.com>
+summary: Demo package
+description: |
+  first line
+  second: line
+
+  third paragraph
+packages:
+  - package: debian
+    architecture: all
+"""
+
+def parse_control(text):
+    """
+    Parses control file like dpkg does, every line has to be a field or
+    a continuation line starting with a space
+    """
+    fields = {}
+    field = None
+    for line in text.splitlines():
+        if line.startswith(" "):
+            assert field is not None, line
+            fields[field] += "\n" + line
+            continue
+        name, sep, value = line.partition(":")
+        assert sep and name and " " not in name, "field {0!r} must be followed by colon".format(line)
+        field = name
+        fields[field] = value.strip()
+    return fields
+
+def build_package(tmp_path):
+    specfile = tmp_path / "packagespec"
+    specfile.write_text(SPEC)
+    spec = load_spec(str(specfile))
+
+    config = Configuration()
+    config.output_dir = str(tmp_path)
+    config.version = spec['version']
+    config.release = spec['release']
+    config.staging_mode = "none"
+    config.deb_builder = "native"
+
+    plugin = debian.DebianPackager()
+    package = spec['packages'][0]
+    directory = plugin.tree(spec, package, config)
+    filename = plugin.filenamegen(package, config)
+    plugin.build(directory, filename, config)
+    return os.path.join(str(tmp_path), filename)
+
+def test_format_description():
+    plugin = debian.DebianPackager()
+    assert plugin.format_description("one\ntwo\n\n  three  \n") == "one\n two\n .\n   three"
+
+def test_control_description(tmp_path):
+    members = dict((name, data) for name, mtime, data in read_ar(build_package(tmp_path)))
+    with tarfile.open(fileobj=io.BytesIO(members["control.tar.gz"])) as tar:
+        control = tar.extractfile("./control").read().decode()
+
+    fields = parse_control(control)
+    assert fields["Package"] == "demo"
+    assert fields["Description"] == "Demo package\n .\n first line\n second: line\n .\n third paragraph"
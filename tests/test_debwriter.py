@@ -0,0 +1,120 @@
+import io
+import os
+import shutil
+import socket
+import tarfile
+import subprocess
+
+import pytest
+
+from debwriter import DebWriter
+from archives import read_ar
+
+EPOCH = 1700000000
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "tree"
+    (root / "DEBIAN").mkdir(parents=True)
+    (root / "DEBIAN" / "control").write_text("Package: demo\nVersion: 1.0-1\nArchitecture: all\n"
+        "Maintainer: Jane Doe <jane@example.com>\nDescription: Demo\n")
+    (root / "DEBIAN" / "postinst").write_text("#!/bin/sh\n")
+    os.chmod(str(root / "DEBIAN" / "postinst"), 0o755)
+    (root / "usr" / "bin").mkdir(parents=True)
+    (root / "usr" / "bin" / "hello").write_bytes(b"#!/bin/sh\necho hello\n")
+    os.chmod(str(root / "usr" / "bin" / "hello"), 0o755)
+    (root / "etc").mkdir()
+    (root / "etc" / "demo.conf").write_bytes(os.urandom(100000))
+    os.symlink("hello", str(root / "usr" / "bin" / "hi"))
+    return root
+
+def members(filename):
+    return dict((name, data) for name, mtime, data in read_ar(filename))
+
+def tar_entries(data):
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        return dict((info.name, (info, tar.extractfile(info).read() if info.isfile() else None)) for info in tar)
+
+def test_layout(tree, tmp_path):
+    filename = str(tmp_path / "demo.deb")
+    DebWriter(filename).write(str(tree / "DEBIAN"), str(tree))
+
+    assert [name for name, mtime, data in read_ar(filename)] == ["debian-binary", "control.tar.gz", "data.tar.xz"]
+    archive = members(filename)
+    assert archive["debian-binary"] == b"2.0\n"
+
+    control = tar_entries(archive["control.tar.gz"])
+    assert sorted(control) == [".", "./control", "./postinst"]
+    assert control["./postinst"][0].mode == 0o755
+    assert control["./control"][0].mode == 0o644
+
+    data = tar_entries(archive["data.tar.xz"])
+    assert sorted(data) == [".", "./etc", "./etc/demo.conf", "./usr", "./usr/bin", "./usr/bin/hello", "./usr/bin/hi"]
+    assert data["./etc/demo.conf"][1] == (tree / "etc" / "demo.conf").read_bytes()
+    assert data["./usr/bin/hello"][0].mode == 0o755
+    assert data["./usr/bin/hi"][0].issym() and data["./usr/bin/hi"][0].linkname == "hello"
+    assert all(info.uid == 0 and info.gid == 0 and info.uname == "root" for info, content in data.values())
+
+@pytest.mark.parametrize("compression", ["gzip", "xz"])
+def test_reproducible(tree, tmp_path, compression):
+    first = str(tmp_path / "first.deb")
+    second = str(tmp_path / "second.deb")
+    DebWriter(first, compression, source_date_epoch=EPOCH, threads=1).write(str(tree / "DEBIAN"), str(tree))
+    os.utime(str(tree / "etc" / "demo.conf"))
+    DebWriter(second, compression, source_date_epoch=EPOCH, threads=4).write(str(tree / "DEBIAN"), str(tree))
+
+    with open(first, "rb") as f1, open(second, "rb") as f2:
+        assert f1.read() == f2.read()
+    assert all(mtime == EPOCH for name, mtime, data in read_ar(first))
+
+def test_stream_matches_tree(tree, tmp_path):
+    # Control files from memory give the same package as the DEBIAN directory
+    control_files = [
+        ("postinst", (tree / "DEBIAN" / "postinst").read_bytes(), 0o755),
+        ("control", (tree / "DEBIAN" / "control").read_bytes(), 0o644),
+    ]
+    shutil.move(str(tree / "DEBIAN"), str(tmp_path / "DEBIAN"))
+    written = str(tmp_path / "written.deb")
+    streamed = str(tmp_path / "streamed.deb")
+    DebWriter(written, source_date_epoch=EPOCH).write(str(tmp_path / "DEBIAN"), str(tree))
+    DebWriter(streamed, source_date_epoch=EPOCH).write_stream(control_files, str(tree))
+
+    with open(written, "rb") as f1, open(streamed, "rb") as f2:
+        assert f1.read() == f2.read()
+
+@pytest.mark.parametrize("compression", ["gzip", "xz"])
+def test_parallel_compression(tree, tmp_path, compression):
+    filename = str(tmp_path / "demo.deb")
+    DebWriter(filename, compression, level=1, threads=4).write(str(tree / "DEBIAN"), str(tree))
+
+    suffix = {"gzip": "gz", "xz": "xz"}[compression]
+    assert [name for name, mtime, data in read_ar(filename)] == ["debian-binary", "control.tar.gz", "data.tar." + suffix]
+    data = tar_entries(members(filename)["data.tar." + suffix])
+    assert data["./etc/demo.conf"][1] == (tree / "etc" / "demo.conf").read_bytes()
+
+def test_output_directory_is_created(tree, tmp_path):
+    filename = str(tmp_path / "new" / "out" / "demo.deb")
+    DebWriter(filename).write(str(tree / "DEBIAN"), str(tree))
+    assert os.listdir(str(tmp_path / "new" / "out")) == ["demo.deb"]
+
+@pytest.mark.skipif(shutil.which("dpkg-deb") is None, reason="dpkg-deb is not installed")
+def test_dpkg_deb_reads_package(tree, tmp_path):
+    filename = str(tmp_path / "demo.deb")
+    DebWriter(filename).write(str(tree / "DEBIAN"), str(tree))
+
+    assert subprocess.check_output(["dpkg-deb", "-f", filename, "Package"]) == b"demo\n"
+    extracted = tmp_path / "extracted"
+    subprocess.check_call(["dpkg-deb", "-x", filename, str(extracted)])
+    assert (extracted / "etc" / "demo.conf").read_bytes() == (tree / "etc" / "demo.conf").read_bytes()
+
+def test_sockets_are_skipped(tree, tmp_path):
+    sock = socket.socket(socket.AF_UNIX)
+    sock.bind(str(tree / "etc" / "demo.sock"))
+    os.mkfifo(str(tree / "etc" / "demo.fifo"))
+    filename = str(tmp_path / "demo.deb")
+    DebWriter(filename).write(str(tree / "DEBIAN"), str(tree))
+    sock.close()
+
+    data = tar_entries(members(filename)["data.tar.xz"])
+    assert "./etc/demo.sock" not in data
+    assert data["./etc/demo.fifo"][0].isfifo()
@@ -0,0 +1,34 @@
+import os
+import hashlib
+
+import digests
+from treeindex import TreeIndex
+
+def test_hash_small_file(tmp_path):
+    path = tmp_path / "small"
+    path.write_bytes(b"hello\n")
+    assert digests.hash_file(str(path), 6) == (hashlib.md5(b"hello\n").hexdigest(), hashlib.sha256(b"hello\n").hexdigest())
+
+def test_hash_mapped_file(tmp_path):
+    # Files from MMAP_THRESHOLD up are hashed through mmap
+    data = bytes(range(256)) * ((digests.MMAP_THRESHOLD + digests.CHUNK_SIZE * 8 + 1000) // 256)
+    path = tmp_path / "large"
+    path.write_bytes(data)
+    assert digests.hash_file(str(path), len(data)) == (hashlib.md5(data).hexdigest(), hashlib.sha256(data).hexdigest())
+
+def test_tree_digests_are_cached(tmp_path, monkeypatch):
+    root = tmp_path / "tree"
+    (root / "etc").mkdir(parents=True)
+    (root / "etc" / "old.conf").write_bytes(b"old\n")
+    (root / "etc" / "new.conf").write_bytes(b"new\n")
+    # Files changed just now could change again within the same mtime, they aren't cached
+    os.utime(str(root / "etc" / "old.conf"), (1000000000, 1000000000))
+    expected = dict((name, (hashlib.md5(data).hexdigest(), hashlib.sha256(data).hexdigest()))
+        for name, data in [("etc/old.conf", b"old\n"), ("etc/new.conf", b"new\n")])
+    assert digests.tree_digests(TreeIndex(str(root))) == expected
+
+    hashed = []
+    hash_file = digests.hash_file
+    monkeypatch.setattr(digests, "hash_file", lambda path, size: hashed.append(path) or hash_file(path, size))
+    assert digests.tree_digests(TreeIndex(str(root))) == expected
+    assert hashed == [str(root / "etc" / "new.conf")]
@@ -0,0 +1,107 @@
+import os
+import time
+import hashlib
+import threading
+
+import pytest
+
+import distributed
+from distributed import Job, DistributedError, TransportError, run_jobs
+
+def fake_run_job(address, job, output_dir, timeout=None):
+    job.worker = address
+    job.error = None
+    if address == "down":
+        # Unreachable worker notices it only after the others ran out of jobs
+        time.sleep(0.2)
+        raise TransportError("Worker down failed")
+    time.sleep(0.05)
+    job.filename = job.name
+
+def test_job_of_unreachable_worker_is_built_by_another(monkeypatch):
+    monkeypatch.setattr(distributed, "run_job", fake_run_job)
+    jobs = [Job("first", {}, {}), Job("second", {}, {})]
+    run_jobs(["up", "down"], jobs, "/nonexistent")
+
+    assert [(job.filename, job.worker, job.error) for job in jobs] == [("first", "up", None), ("second", "up", None)]
+
+def test_jobs_fail_when_no_worker_is_reachable(monkeypatch):
+    monkeypatch.setattr(distributed, "run_job", fake_run_job)
+    jobs = [Job("first", {}, {})]
+    run_jobs(["down"], jobs, "/nonexistent")
+
+    assert jobs[0].filename is None
+    assert jobs[0].error == "Worker down failed"
+
+@pytest.fixture
+def worker(tmp_path):
+    """
+    Address of a worker whose builds write the job name into a package
+    """
+    def build(job, tree, scripts, output_dir):
+        filename = job["name"] + ".deb"
+        with open(os.path.join(output_dir, filename), "w") as f:
+            f.write(job["name"])
+        return filename
+
+    address = str(tmp_path / "worker.sock")
+    server = distributed.UnixWorkerServer(address, distributed.WorkerHandler)
+    server.worker = distributed.Worker(str(tmp_path / "store"), build)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield address
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+def remote_job(name):
+    return Job(name, {"action": "build", "job": {"name": name}, "manifest": [], "scripts": {}}, {})
+
+def test_package_is_written_into_new_output_directory(worker, tmp_path):
+    output_dir = tmp_path / "out" / "d1"
+    jobs = [remote_job("first"), remote_job("second")]
+    run_jobs([worker], jobs, str(output_dir))
+
+    assert [(job.filename, job.error) for job in jobs] == [("first.deb", None), ("second.deb", None)]
+    assert sorted(os.listdir(str(output_dir))) == ["first.deb", "second.deb"]
+    assert (output_dir / "first.deb").read_text() == "first"
+    # Digest of the package comes with the transfer
+    assert jobs[0].digest == hashlib.sha256(b"first").hexdigest()
+
+def test_local_errors_keep_worker_in_use(worker, tmp_path):
+    # Output directory can't be created, the worker is still used for the next job
+    blocked = tmp_path / "file"
+    blocked.write_text("")
+    job = remote_job("first")
+    with pytest.raises(DistributedError):
+        distributed.run_job(worker, job, str(blocked / "out"))
+
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    (output_dir / "second.deb.tmp").mkdir()
+    jobs = [remote_job("second"), remote_job("third")]
+    run_jobs([worker], jobs, str(output_dir))
+    assert jobs[0].filename is None and "Can't write" in jobs[0].error
+    assert (jobs[1].filename, jobs[1].error) == ("third.deb", None)
+
+def test_materialize_refuses_paths_through_symlinks(tmp_path):
+    store = distributed.BlobStore(str(tmp_path / "store"))
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    manifest = [
+        ["x", distributed.SYMLINK, 0o777, 0, 0, str(outside), None],
+        ["x/foo", distributed.DIRECTORY, 0o755, 0, 0, None, None],
+    ]
+    with pytest.raises(DistributedError):
+        store.materialize(manifest, str(tmp_path / "tree"))
+    assert os.listdir(str(outside)) == []
+
+def test_materialize(tmp_path):
+    store = distributed.BlobStore(str(tmp_path / "store"))
+    manifest = [
+        ["usr", distributed.DIRECTORY, 0o755, 0, 0, None, None],
+        ["usr/lib", distributed.DIRECTORY, 0o755, 0, 0, None, None],
+        ["lib", distributed.SYMLINK, 0o777, 0, 0, "usr/lib", None],
+    ]
+    store.materialize(manifest, str(tmp_path / "tree"))
+    assert os.readlink(str(tmp_path / "tree" / "lib")) == "usr/lib"
@@ -0,0 +1,65 @@
+import random
+import fnmatch
+
+import pytest
+
+from excludes import ExcludeRules
+
+def reference_match(pattern, path):
+    """
+    Matches path components one by one, "**" takes any number of them
+    """
+    def match(parts, components):
+        if not parts:
+            return not components
+        if parts[0] == "**":
+            return any(match(parts[1:], components[i:]) for i in range(len(components) + 1))
+        return bool(components) and fnmatch.fnmatchcase(components[0], parts[0]) and match(parts[1:], components[1:])
+    return match(pattern.strip("/").split("/"), path.strip("/").split("/"))
+
+@pytest.mark.parametrize("pattern, path, excluded", [
+    ("/usr/share/doc", "/usr/share/doc", True),
+    ("/usr/share/doc", "/usr/share/doc/demo", False),
+    ("usr/share/doc/", "/usr/share/doc", True),
+    ("/usr/share/*", "/usr/share/doc", True),
+    ("/usr/share/*", "/usr/share/doc/demo", False),
+    ("/usr/share/doc/**", "/usr/share/doc", True),
+    ("/usr/share/doc/**", "/usr/share/doc/demo/examples", True),
+    ("/usr/**/doc", "/usr/doc", True),
+    ("/usr/**/doc", "/usr/local/share/doc", True),
+    ("/usr/**/doc", "/usr/local/share/docs", False),
+    ("/opt/app-?", "/opt/app-1", True),
+    ("/opt/app-?", "/opt/app-10", False),
+    ("/opt/[ab]*", "/opt/beta", True),
+    ("/opt/[ab]*", "/opt/cache", False),
+    ("/var/*/log", "/var/lib/log", True),
+    ("/var/*/log", "/var/log", False),
+])
+def test_match(pattern, path, excluded):
+    assert ExcludeRules([pattern]).match(path) == excluded
+
+def test_empty():
+    assert not ExcludeRules(None)
+    assert not ExcludeRules([]).match("/usr")
+    assert ExcludeRules(["/usr"])
+
+def test_walk_matches_reference():
+    patterns = ["/usr/share/doc/**", "/usr/*/man", "/opt/**/cache", "/srv/data", "/etc/[xy]*"]
+    names = ["usr", "share", "doc", "local", "man", "opt", "app", "cache", "srv", "data", "etc", "xdg", "yum", "zz"]
+
+    rng = random.Random(1)
+    paths = set()
+    for i in range(2000):
+        paths.add("/" + "/".join(rng.choice(names) for j in range(rng.randint(1, 5))))
+
+    rules = ExcludeRules(patterns)
+    expected = dict((path, any(reference_match(p, path) for p in patterns)) for path in paths)
+
+    # Sorted order is a depth-first walk, cached states of parents are reused
+    for path in sorted(paths):
+        assert rules.match(path) == expected[path], path
+
+    shuffled = sorted(paths)
+    rng.shuffle(shuffled)
+    for path in shuffled:
+        assert rules.match(path) == expected[path], path
@@ -0,0 +1,78 @@
+import os
+import hashlib
+
+import pytest
+
+import fanout
+from fanout import Fanout, FanoutError
+from treeindex import TreeIndex
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    # Small chunks split the files into several pieces
+    monkeypatch.setattr(fanout, "CHUNK_SIZE", 1000)
+    root = tmp_path / "tree"
+    (root / "usr" / "share").mkdir(parents=True)
+    (root / "usr" / "share" / "big").write_bytes(os.urandom(25000))
+    (root / "usr" / "share" / "small").write_bytes(b"small\n")
+    (root / "usr" / "share" / "empty").write_bytes(b"")
+    os.symlink("big", str(root / "usr" / "share" / "link"))
+    return TreeIndex(str(root))
+
+def reader(consumer, result, read_size=-1):
+    def write():
+        for entry in consumer.fanout.files:
+            with consumer.open(os.path.join(consumer.fanout.root, entry.path)) as f:
+                if read_size is None:
+                    # Rest of the file is skipped
+                    result[entry.path] = f.read(10)
+                    continue
+                parts = []
+                while True:
+                    part = f.read(read_size)
+                    parts.append(part)
+                    if read_size < 0 or not part:
+                        break
+                result[entry.path] = b"".join(parts)
+    return write
+
+def test_every_writer_gets_all_files(index):
+    tree = Fanout(index)
+    results = [{}, {}, {}]
+    writers = []
+    for number, read_size in enumerate([-1, 333, None]):
+        consumer = tree.consumer(str(number))
+        writers.append((consumer, reader(consumer, results[number], read_size)))
+    tree.run(writers)
+
+    for entry in tree.files:
+        with open(os.path.join(index.root, entry.path), "rb") as f:
+            data = f.read()
+        assert results[0][entry.path] == results[1][entry.path] == data
+        assert results[2][entry.path] == data[:10]
+        assert tree.digests[entry.path] == (hashlib.md5(data).hexdigest(), hashlib.sha256(data).hexdigest())
+    assert tree.paths == ["usr", "usr/share", "usr/share/big", "usr/share/empty", "usr/share/link", "usr/share/small"]
+    assert index.digests == tree.digests
+
+def test_writer_errors_are_raised(index):
+    tree = Fanout(index)
+    result = {}
+    good = tree.consumer("good")
+
+    def broken():
+        raise ValueError("broken writer")
+
+    with pytest.raises(ValueError):
+        tree.run([(tree.consumer("broken"), broken), (good, reader(good, result))])
+    # The other writer isn't blocked by the failed one
+    assert len(result) == 3
+
+def test_files_are_taken_in_order(index):
+    tree = Fanout(index)
+    consumer = tree.consumer("unordered")
+
+    def write():
+        consumer.open(os.path.join(tree.root, "usr/share/small"))
+
+    with pytest.raises(FanoutError, match="unordered writer wants"):
+        tree.run([(consumer, write)])
@@ -0,0 +1,50 @@
+import time
+
+from hooks import Hook, check_hooks, run_hooks
+
+def shell(name, script, depends=(), timeout=None):
+    return Hook(name, ["sh", "-c", script], depends, timeout)
+
+def test_dependencies_are_respected(tmp_path):
+    log = tmp_path / "log"
+    hooks = [
+        shell("last", "echo last >> {0}".format(log), ["slow", "fast"]),
+        shell("slow", "sleep 0.3; echo slow >> {0}".format(log)),
+        shell("fast", "echo fast >> {0}".format(log)),
+    ]
+    started = time.time()
+    assert run_hooks(hooks) == []
+    # slow and fast run concurrently, last waits for both
+    assert log.read_text().split() == ["fast", "slow", "last"]
+    assert time.time() - started < 2
+    assert all(hook.returncode == 0 and hook.duration is not None for hook in hooks)
+
+def test_output_is_prefixed(capsys):
+    assert run_hooks([shell("greet", "echo hello; echo world")]) == []
+    assert capsys.readouterr().out == "[greet] hello\n[greet] world\n"
+
+def test_failures_skip_dependent_hooks(tmp_path):
+    hooks = [shell("broken", "exit 3"), shell("after", "touch {0}".format(tmp_path / "ran"), ["broken"]),
+        shell("other", "true")]
+    assert [hook.name for hook in run_hooks(hooks)] == ["broken", "after"]
+    assert hooks[0].returncode == 3
+    assert not (tmp_path / "ran").exists()
+    assert hooks[2].returncode == 0
+
+def test_timeout_kills_hook_and_its_children():
+    hook = shell("stuck", "sleep 30 & sleep 30; wait", timeout=0.3)
+    started = time.time()
+    assert run_hooks([hook]) == [hook]
+    assert hook.timed_out
+    assert time.time() - started < 10
+
+def test_missing_command():
+    hook = Hook("missing", ["/nonexistent/hook"])
+    assert run_hooks([hook]) == [hook]
+    assert hook.returncode == 127
+
+def test_check_hooks():
+    assert check_hooks([shell("a", "true"), shell("b", "true", ["a"])]) is None
+    assert check_hooks([shell("a", "true"), shell("a", "true")]) == "Hook names have to be unique"
+    assert check_hooks([shell("a", "true", ["c"])]) == "Hook a depends on unknown hook c"
+    assert check_hooks([shell("a", "true", ["b"]), shell("b", "true", ["a"])]) == "Hooks a, b have cyclic dependencies"
@@ -0,0 +1,56 @@
+import os
+import types
+
+import pytest
+
+import repacked
+from repacked import Configuration, build_packages
+from tools import ToolError
+
+class Packager:
+    """
+    Stands in for package format plugins, packages of format "broken" fail
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def tree(self, spec, package, config):
+        return os.path.join(config.output_dir, self.name + ".tree")
+
+    def filenamegen(self, package, config):
+        return "{0}.{1}".format(package['name'], self.name)
+
+    def build(self, directory, filename, config):
+        if self.name == "broken":
+            raise ToolError("{0} failed with exit status 2".format(self.name))
+        with open(os.path.join(config.output_dir, filename), "w") as f:
+            f.write(str(os.getpid()))
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    plugins = dict((name, types.SimpleNamespace(name=name, plugin_object=Packager(name))) for name in ["debian", "rpm", "broken"])
+    monkeypatch.setattr(repacked, "pkg_plugins", plugins)
+    config = Configuration()
+    config.output_dir = str(tmp_path)
+    config.version = "1.0"
+    config.release = "1"
+    return config
+
+def spec(*formats):
+    return {'name': "demo", 'packages': [{'package': name, 'name': "demo-{0}".format(index)} for index, name in enumerate(formats)]}
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_failed_builds(config, tmp_path, jobs):
+    config.jobs = jobs
+    tempdirs = build_packages(spec("debian", "broken", "rpm"), config)
+    assert sorted(tempdirs) == [str(tmp_path / "debian.tree"), str(tmp_path / "rpm.tree")]
+    assert len(config.failed_builds) == 1
+    assert sorted(os.listdir(str(tmp_path))) == (["demo-0.debian", "demo-2.rpm"] if jobs == 1 else ["demo-0.debian", "demo-2.rpm", "logs"])
+
+def test_jobs_run_in_workers(config, tmp_path):
+    config.jobs = 2
+    build_packages(spec("debian", "rpm"), config)
+    pids = set((tmp_path / name).read_text() for name in ["demo-0.debian", "demo-1.rpm"])
+    assert str(os.getpid()) not in pids
+    assert sorted(os.listdir(str(tmp_path / "logs"))) == ["demo-debian-0.log", "demo-rpm-1.log"]
@@ -0,0 +1,157 @@
+import io
+import os
+import json
+import hashlib
+import shutil
+import tarfile
+
+import pytest
+
+import debian
+import rpm
+import repacked
+from repacked import Configuration, load_plugins, read_plugin_index
+from specs import load_spec
+from archives import read_ar, read_rpm, read_cpio
+
+@pytest.fixture
+def plugin_dir(tmp_path, monkeypatch):
+    plugin_dir = str(tmp_path / "plugins")
+    shutil.copytree(os.path.join(os.path.dirname(repacked.__file__), "plugins"), plugin_dir,
+        ignore=shutil.ignore_patterns("__pycache__"))
+    monkeypatch.setattr(repacked, "plugin_dir", plugin_dir)
+    monkeypatch.setattr(repacked, "plugin_index_path", str(tmp_path / "plugin-index.json"))
+    monkeypatch.setattr(repacked, "pkg_plugins", {})
+    return plugin_dir
+
+def test_only_requested_plugins_are_loaded(plugin_dir):
+    load_plugins(["rpm"])
+    assert list(repacked.pkg_plugins) == ["rpm"]
+    # Index lists all plugins found by the scan
+    assert sorted(read_plugin_index()) == ["debian", "rpm"]
+
+    load_plugins()
+    assert sorted(repacked.pkg_plugins) == ["debian", "rpm"]
+    assert all(info.plugin_object is not None for info in repacked.pkg_plugins.values())
+
+def test_index_is_written_again_after_changes(plugin_dir):
+    load_plugins(["debian"])
+    assert read_plugin_index() is not None
+
+    os.utime(os.path.join(plugin_dir, "rpm.plugin"), ns=(0, 0))
+    assert read_plugin_index() is None
+    load_plugins(["debian"])
+    with open(repacked.plugin_index_path) as f:
+        assert json.load(f)['plugins']['rpm']['mtime_ns'] == 0
+
+SPEC = """
+name: demo
+version: 1.0
+release: 1
+maintainer: Jane Doe <jane@example.com>
+summary: Demo package
+description: Demo package
+packagetree: {0}
+packages:
+  - package: debian
+    architecture: all
+  - package: rpm
+    architecture: noarch
+"""
+
+@pytest.fixture
+def spec(tmp_path):
+    tree = tmp_path / "tree"
+    (tree / "usr" / "bin").mkdir(parents=True)
+    (tree / "usr" / "bin" / "hello").write_text("#!/bin/sh\necho hello\n")
+    os.chmod(str(tree / "usr" / "bin" / "hello"), 0o755)
+    (tree / "etc" / "demo").mkdir(parents=True)
+    (tree / "etc" / "demo" / "demo.conf").write_bytes(os.urandom(5000))
+    os.symlink("hello", str(tree / "usr" / "bin" / "hi"))
+    specfile = tmp_path / "packagespec"
+    specfile.write_text(SPEC.format(tree))
+    return load_spec(str(specfile))
+
+def package_entries(filename):
+    """
+    Returns {path: (mode, content)} of files of deb or rpm package
+    """
+    if filename.endswith(".deb"):
+        data = dict((name, data) for name, mtime, data in read_ar(filename))["data.tar.xz"]
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            return dict((info.name[1:] or "/", (info.mode, tar.extractfile(info).read() if info.isfile() else info.linkname))
+                for info in tar)
+    signature, header, payload = read_rpm(filename)
+    return dict((name[1:], (mode & 0o7777, data)) for name, mode, mtime, data in read_cpio(payload))
+
+@pytest.mark.parametrize("index", [0, 1])
+@pytest.mark.parametrize("preserve_symlinks", [False, True])
+def test_streamed_package_matches_copied_tree(spec, tmp_path, index, preserve_symlinks):
+    package = spec['packages'][index]
+    packagers = {"debian": debian.DebianPackager, "rpm": rpm.RPMPackager}
+    entries = []
+    directories = []
+    for staging_mode in ["none", "copy"]:
+        config = Configuration()
+        config.output_dir = str(tmp_path / staging_mode)
+        config.version = spec['version']
+        config.release = spec['release']
+        config.staging_mode = staging_mode
+        config.deb_builder = config.rpm_builder = "native"
+        config.preserve_symlinks = preserve_symlinks
+
+        plugin = packagers[package['package']]()
+        directory = plugin.tree(spec, package, config)
+        filename = plugin.filenamegen(package, config)
+        plugin.build(directory, filename, config)
+        if directory:
+            shutil.rmtree(directory)
+        directories.append(directory)
+        entries.append(package_entries(os.path.join(config.output_dir, filename)))
+
+    # Streamed package doesn't need a build tree
+    assert directories[0] is None and directories[1] is not None
+    assert entries[0] == entries[1]
+    hi = entries[0]["/usr/bin/hi"]
+    assert (hi[1] == (b"hello" if index else "hello")) == preserve_symlinks
+
+def test_md5sums(spec, tmp_path):
+    config = Configuration()
+    config.output_dir = str(tmp_path / "out")
+    config.version = spec['version']
+    config.release = spec['release']
+    config.staging_mode = "none"
+    config.deb_builder = "native"
+
+    plugin = debian.DebianPackager()
+    package = spec['packages'][0]
+    plugin.build(plugin.tree(spec, package, config), plugin.filenamegen(package, config), config)
+
+    control = dict((name, data) for name, mtime, data in read_ar(os.path.join(config.output_dir, "demo_1.0-1_all.deb")))["control.tar.gz"]
+    with tarfile.open(fileobj=io.BytesIO(control)) as tar:
+        md5sums = tar.extractfile("./md5sums").read().decode()
+    lines = []
+    # Symlinks are followed by default, hi is packaged as a file
+    for path in ["etc/demo/demo.conf", "usr/bin/hello", "usr/bin/hi"]:
+        with open(os.path.join(spec['packagetree'], path), "rb") as f:
+            lines.append("{0}  {1}\n".format(hashlib.md5(f.read()).hexdigest(), path))
+    assert md5sums == "".join(lines)
+
+def test_rpm_spec_file_list(spec, tmp_path):
+    config = Configuration()
+    config.output_dir = str(tmp_path / "out")
+    config.version = spec['version']
+    config.release = spec['release']
+    config.staging_mode = "copy"
+    config.rpm_builder = "rpmbuild"
+    config.preserve_symlinks = True
+
+    plugin = rpm.RPMPackager()
+    package = dict(spec['packages'][1], directory_exclude_list=["/etc", "/usr/**"])
+    directory = plugin.tree(spec, package, config)
+    with open(os.path.join(directory, "rpm.spec")) as f:
+        files = f.read().split("%files\n", 1)[1]
+    shutil.rmtree(directory)
+
+    # Excluded directories aren't owned by the package, their content is
+    assert files.splitlines() == ['%dir "/etc/demo"', '"/etc/demo/demo.conf"', '"/usr/bin/hello"', '"/usr/bin/hi"']
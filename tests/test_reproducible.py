@@ -0,0 +1,79 @@
+import os
+import shutil
+
+import pytest
+
+import debian
+import rpm
+from repacked import Configuration
+from staging import StagingArea
+from specs import load_spec
+
+EPOCH = 1700000000
+
+SPEC = """
+name: demo
+version: 1.0
+release: 1
+maintainer: Jane Doe <jane@example.com>
+summary: Demo package
+description: Demo package
+packagetree: {0}
+scripts:
+  postinst: {1}
+packages:
+  - package: debian
+    architecture: all
+  - package: rpm
+    architecture: noarch
+"""
+
+PLUGINS = {"debian": debian.DebianPackager, "rpm": rpm.RPMPackager}
+
+@pytest.fixture
+def spec(tmp_path):
+    tree = tmp_path / "tree"
+    (tree / "usr" / "bin").mkdir(parents=True)
+    (tree / "usr" / "bin" / "hello").write_text("#!/bin/sh\necho hello\n")
+    os.chmod(str(tree / "usr" / "bin" / "hello"), 0o755)
+    (tree / "etc" / "demo").mkdir(parents=True)
+    (tree / "etc" / "demo" / "demo.conf").write_bytes(os.urandom(50000))
+    os.symlink("hello", str(tree / "usr" / "bin" / "hi"))
+    script = tmp_path / "postinst"
+    script.write_text("#!/bin/sh\necho installed\n")
+    specfile = tmp_path / "packagespec"
+    specfile.write_text(SPEC.format(tree, script))
+    return load_spec(str(specfile))
+
+def build(spec, tmp_path, package, staging_mode, threads):
+    config = Configuration()
+    config.output_dir = str(tmp_path / "out-{0}-{1}".format(staging_mode, threads))
+    config.version = spec['version']
+    config.release = spec['release']
+    config.staging_mode = staging_mode
+    config.deb_builder = config.rpm_builder = "native"
+    config.compression = "xz"
+    config.compression_threads = threads
+    config.source_date_epoch = EPOCH
+    if staging_mode == "shared":
+        config.staging = StagingArea()
+
+    plugin = PLUGINS[package['package']]()
+    directory = plugin.tree(spec, package, config)
+    filename = plugin.filenamegen(package, config)
+    plugin.build(directory, filename, config)
+    for path in [directory] + (config.staging.directories() if config.staging else []):
+        if path:
+            shutil.rmtree(path)
+    with open(os.path.join(config.output_dir, filename), "rb") as f:
+        return f.read()
+
+@pytest.mark.parametrize("index", [0, 1])
+def test_staged_and_streamed_packages_are_identical(spec, tmp_path, index):
+    package = spec['packages'][index]
+    streamed = build(spec, tmp_path, package, "none", 1)
+    # Files touched later still get the same clamped times
+    os.utime(os.path.join(spec['packagetree'], "usr", "bin", "hello"))
+    assert build(spec, tmp_path, package, "none", 4) == streamed
+    assert build(spec, tmp_path, package, None, 2) == streamed
+    assert build(spec, tmp_path, package, "shared", 1) == streamed
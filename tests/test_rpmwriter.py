@@ -0,0 +1,85 @@
+import os
+import hashlib
+
+import pytest
+
+from rpmwriter import RPMWriter
+from archives import read_rpm, read_cpio
+
+EPOCH = 1700000000
+
+# Header tags checked by the tests
+NAME, VERSION, RELEASE, BUILDTIME, BUILDHOST = 1000, 1001, 1002, 1006, 1007
+FILEMODES, FILEMTIMES, FILEDIGESTS, FILELINKTOS = 1030, 1034, 1035, 1036
+DIRINDEXES, BASENAMES, DIRNAMES = 1116, 1117, 1118
+REQUIRENAME, POSTIN = 1049, 1024
+
+PATHS = ["/etc", "/etc/demo.conf", "/usr/bin/hello", "/usr/bin/hi"]
+
+@pytest.fixture
+def root(tmp_path):
+    root = tmp_path / "root"
+    (root / "usr" / "bin").mkdir(parents=True)
+    (root / "usr" / "bin" / "hello").write_bytes(b"#!/bin/sh\necho hello\n")
+    os.chmod(str(root / "usr" / "bin" / "hello"), 0o755)
+    (root / "etc").mkdir()
+    (root / "etc" / "demo.conf").write_bytes(os.urandom(100000))
+    os.symlink("hello", str(root / "usr" / "bin" / "hi"))
+    return root
+
+def write(filename, root, compression="gzip", **args):
+    writer = RPMWriter(filename, "demo", "1.0", "1", "noarch", compression, **args)
+    writer.set_metadata("Demo", "Demo package", packager="Jane Doe <jane@example.com>")
+    writer.add_dependencies("requires", "bash >= 4, coreutils")
+    writer.add_script("postinst", "echo post\n")
+    writer.write(str(root), PATHS)
+
+@pytest.mark.parametrize("compression", ["gzip", "xz"])
+def test_package(root, tmp_path, compression):
+    filename = str(tmp_path / "demo.rpm")
+    write(filename, root, compression)
+    signature, header, payload = read_rpm(filename)
+
+    assert (header[NAME], header[VERSION], header[RELEASE]) == ("demo", "1.0", "1")
+    assert "bash" in header[REQUIRENAME] and "coreutils" in header[REQUIRENAME]
+    assert header[POSTIN] == "echo post\n"
+
+    names = [header[DIRNAMES][d] + b for d, b in zip(header[DIRINDEXES], header[BASENAMES])]
+    assert names == PATHS
+    content = (root / "etc" / "demo.conf").read_bytes()
+    assert header[FILEDIGESTS][1] == hashlib.sha256(content).hexdigest()
+    assert header[FILELINKTOS][3] == "hello"
+    assert header[FILEMODES][2] & 0o7777 == 0o755
+
+    entries = read_cpio(payload)
+    assert [name for name, mode, mtime, data in entries] == ["." + path for path in PATHS]
+    assert entries[1][3] == content
+    assert entries[3][3] == b"hello"
+
+def test_reproducible(root, tmp_path):
+    first = str(tmp_path / "first.rpm")
+    second = str(tmp_path / "second.rpm")
+    write(first, root, "xz", threads=1, source_date_epoch=EPOCH)
+    os.utime(str(root / "etc" / "demo.conf"))
+    write(second, root, "xz", threads=4, source_date_epoch=EPOCH)
+
+    with open(first, "rb") as f1, open(second, "rb") as f2:
+        assert f1.read() == f2.read()
+    signature, header, payload = read_rpm(first)
+    assert header[BUILDTIME] == [EPOCH]
+    assert header[BUILDHOST] == "localhost"
+    assert set(header[FILEMTIMES]) == {EPOCH}
+
+def test_given_digests(root, tmp_path):
+    # Digests computed before are used as they are, files are not hashed again
+    filename = str(tmp_path / "demo.rpm")
+    writer = RPMWriter(filename, "demo", "1.0", "1", "noarch")
+    writer.set_metadata("Demo", "Demo package")
+    writer.write(str(root), PATHS, digests={"/etc/demo.conf": "0" * 64})
+    signature, header, payload = read_rpm(filename)
+    assert header[FILEDIGESTS][1] == "0" * 64
+
+def test_output_directory_is_created(root, tmp_path):
+    filename = str(tmp_path / "new" / "out" / "demo.rpm")
+    write(filename, root)
+    assert os.listdir(str(tmp_path / "new" / "out")) == ["demo.rpm"]
@@ -0,0 +1,63 @@
+import os
+import threading
+
+import pytest
+
+import server
+from server import BuildServer, request
+
+def build(args, cwd, logfile):
+    """
+    Stands in for serve_job, packagespec "broken" fails and "crash"
+    kills the worker process
+    """
+    with open(logfile, "w") as f:
+        f.write("building {0} in {1}\n".format(" ".join(args), cwd))
+    if args[0] == "crash":
+        os._exit(1)
+    if args[0] == "broken":
+        return ["broken"], {}
+    return [], {"demo_version": "1.0"}
+
+@pytest.fixture
+def socket_path(tmp_path):
+    path = str(tmp_path / "server.sock")
+    build_server = BuildServer(path, build, workers=2, log_dir=str(tmp_path / "logs"))
+    thread = threading.Thread(target=build_server.serve_forever)
+    thread.start()
+    yield path
+    build_server.shutdown()
+    thread.join()
+    build_server.server_close()
+
+def test_build_and_wait(socket_path):
+    job = request(socket_path, {"action": "build", "args": ["packagespec", "-f", "rpm"], "cwd": "/src"})
+    assert job["id"] == 1 and job["state"] in (server.QUEUED, server.RUNNING, server.DONE)
+
+    job = request(socket_path, {"action": "wait", "id": 1})
+    assert (job["state"], job["failed"], job["versions"]) == (server.DONE, [], {"demo_version": "1.0"})
+    with open(job["log"]) as f:
+        assert f.read() == "building packagespec -f rpm in /src\n"
+
+def test_failed_jobs(socket_path):
+    broken = request(socket_path, {"action": "build", "args": ["broken"]})
+    assert request(socket_path, {"action": "wait", "id": broken["id"]})["failed"] == ["broken"]
+    crash = request(socket_path, {"action": "build", "args": ["crash"]})
+    crash = request(socket_path, {"action": "wait", "id": crash["id"]})
+    assert crash["state"] == server.FAILED and "worker died" in crash["error"]
+
+    # A new pool replaces the broken one
+    job = request(socket_path, {"action": "build", "args": ["packagespec"]})
+    assert request(socket_path, {"action": "wait", "id": job["id"]})["state"] == server.DONE
+
+    jobs = request(socket_path, {"action": "status"})["jobs"]
+    assert [job["id"] for job in jobs] == [1, 2, 3]
+    assert len(set(job["log"] for job in jobs)) == 3
+
+def test_invalid_requests(socket_path):
+    assert request(socket_path, {"action": "build", "args": []}) == {"error": "No packagespec given"}
+    assert request(socket_path, {"action": "status", "id": 7})["error"].startswith("Invalid request")
+    assert request(socket_path, {"action": "dance"}) == {"error": "Unknown action dance"}
+
+def test_shutdown(socket_path):
+    assert request(socket_path, {"action": "shutdown"}) == {"state": "shutdown"}
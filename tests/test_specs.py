@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+import specs
+from specs import load_spec, validate, SpecError
+
+VALID = {
+    "name": "demo",
+    "version": 1.0,
+    "maintainer": "Jane Doe <jane@example.com>",
+    "summary": "Demo",
+    "description": "Demo package",
+    "packages": [{"package": "debian", "architecture": "all"}],
+}
+
+def spec(**changes):
+    spec = dict(VALID, **changes)
+    return dict((key, value) for key, value in spec.items() if value is not None)
+
+def test_valid():
+    assert validate(spec()) == []
+    assert validate(spec(scripts={"postinst": "SCRIPTS/postinst"}, pkgbuild={"hooks": [{"name": "a", "command": "true"}]})) == []
+
+@pytest.mark.parametrize("changes, error", [
+    ({"name": None}, "spec: missing name"),
+    ({"name": 1}, "spec: name has wrong type int"),
+    ({"version": True}, "spec: version has wrong type bool"),
+    ({"packages": []}, "spec: no packages"),
+    ({"packages": ["debian"]}, "package 1: has to be a mapping"),
+    ({"packages": [{"package": "debian"}]}, "package 1: missing architecture"),
+    ({"packages": [{"package": "rpm", "architecture": "all", "directory_exclude_list": ["/usr", 1]}]},
+        "package 1: directory_exclude_list entry 1 is not a string"),
+    ({"scripts": {"postinst": ["a"]}}, "spec: script postinst has to be a file name"),
+    ({"pkgbuild": {"hooks": {"name": "a"}}}, "pkgbuild: hooks has to be a list"),
+    ({"pkgbuild": {"hooks": [{"name": "a"}]}}, "pkgbuild: hooks need name and command: {'name': 'a'}"),
+])
+def test_invalid(changes, error):
+    assert validate(spec(**changes)) == [error]
+
+def test_not_a_mapping():
+    assert validate(["demo"]) == ["packagespec has to be a mapping, not list"]
+
+def test_load_spec(tmp_path):
+    filename = tmp_path / "packagespec"
+    filename.write_text("name: demo\nversion: 1.0\nrelease: 2\nmaintainer: Jane\nsummary: Demo\n"
+        "description: Demo\npackages:\n  - package: debian\n    architecture: all\n")
+    loaded = load_spec(str(filename))
+    # Values used as strings are normalized
+    assert (loaded["version"], loaded["release"]) == ("1.0", "2")
+    assert len(os.listdir(specs.cache_dir)) == 1
+
+    # Unchanged spec comes from the cache, also in a new process
+    specs.memory_cache.clear()
+    assert load_spec(str(filename)) == loaded
+
+def test_load_invalid_spec(tmp_path):
+    filename = tmp_path / "packagespec"
+    filename.write_text("name: demo\npackages: []\n")
+    with pytest.raises(SpecError) as e:
+        load_spec(str(filename))
+    assert "spec: missing maintainer" in str(e.value)
+    assert "spec: no packages" in str(e.value)
+
+    filename.write_text("name: [demo\n")
+    with pytest.raises(SpecError):
+        load_spec(str(filename))
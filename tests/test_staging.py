@@ -0,0 +1,94 @@
+import os
+import shutil
+
+import pytest
+
+from staging import FileLinker, StagingArea, link_tree, sync_tree
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "tree"
+    (root / "usr" / "bin").mkdir(parents=True)
+    (root / "usr" / "bin" / "hello").write_text("#!/bin/sh\necho hello\n")
+    os.chmod(str(root / "usr" / "bin" / "hello"), 0o755)
+    (root / "etc").mkdir()
+    (root / "etc" / "demo.conf").write_text("setting = 1\n")
+    os.symlink("hello", str(root / "usr" / "bin" / "hi"))
+    return root
+
+def listing(root):
+    entries = {}
+    for directory, dirs, files in os.walk(str(root)):
+        for name in dirs + files:
+            path = os.path.join(directory, name)
+            relpath = os.path.relpath(path, str(root))
+            if os.path.islink(path):
+                entries[relpath] = "-> " + os.readlink(path)
+            elif os.path.isdir(path):
+                entries[relpath] = None
+            else:
+                with open(path) as f:
+                    entries[relpath] = (f.read(), os.stat(path).st_mode & 0o7777)
+    return entries
+
+@pytest.mark.parametrize("methods", [["hardlink"], ["reflink", "copy_range"], []])
+def test_link_tree(tree, tmp_path, methods):
+    count = link_tree(str(tree), str(tmp_path / "copy"), FileLinker(methods), preserve_symlinks=True)
+    assert count == 6
+    assert listing(tmp_path / "copy") == listing(tree)
+    assert os.path.samefile(str(tree / "etc" / "demo.conf"), str(tmp_path / "copy" / "etc" / "demo.conf")) == (methods == ["hardlink"])
+
+def test_link_tree_follows_symlinks(tree, tmp_path):
+    link_tree(str(tree), str(tmp_path / "copy"), FileLinker([]))
+    assert not os.path.islink(str(tmp_path / "copy" / "usr" / "bin" / "hi"))
+    assert (tmp_path / "copy" / "usr" / "bin" / "hi").read_text() == (tree / "usr" / "bin" / "hello").read_text()
+
+def test_views_share_one_stage(tree, tmp_path):
+    staging = StagingArea(preserve_symlinks=True)
+    staging.view(str(tree), str(tmp_path / "first"))
+    staging.view(str(tree), str(tmp_path / "second"))
+    assert len(staging.directories()) == 1
+    assert listing(tmp_path / "first") == listing(tmp_path / "second") == listing(tree)
+
+    # Views are linked to the stage, never to the source tree
+    stagedir = staging.directories()[0]
+    conf = os.path.join("etc", "demo.conf")
+    assert not os.path.samefile(str(tree / conf), str(tmp_path / "first" / conf))
+    assert os.path.samefile(os.path.join(stagedir, conf), str(tmp_path / "first" / conf))
+    shutil.rmtree(stagedir)
+
+def test_sync_tree(tree, tmp_path):
+    # Files and symlinks are copied, directories are counted as unchanged
+    stage = tmp_path / "stage"
+    linker = FileLinker(["copy_range"])
+    assert sync_tree(str(tree), str(stage), linker, preserve_symlinks=True) == (3, 0, 3)
+    assert listing(stage) == listing(tree)
+
+    # Only changed entries are copied again
+    assert sync_tree(str(tree), str(stage), linker, preserve_symlinks=True) == (0, 0, 6)
+    (tree / "etc" / "demo.conf").write_text("setting = 22\n")
+    os.chmod(str(tree / "usr" / "bin" / "hello"), 0o700)
+    os.unlink(str(tree / "usr" / "bin" / "hi"))
+    (tree / "usr" / "bin" / "hi").mkdir()
+    (tree / "usr" / "share").mkdir()
+    assert sync_tree(str(tree), str(stage), linker, preserve_symlinks=True) == (1, 0, 6)
+    assert listing(stage) == listing(tree)
+
+    os.unlink(str(tree / "etc" / "demo.conf"))
+    assert sync_tree(str(tree), str(stage), linker, preserve_symlinks=True) == (0, 1, 6)
+    assert listing(stage) == listing(tree)
+
+def test_persistent_stage(tree, tmp_path):
+    staging = StagingArea(preserve_symlinks=True, persistent_dir=str(tmp_path / "stages"), name="demo")
+    staging.view(str(tree), str(tmp_path / "view"))
+    staging.close()
+    assert staging.directories() == []
+    assert listing(tmp_path / "view") == listing(tree)
+
+    # The next run finds the stage of the previous one
+    staging = StagingArea(preserve_symlinks=True, persistent_dir=str(tmp_path / "stages"), name="demo")
+    (tree / "etc" / "new.conf").write_text("new\n")
+    staging.view(str(tree), str(tmp_path / "next"))
+    staging.close()
+    assert listing(tmp_path / "next") == listing(tree)
+    assert len([name for name in os.listdir(str(tmp_path / "stages")) if not name.endswith(".lock")]) == 1
@@ -0,0 +1,25 @@
+import os
+
+import pytest
+
+import templating
+from templating import get_template, render_inline
+
+@pytest.fixture
+def module_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(templating, "module_root", str(tmp_path / "modules"))
+    monkeypatch.setattr(templating, "template_lookup", None)
+    monkeypatch.setattr(templating, "inline_templates", {})
+    return tmp_path / "modules"
+
+def test_templates_are_compiled_once(module_root):
+    template = get_template("debcontrol.tmpl")
+    assert get_template("debcontrol.tmpl") is template
+    # Compiled module is kept for the next processes
+    modules = [name for directory, dirs, files in os.walk(str(module_root)) for name in files]
+    assert modules == ["debcontrol.tmpl.py"]
+
+def test_render_inline(module_root):
+    assert render_inline("libdemo (>= ${version})", version="1.0") == "libdemo (>= 1.0)"
+    assert render_inline("libdemo (>= ${version})", version="2.0") == "libdemo (>= 2.0)"
+    assert list(templating.inline_templates) == ["libdemo (>= ${version})"]
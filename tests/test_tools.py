@@ -0,0 +1,19 @@
+import logging
+
+import pytest
+
+from tools import ToolError, run_tool
+
+def test_output_is_logged(caplog):
+    caplog.set_level(logging.INFO)
+    run_tool("echo", ["sh", "-c", "echo built; echo done >&2"])
+    assert [(r.levelno, r.message) for r in caplog.records] == [(logging.INFO, "echo: built"), (logging.INFO, "echo: done")]
+
+def test_failure(caplog):
+    with pytest.raises(ToolError, match="dpkg-deb failed with exit status 2"):
+        run_tool("dpkg-deb", ["sh", "-c", "echo broken; exit 2"])
+    assert [(r.levelno, r.message) for r in caplog.records] == [(logging.ERROR, "dpkg-deb: broken")]
+
+def test_missing_tool():
+    with pytest.raises(ToolError, match="Can't run rpmbuild"):
+        run_tool("rpmbuild", ["/nonexistent/rpmbuild", "-bb"])
@@ -0,0 +1,54 @@
+import os
+import json
+import multiprocessing
+
+import pytest
+
+import tracing
+from tracing import span
+
+@pytest.fixture
+def trace_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, "tracer", None)
+    return str(tmp_path / "trace.json")
+
+def child_span():
+    with span("child", files=1) as args:
+        args["bytes"] = 10
+
+def test_spans_are_off_by_default(monkeypatch):
+    monkeypatch.setattr(tracing, "tracer", None)
+    with span("stage", files=1) as args:
+        args["bytes"] = 1
+    assert args == {"files": 1, "bytes": 1}
+
+def test_chrome_trace(trace_file, capsys):
+    tracing.start(trace_file)
+    with span("build", format="debian") as args:
+        args["bytes"] = 100
+        with span("copy", files=3):
+            pass
+    with pytest.raises(ValueError):
+        with span("build", format="rpm"):
+            raise ValueError()
+    # Forked workers write their own parts
+    process = multiprocessing.get_context("fork").Process(target=child_span)
+    process.start()
+    process.join()
+    tracing.finish()
+
+    with open(trace_file) as f:
+        trace = json.load(f)
+    events = trace["traceEvents"]
+    assert [event["name"] for event in events] == ["build", "copy", "build", "child"]
+    assert all(event["ph"] == "X" and event["dur"] >= 0 for event in events)
+    assert events[0]["args"] == {"format": "debian", "bytes": 100}
+    assert events[2]["args"] == {"format": "rpm", "error": "ValueError"}
+    assert events[3]["pid"] == process.pid != events[0]["pid"] == os.getpid()
+    assert tracing.tracer is None
+
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split() == ["stage", "count", "total", "max", "files", "bytes"]
+    rows = dict((line.split()[0], line.split()[1:]) for line in lines[1:])
+    assert rows["build"][0] == "2" and rows["build"][-1] == "100"
+    assert rows["copy"][-1] == "3"
@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+import treeindex
+from treeindex import TreeIndex, DIRECTORY, FILE, SYMLINK
+
+@pytest.fixture
+def root(tmp_path):
+    root = tmp_path / "tree"
+    (root / "usr" / "lib").mkdir(parents=True)
+    (root / "usr" / "lib" / "a.so").write_bytes(b"x" * 1025)
+    os.link(str(root / "usr" / "lib" / "a.so"), str(root / "usr" / "lib" / "b.so"))
+    (root / "etc").mkdir()
+    (root / "etc" / "empty.conf").write_bytes(b"")
+    (root / "etc" / "demo.conf").write_bytes(b"x" * 10)
+    os.symlink("usr/lib", str(root / "lib"))
+    return root
+
+def test_entries(root):
+    index = TreeIndex(str(root))
+    assert [(e.path, e.type) for e in index.entries] == [
+        ("etc", DIRECTORY), ("etc/demo.conf", FILE), ("etc/empty.conf", FILE),
+        ("lib", SYMLINK), ("usr", DIRECTORY), ("usr/lib", DIRECTORY),
+        ("usr/lib/a.so", FILE), ("usr/lib/b.so", FILE)]
+    assert index.entries[3].linkto == "usr/lib"
+    assert [e.path for e in index.directories()] == ["etc", "usr", "usr/lib"]
+
+def test_follow_symlinks(root):
+    index = TreeIndex(str(root), follow_symlinks=True)
+    paths = [e.path for e in index.entries]
+    assert "lib/a.so" in paths and "usr/lib/a.so" in paths
+    assert dict((e.path, e.type) for e in index.entries)["lib"] == DIRECTORY
+
+def test_installed_size(root):
+    # Like dpkg-gencontrol: files are rounded up to KiB, hardlinked a.so
+    # and b.so count once, directories and the symlink take 1 KiB each
+    index = TreeIndex(str(root))
+    assert index.installed_size() == 1 + 0 + 2 + 3 + 1
+    assert index.total_size() == 10 + len("usr/lib") + 2 * 1025
+
+def test_index_is_shared(root):
+    treeindex.clear_indexes()
+    index = treeindex.index_tree(str(root))
+    assert treeindex.index_tree(str(root)) is index
+    treeindex.clear_indexes()
+    assert treeindex.index_tree(str(root)) is not index
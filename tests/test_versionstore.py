@@ -0,0 +1,63 @@
+import os
+import hashlib
+
+import pytest
+
+import repacked
+import versionstore
+from repacked import Configuration
+from artifacts import ArtifactStore
+from versionstore import VersionStore
+
+@pytest.fixture
+def store(tmp_path):
+    return VersionStore(str(tmp_path / "versions.db"))
+
+def test_history(store):
+    store.record("demo", "1.0", "1", None, "debian", "/out/demo_1.0-1_all.deb", 1.5, "a" * 64)
+    store.record("demo", "1.0", "2", None, "debian", "/out/demo_1.0-2_all.deb", 2.0, "b" * 64)
+    store.record("demo", "1.0", "2", None, "rpm", "/out/demo-1.0-2.noarch.rpm", 2.0, "c" * 64)
+
+    assert [row['release'] for row in store.history("demo")] == ["2", "2", "1"]
+    assert [(row['format'], row['release']) for row in store.latest()] == [("debian", "2"), ("rpm", "2")]
+    assert store.recent_digests(1) == {"b" * 64, "c" * 64}
+    assert store.recent_digests(2) == {"a" * 64, "b" * 64, "c" * 64}
+    assert "demo_1.0-2_all.deb" in versionstore.format_builds(store.latest())
+
+@pytest.fixture
+def config(tmp_path, store):
+    config = Configuration()
+    config.output_dir = str(tmp_path / "out")
+    config.version = "1.0"
+    config.release = "1"
+    config.config_version_db = store
+    os.makedirs(config.output_dir)
+    with open(os.path.join(config.output_dir, "demo.deb"), "wb") as f:
+        f.write(b"package")
+    return config
+
+@pytest.fixture
+def reads(monkeypatch):
+    """
+    Packages hashed by digest_artifact
+    """
+    reads = []
+    def digest_artifact(filename):
+        reads.append(os.path.basename(filename))
+        return versionstore.digest_artifact(filename)
+    monkeypatch.setattr(repacked, "digest_artifact", digest_artifact)
+    monkeypatch.setattr("artifacts.digest_artifact", digest_artifact)
+    return reads
+
+def test_known_digest_is_recorded(config, store, reads):
+    repacked.record_version({"name": "demo"}, config, "debian", "demo.deb", 1.0, "0" * 64)
+    assert reads == []
+    assert store.history("demo")[0]['digest'] == "0" * 64
+
+def test_package_is_hashed_once(config, store, reads):
+    config.artifact_store = ArtifactStore(config.output_dir)
+    repacked.record_version({"name": "demo"}, config, "debian", "demo.deb", 1.0)
+    digest = hashlib.sha256(b"package").hexdigest()
+    assert reads == ["demo.deb"]
+    assert store.history("demo")[0]['digest'] == digest
+    assert os.path.samefile(os.path.join(config.output_dir, "demo.deb"), config.artifact_store.path(digest))
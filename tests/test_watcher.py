@@ -0,0 +1,57 @@
+import os
+import threading
+
+import pytest
+
+from watcher import InotifyWatcher, PollingWatcher
+from repacked import affected_packages
+
+@pytest.fixture(params=["inotify", "polling"])
+def watcher(request, tmp_path):
+    watcher = InotifyWatcher() if request.param == "inotify" else PollingWatcher(interval=0.05)
+    yield watcher
+    watcher.close()
+
+def change_later(change):
+    timer = threading.Timer(0.1, change)
+    timer.start()
+    return timer
+
+def test_tree_changes(watcher, tmp_path):
+    tree = tmp_path / "tree"
+    (tree / "usr").mkdir(parents=True)
+    watcher.watch_tree(str(tree))
+    watcher.start()
+
+    # Directories created later are watched too
+    change_later(lambda: (tree / "usr" / "share").mkdir()).join()
+    assert str(tree / "usr" / "share") in watcher.wait()
+    change_later(lambda: (tree / "usr" / "share" / "new").write_text("new\n")).join()
+    assert str(tree / "usr" / "share" / "new") in watcher.wait()
+
+def test_replaced_file(watcher, tmp_path):
+    script = tmp_path / "postinst"
+    script.write_text("#!/bin/sh\n")
+    (tmp_path / "other").write_text("other\n")
+    watcher.watch_file(str(script))
+    watcher.start()
+
+    def replace():
+        # Changes of other files of the directory aren't reported
+        (tmp_path / "other").write_text("changed\n")
+        (tmp_path / "postinst.new").write_text("#!/bin/sh\necho new\n")
+        os.rename(str(tmp_path / "postinst.new"), str(script))
+
+    change_later(replace).join()
+    assert watcher.wait() == {str(script)}
+
+def test_affected_packages(tmp_path):
+    spec = {
+        'packagetree': str(tmp_path / "tree"),
+        'scripts': {'postinst': str(tmp_path / "postinst")},
+        'packages': [{'package': 'debian'}, {'package': 'rpm', 'scripts': {'preinst': str(tmp_path / "preinst")}}],
+    }
+    assert affected_packages(spec, {str(tmp_path / "postinst")}) == {0}
+    assert affected_packages(spec, {str(tmp_path / "preinst")}) == {1}
+    assert affected_packages(spec, {str(tmp_path / "unrelated")}) == set()
+    assert affected_packages(spec, {str(tmp_path / "tree" / "etc")}) is None